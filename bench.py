@@ -0,0 +1,1104 @@
+# Micro-benchmarks for the hot paths of the client.
+# Run: python bench.py [name ...]   (no args runs everything)
+import asyncio
+import hashlib
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import io
+import copy
+import socket
+import threading
+from parser import bdecode, bencode, bencode_into, info_hash_from_bytes, parse_any, BencodeWriter
+from metainfo import Metainfo
+from recheck import recheck
+from storage import PieceStorage
+from picker import PiecePicker
+from wire import PeerProtocol, FAST_EXTENSION_BIT, allowed_fast_set
+from tracker import TrackerTiers, parse_peers
+from udp_tracker import UdpTrackerClient, UdpTrackerError, MAX_SCRAPE
+from dht import DhtNode
+
+def make_torrent(num_pieces, piece_length=262144):
+    """Build a synthetic single-file .torrent with num_pieces random piece hashes."""
+    info = {
+        b'length': num_pieces * piece_length,
+        b'name': b'bench.bin',
+        b'piece length': piece_length,
+        b'pieces': os.urandom(20 * num_pieces),
+    }
+    return bencode({b'announce': b'http://127.0.0.1:6969/announce', b'info': info})
+
+def timeit(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+def bench_info_hash():
+    data = make_torrent(50000)
+
+    def old_path():
+        d = bdecode(data)
+        return hashlib.sha1(bencode(d[b'info'])).digest()
+
+    def span_path():
+        return info_hash_from_bytes(data)[1]
+
+    assert old_path() == span_path()
+    t_old, t_new = timeit(old_path), timeit(span_path)
+    print(f"info_hash (50k pieces, {len(data)/1e6:.1f} MB): "
+          f"decode+re-encode {t_old*1000:.2f} ms | raw span {t_new*1000:.2f} ms | x{t_old/t_new:.1f}")
+
+def make_tracker_response(num_peers):
+    """Non-compact tracker response: one dict per peer, the worst case for the decoder."""
+    peers = [{b'ip': f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}".encode(),
+              b'peer id': os.urandom(20), b'port': 6881 + i % 1000} for i in range(num_peers)]
+    return bencode({b'interval': 1800, b'complete': num_peers, b'incomplete': 0, b'peers': peers})
+
+def bench_bdecode():
+    cases = {'metainfo 200k pieces': make_torrent(200000),
+             'tracker 20k peers': make_tracker_response(20000),
+             'tracker compact 50k peers': bencode({b'interval': 1800, b'peers': os.urandom(6 * 50000)})}
+    for label, data in cases.items():
+        mb = len(data) / 1e6
+        variants = {
+            'recursive': lambda: parse_any(data, 0),
+            'iterative': lambda: bdecode(data),
+            'zero-copy': lambda: bdecode(data, view_threshold=4096),
+            'lazy': lambda: bdecode(data, view_threshold=4096, lazy=True),
+        }
+        row = ' | '.join(f"{name} {mb / timeit(fn):.0f} MB/s" for name, fn in variants.items())
+        print(f"bdecode {label} ({mb:.1f} MB): {row}")
+
+def _random_value(rng, depth=0):
+    kind = rng.randrange(4 if depth < 4 else 2)
+    if kind == 0:
+        return rng.randint(-2**70, 2**70) if rng.random() < 0.1 else rng.randint(-1000, 1000)
+    if kind == 1:
+        return bytes(rng.getrandbits(8) for _ in range(rng.choice((0, 1, 5, 40, 300))))
+    if kind == 2:
+        return [_random_value(rng, depth + 1) for _ in range(rng.randrange(5))]
+    return {bytes(rng.getrandbits(8) for _ in range(rng.randrange(1, 8))): _random_value(rng, depth + 1)
+            for _ in range(rng.randrange(5))}
+
+# Operations a lazily decoded container must answer exactly like a plain one
+_LIST_OPS = (
+    lambda l: l + [1], lambda l: [1] + l, lambda l: l * 2, lambda l: 2 * l, lambda l: list(reversed(l)),
+    lambda l: l.pop(), lambda l: l.append(1), lambda l: l.insert(0, 1), lambda l: l.extend([1]),
+    lambda l: l.__iadd__([1]), lambda l: l.remove(1), lambda l: l.reverse(), lambda l: l.clear(),
+    lambda l: l.__setitem__(0, 1), lambda l: l.__delitem__(0), lambda l: l[1:], lambda l: l.count(1),
+    lambda l: l < [1], lambda l: len(l), lambda l: bool(l), lambda l: l.copy(), lambda l: copy.copy(l))
+_DICT_OPS = (
+    lambda d: d.pop(next(iter(d), b''), 0), lambda d: d.setdefault(b'k', 1), lambda d: d.update({b'k': 1}),
+    lambda d: d | {b'k': 1}, lambda d: {b'k': 1} | d, lambda d: d.__ior__({b'k': 1}), lambda d: {**d},
+    lambda d: dict(d), lambda d: d.popitem(), lambda d: d.__setitem__(b'k', 1), lambda d: list(reversed(d)),
+    lambda d: d.__delitem__(next(iter(d), b'')), lambda d: d.clear(), lambda d: b'k' in d,
+    lambda d: d.get(b'k'), lambda d: list(d.items()), lambda d: d.copy(), lambda d: copy.copy(d))
+
+def _nested_paths(value, path=()):
+    """Paths to every container below the top level (the ones lazy=True defers)."""
+    items = enumerate(value) if isinstance(value, list) else value.items() if isinstance(value, dict) else ()
+    for k, v in items:
+        if isinstance(v, (list, dict)):
+            yield path + (k,)
+            yield from _nested_paths(v, path + (k,))
+
+def _outcome(op, container):
+    try:
+        return op(container), container
+    except Exception as e:
+        return type(e), container
+
+def fuzz_bdecode(rounds=3000, seed=1):
+    """Equivalence check: every decoder mode must agree with the recursive parser,
+    and truncated / corrupted input may only ever raise ValueError."""
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        data = bencode(_random_value(rng))
+        expected = parse_any(data, 0)[0]
+        for kw in ({}, {'view_threshold': 32}, {'lazy': True}, {'view_threshold': 0, 'lazy': True}):
+            assert bdecode(data, **kw) == expected, (data, kw)
+        assert bdecode(bytearray(data)) == expected
+        assert bdecode(memoryview(data)) == expected
+        # A still undecoded container must behave exactly like the plain one, mutations included
+        for path in _nested_paths(expected):
+            plain, lazy = copy.deepcopy(expected), bdecode(data, lazy=True)
+            for k in path:
+                plain, lazy = plain[k], lazy[k]
+            ops = _LIST_OPS if isinstance(plain, list) else _DICT_OPS
+            op = rng.choice(ops)
+            assert _outcome(op, lazy) == _outcome(op, plain), (data, path, ops.index(op))
+        # Corrupt input must raise ValueError, never hang or return garbage silently,
+        # in every mode; repr() makes lazy containers decode all the way down
+        cut = data[:rng.randrange(len(data))] if len(data) > 1 else b''
+        bad = bytearray(data)
+        bad[rng.randrange(len(bad))] = rng.getrandbits(8)
+        for broken in (cut, bytes(bad)):
+            for kw in ({}, {'view_threshold': 32}, {'lazy': True}, {'view_threshold': 0, 'lazy': True}):
+                try:
+                    repr(bdecode(broken, **kw))
+                except ValueError:
+                    pass
+    print(f"fuzz_bdecode: {rounds} random structures OK")
+
+def bench_metainfo():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.torrent')
+        with open(path, 'wb') as f:
+            f.write(make_torrent(200000))
+        t_cold = timeit(lambda: Metainfo.load(path, use_cache=False))
+        Metainfo.load(path)
+        t_cached = timeit(lambda: Metainfo.load(path))
+    print(f"Metainfo.load (200k pieces): parse {t_cold*1000:.2f} ms | cached {t_cached*1000:.2f} ms")
+
+def legacy_bencode(data):
+    """The original per-level join encoder, kept as the baseline for bench_bencode."""
+    if isinstance(data, int):
+        return b'i' + str(data).encode() + b'e'
+    elif isinstance(data, bytes):
+        return str(len(data)).encode() + b':' + data
+    elif isinstance(data, list):
+        return b'l' + b''.join(legacy_bencode(item) for item in data) + b'e'
+    elif isinstance(data, dict):
+        result = [b'd']
+        for key in sorted(data.keys()):
+            result.append(legacy_bencode(key))
+            result.append(legacy_bencode(data[key]))
+        result.append(b'e')
+        return b''.join(result)
+    raise ValueError(f"Unsupported type for bencoding: {type(data)}")
+
+def bench_bencode():
+    deep = 0
+    for i in range(200):
+        deep = [deep, {b'k': i}]
+    cases = {
+        'tracker request': {b'info_hash': os.urandom(20), b'peer_id': os.urandom(20), b'port': 6881,
+                            b'uploaded': 0, b'downloaded': 123456, b'left': 9876543, b'event': b'started'},
+        'ext handshake': {b'm': {b'ut_metadata': 3, b'ut_pex': 1}, b'metadata_size': 31235,
+                          b'p': 6881, b'reqq': 250, b'v': b'NovaTorrent 1.0'},
+        'ut_metadata piece': {b'msg_type': 1, b'piece': 0, b'total_size': 31235, b'data': os.urandom(16384)},
+        'resume file': {b'info-hash': os.urandom(20), b'pieces': os.urandom(12500),
+                        b'files': [{b'length': i * 1000, b'mtime': 1700000000 + i} for i in range(2000)]},
+        'metainfo 50k pieces': bdecode(make_torrent(50000)),
+        'deep nesting x200': deep,
+    }
+    for label, obj in cases.items():
+        assert legacy_bencode(obj) == bencode(obj)
+        n = 2000 if len(legacy_bencode(obj)) < 50000 else 20
+        t_old = timeit(lambda: [legacy_bencode(obj) for _ in range(n)]) / n
+        t_new = timeit(lambda: [bencode(obj) for _ in range(n)]) / n
+        buf = bytearray()
+        t_into = timeit(lambda: [bencode_into(obj, buf) or buf.clear() for _ in range(n)]) / n
+        print(f"bencode {label}: legacy {t_old*1e6:.1f} us | bencode {t_new*1e6:.1f} us "
+              f"| bencode_into {t_into*1e6:.1f} us | x{t_old/t_new:.1f}")
+    sink = io.BytesIO()
+    with BencodeWriter(sink) as w:
+        for obj in cases.values():
+            w.write(obj)
+    assert sink.getvalue() == b''.join(bencode(o) for o in cases.values())
+
+def bench_recheck(size_mb=256, piece_length=1 << 20):
+    """Recheck throughput for 1 thread vs one per core, on a file in the page cache."""
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'data.bin')
+        hashes = bytearray()
+        with open(out + '.part', 'wb') as f:
+            for _ in range(size_mb * (1 << 20) // piece_length):
+                piece = os.urandom(piece_length)
+                hashes += hashlib.sha1(piece).digest()
+                f.write(piece)
+        info = {b'length': size_mb << 20, b'name': b'data.bin', b'piece length': piece_length,
+                b'pieces': bytes(hashes)}
+        meta = Metainfo.from_bytes(bencode({b'info': info}))
+        storage = PieceStorage(meta, out)
+        storage.open()
+        for workers in sorted({1, os.cpu_count() or 1}):
+            t = timeit(lambda: recheck(meta, storage, workers=workers), repeat=3)
+            print(f"recheck {size_mb} MB, {workers} thread(s): {size_mb / t:.0f} MB/s")
+        assert len(recheck(meta, storage)) == meta.num_pieces
+        storage.close()
+
+# --- Loopback swarm helpers ---
+
+def make_payload_torrent(size, piece_length=262144, private=False):
+    """Random payload plus a Metainfo describing it."""
+    data = os.urandom(size)
+    pieces = b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, size, piece_length))
+    info = {b'length': size, b'name': b'payload.bin', b'piece length': piece_length, b'pieces': pieces}
+    if private: info[b'private'] = 1
+    return data, Metainfo.from_bytes(bencode({b'announce': b'http://127.0.0.1:1/announce', b'info': info}))
+
+class LoopbackSeed:
+    """
+    Minimal seed on 127.0.0.1: handshake, full bitfield, unchoke, then answers
+    every request after `latency` seconds (simulated network delay) unless it
+    was cancelled in the meantime.
+    unchoke_delay holds the unchoke back (a real seed's next rechoke); with
+    fast=True and a client that supports BEP 6 it sends have_all and its
+    allowed-fast set instead, serves those pieces while choking and rejects
+    other requests.
+    """
+
+    def __init__(self, data, meta, latency=0.0, fast=False, unchoke_delay=0.0):
+        self.data, self.meta, self.latency = data, meta, latency
+        self.fast, self.unchoke_delay = fast, unchoke_delay
+        self.server = None
+        self.blocks_sent = self.cancelled = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[:2]
+
+    def close(self):
+        self.server.close()
+
+    async def _serve(self, w, cancelled, idx, begin, length):
+        await asyncio.sleep(self.latency)
+        if (idx, begin) in cancelled:
+            cancelled.discard((idx, begin))
+            self.cancelled += 1
+            return
+        off = idx * self.meta.piece_length + begin
+        if not w.is_closing():
+            w.write(struct.pack('>IBII', 9 + length, 7, idx, begin) + self.data[off:off + length])
+            self.blocks_sent += 1
+
+    async def _handle(self, r, w):
+        try:
+            h = await r.readexactly(68)
+            fast = self.fast and bool(h[27] & FAST_EXTENSION_BIT)
+            reserved = b'\0' * 7 + bytes([FAST_EXTENSION_BIT if self.fast else 0])
+            w.write(h[:20] + reserved + self.meta.info_hash + b'-NT0000-seedseedseed')
+            allowed = set()
+            if fast:
+                allowed = allowed_fast_set('127.0.0.1', self.meta.info_hash, self.meta.num_pieces)
+                w.write(struct.pack('>IB', 1, 0x0E) + b''.join(struct.pack('>IBI', 5, 0x11, i) for i in allowed))
+            else:
+                bf = bytearray((self.meta.num_pieces + 7) // 8)
+                for i in range(self.meta.num_pieces):
+                    bf[i >> 3] |= 0x80 >> (i & 7)
+                w.write(struct.pack('>IB', len(bf) + 1, 5) + bf)
+            choked = [True]
+
+            def unchoke():
+                choked[0] = False
+                if not w.is_closing(): w.write(struct.pack('>IB', 1, 1))
+            if self.unchoke_delay: asyncio.get_running_loop().call_later(self.unchoke_delay, unchoke)
+            else: unchoke()
+            cancelled = set()
+            while True:
+                length = struct.unpack('>I', await r.readexactly(4))[0]
+                msg = await r.readexactly(length) if length else b''
+                if msg[:1] == b'\x06':
+                    idx, begin, blen = struct.unpack('>III', msg[1:13])
+                    if choked[0] and idx not in allowed:
+                        if fast: w.write(struct.pack('>IBIII', 13, 0x10, idx, begin, blen))
+                        continue
+                    asyncio.ensure_future(self._serve(w, cancelled, idx, begin, blen))
+                elif msg[:1] == b'\x08':
+                    cancelled.add(struct.unpack('>II', msg[1:9]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            w.close()
+
+async def loopback_download(data, meta, seeds=1, latency=0.0, seed_kw=None, **downloader_kw):
+    """
+    Download meta from `seeds` loopback seeds; returns (seconds, downloader).
+    latency is one delay for every seed or a list with one per seed;
+    seed_kw are extra LoopbackSeed arguments.
+    """
+    from connect_to_peer_async import TorrentDownloader
+    latencies = latency if isinstance(latency, (list, tuple)) else [latency] * seeds
+    servers = [LoopbackSeed(data, meta, lat, **(seed_kw or {})) for lat in latencies]
+    peers = [await s.start() for s in servers]
+    tmp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tmp)   # resume record lands next to the (path-less) torrent
+    try:
+        out = os.path.join(tmp, 'payload.bin')
+        d = TorrentDownloader(meta, peers, max_peers=len(peers), **downloader_kw)
+        t = time.perf_counter()
+        ok = await d.download(out)
+        elapsed = time.perf_counter() - t
+        with open(out, 'rb') as f:
+            assert ok and f.read() == data
+        return elapsed, d
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+        for s in servers:
+            s.close()
+
+def quiet(fn, *args, **kw):
+    """Run fn with the downloader's per-piece terminal logging suppressed."""
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        return fn(*args, **kw)
+    finally:
+        sys.stdout = stdout
+
+def bench_loop_lag():
+    """Event-loop lag while downloading 4 MiB pieces: SHA-1 + write inline vs on the I/O executor."""
+    data, meta = make_payload_torrent(48 << 20, piece_length=4 << 20)
+    for label, workers in (('inline', 0), ('executor', 2)):
+        elapsed, d = quiet(asyncio.run, loopback_download(data, meta, seeds=3, io_workers=workers))
+        print(f"loop lag {label}: avg {d.loop_lag*1000:.1f} ms | max {d.loop_lag_max*1000:.1f} ms "
+              f"| {len(data) / elapsed / 1e6:.1f} MB/s")
+
+def bench_pipeline(latency=0.05):
+    """Throughput of a single connection to a seed with `latency` s of delay per request."""
+    data, meta = make_payload_torrent(32 << 20)
+    variants = (('depth 1', dict(adaptive_requests=False, max_request_depth=1)),
+                ('depth 16 (one piece, ~old behaviour)', dict(adaptive_requests=False, max_request_depth=16)),
+                ('adaptive', dict()))
+    for label, kw in variants:
+        elapsed, _ = quiet(asyncio.run, loopback_download(data, meta, seeds=1, latency=latency, **kw))
+        print(f"pipeline {label}, {latency*1000:.0f} ms delay: {len(data) / elapsed / 1e6:.2f} MB/s per connection")
+
+def bench_endgame(slow_latency=1.0):
+    """Tail of a download where one of four seeds is very slow: endgame on vs off."""
+    data, meta = make_payload_torrent(8 << 20)
+    for label, endgame in (('off', False), ('on', True)):
+        elapsed, d = quiet(asyncio.run, loopback_download(data, meta, latency=[0.0, 0.0, 0.0, slow_latency], endgame=endgame))
+        s = d.scheduler
+        print(f"endgame {label}: {elapsed:.2f} s with one {slow_latency*1000:.0f} ms seed, "
+              f"{s.duplicate_requests} duplicate requests, {d.cancels_sent} cancels, {s.wasted_bytes / 1024:.0f} KB wasted")
+
+def bench_ttfb(unchoke_delay=1.0, latency=0.02):
+    """Time to first block from a seed that unchokes only after `unchoke_delay` s: BEP 6 off vs on."""
+    data, meta = make_payload_torrent(16 << 20)
+    seed_kw = dict(fast=True, unchoke_delay=unchoke_delay)
+    for label, fast in (('off', False), ('on', True)):
+        elapsed, d = quiet(asyncio.run, loopback_download(data, meta, latency=latency, seed_kw=seed_kw,
+                                                          fast_extension=fast))
+        print(f"fast extension {label}: first block after {d.time_to_first_block * 1000:.0f} ms, "
+              f"{len(d.verified_indices)} pieces in {elapsed:.2f} s (seed unchokes after {unchoke_delay:.1f} s)")
+
+async def legacy_receive_message(reader, timeout=10):
+    """The per-message receive path before wire.PeerProtocol, kept for comparison."""
+    try:
+        length_data = await asyncio.wait_for(reader.readexactly(4), timeout=timeout)
+        length = struct.unpack(">I", length_data)[0]
+        if length == 0: return None, None
+        msg_data = await asyncio.wait_for(reader.readexactly(length), timeout=timeout)
+        return msg_data[0], msg_data[1:]
+    except: return None, None
+
+def _stream_blocks(sock, total, piece_length=262144, block=16384):
+    # Sender thread: handshake, then `total` bytes of block payload
+    chunk = bytearray()
+    for begin in range(0, piece_length, block):
+        chunk += struct.pack('>IBII', 9 + block, 7, 0, begin) + os.urandom(block)
+    sock.sendall(b'\x13' + b'\0' * 67)
+    for _ in range(total // piece_length):
+        sock.sendall(chunk)
+    sock.close()
+
+def bench_wire(total=512 << 20, piece_length=262144):
+    """Receive-side CPU per GB of block traffic: StreamReader + wait_for vs the buffered protocol."""
+    async def legacy(sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        piece = bytearray(piece_length)
+        await reader.readexactly(68)
+        while True:
+            msg_id, payload = await legacy_receive_message(reader)
+            if msg_id is None: break
+            begin = struct.unpack(">I", payload[4:8])[0]
+            data = payload[8:]
+            piece[begin:begin + len(data)] = data
+        writer.close()
+
+    async def buffered(sock):
+        piece = memoryview(bytearray(piece_length))
+        loop = asyncio.get_running_loop()
+        _, proto = await loop.create_connection(
+            lambda: PeerProtocol(lambda i, b, n: piece[b:b + n]), sock=sock)
+        while not (proto.closed and not proto.messages):
+            await proto.wait_message(10)
+            proto.messages.clear()
+
+    for label, receiver in (('StreamReader', legacy), ('PeerProtocol', buffered)):
+        a, b = socket.socketpair()
+        sender = threading.Thread(target=_stream_blocks, args=(b, total, piece_length))
+        sender.start()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        asyncio.run(receiver(a))
+        cpu, wall = time.thread_time() - cpu, time.perf_counter() - wall
+        sender.join()
+        gb = total / 1e9
+        print(f"wire {label}: {cpu / gb:.2f} CPU s/GB on the loop thread, {total / wall / 1e6:.0f} MB/s")
+
+def _sink(sock):
+    # Reader thread: swallow everything the loop writes
+    while sock.recv(1 << 20):
+        pass
+
+def bench_requests(bursts=2000, per_burst=256):
+    """Cost of sending request bursts (one 4 MiB piece = 256 requests): write+drain each vs batched."""
+    async def legacy(sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        for _ in range(bursts):
+            for begin in range(per_burst):
+                writer.write(struct.pack(">IBIII", 13, 6, 0, begin * 16384, 16384))
+                await writer.drain()
+        writer.close()
+        return bursts * per_burst
+
+    async def batched(sock):
+        loop = asyncio.get_running_loop()
+        transport, proto = await loop.create_connection(PeerProtocol, sock=sock)
+        for _ in range(bursts):
+            for begin in range(per_burst):
+                proto.queue_request(0, begin * 16384, 16384)
+            await proto.drain()
+            await asyncio.sleep(0)   # one loop iteration: the burst goes out in one write
+        transport.close()
+        return proto.writes
+
+    for label, sender in (('write+drain', legacy), ('batched', batched)):
+        a, b = socket.socketpair()
+        reader = threading.Thread(target=_sink, args=(b,))
+        reader.start()
+        cpu = time.thread_time()
+        writes = asyncio.run(sender(a))
+        cpu = time.thread_time() - cpu
+        a.close()   # the loop may be gone before the transport finished closing
+        reader.join()
+        n = bursts * per_burst
+        print(f"requests {label}: {cpu / n * 1e6:.2f} CPU us/request, {writes} writes for {n} requests")
+
+def _instance(tmp, meta, name, peers, **downloader_kw):
+    """A client on loopback with its own directory, .torrent path and so resume file."""
+    from connect_to_peer_async import TorrentDownloader
+    raw = bencode({b'announce': b'http://127.0.0.1:1/announce', b'info': meta.info})
+    d = os.path.join(tmp, name)
+    os.makedirs(d)
+    m = Metainfo.from_bytes(raw, path=os.path.join(d, 'x.torrent'))
+    kw = {'max_peers': 8, 'listen_port': 0, **downloader_kw}
+    return TorrentDownloader(m, peers, **kw), os.path.join(d, 'payload.bin')
+
+async def _start_seeder(tmp, data, meta, **downloader_kw):
+    seeder, seed_out = _instance(tmp, meta, 'seed', [], **downloader_kw)
+    with open(seed_out, 'wb') as f:
+        f.write(data)
+    task = asyncio.ensure_future(seeder.download(seed_out, seed=True))
+    while not seeder.is_complete() or seeder.listen_port == 0:
+        await asyncio.sleep(0.01)
+    return seeder, task
+
+async def loopback_swarm(data, meta, leechers=1, **downloader_kw):
+    """
+    Real client instances on loopback: one seeds `data` from disk through its
+    listener, `leechers` more download from it and from each other.
+    Returns (seconds until every leecher is done, seeder, [leechers]).
+    """
+    tmp = tempfile.mkdtemp()
+    instance = lambda name, peers: _instance(tmp, meta, name, peers, **downloader_kw)
+    try:
+        seeder, seed_task = await _start_seeder(tmp, data, meta, **downloader_kw)
+        clients = [instance(f'leech{i}', [('127.0.0.1', seeder.listen_port)]) for i in range(leechers)]
+        t = time.perf_counter()
+        tasks = [asyncio.ensure_future(c.download(out, seed=True)) for c, out in clients]
+        while any(c.listen_port == 0 for c, _ in clients):
+            await asyncio.sleep(0.001)
+        # Later leechers also know the earlier ones (which listen too)
+        for i, (c, _) in enumerate(clients):
+            c.add_peers([('127.0.0.1', other.listen_port) for other, _ in clients[:i]])
+        while not all(c.is_complete() and c.finalized for c, _ in clients):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - t
+        for c, out in clients:
+            with open(out, 'rb') as f:
+                assert f.read() == data
+        for c, _ in clients + [(seeder, None)]:
+            c.is_aborted = True
+        await asyncio.gather(seed_task, *tasks)
+        return elapsed, seeder, [c for c, _ in clients]
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def bench_swarm(size=32 << 20, leechers=3):
+    """Client-to-client on loopback: one seeding instance, `leechers` downloading instances."""
+    data, meta = make_payload_torrent(size)
+    elapsed, seeder, clients = quiet(asyncio.run, loopback_swarm(data, meta, leechers))
+    print(f"swarm: {leechers} leechers got {size >> 20} MiB in {elapsed:.2f} s; "
+          f"seed uploaded {seeder.total_uploaded / 1e6:.1f} MB, "
+          + ", ".join(f"leecher {i} uploaded {c.total_uploaded / 1e6:.1f} MB" for i, c in enumerate(clients)))
+    # Every leecher's copy was uploaded by someone in the swarm, the seed included
+    assert seeder.total_uploaded > 0 and any(c.total_uploaded for c in clients)
+    assert seeder.total_uploaded + sum(c.total_uploaded for c in clients) >= leechers * size
+
+async def loopback_pex(data, meta, others=6, timeout=3.0, **downloader_kw):
+    """
+    A tracker that only ever announced the seed: `others` clients are connected
+    to it when a newcomer, also knowing only the seed, joins. Returns (seconds
+    until the newcomer has all others + 1 slots connected or None, slots
+    connected then, newcomer).
+    """
+    tmp = tempfile.mkdtemp()
+    seed_addr = lambda: [('127.0.0.1', seeder.listen_port)]
+    clients = []
+    try:
+        # Few upload slots keep the others interested, and so connected, for a while
+        seeder, seed_task = await _start_seeder(tmp, data, meta, upload_slots=2, **downloader_kw)
+        clients = [_instance(tmp, meta, f'peer{i}', seed_addr(), **downloader_kw) for i in range(others)]
+        tasks = [asyncio.ensure_future(c.download(out)) for c, out in clients]
+        while seeder.pool.connected < others:
+            await asyncio.sleep(0.001)
+        newcomer, out = _instance(tmp, meta, 'newcomer', seed_addr(), **{**downloader_kw, 'max_peers': others + 1})
+        tasks.append(asyncio.ensure_future(newcomer.download(out)))
+        t = time.perf_counter()
+        elapsed = None
+        while time.perf_counter() - t < timeout:
+            if newcomer.pool.connected >= others + 1:
+                elapsed = time.perf_counter() - t
+                break
+            await asyncio.sleep(0.001)
+        connected = newcomer.pool.connected
+        for c in [seeder, newcomer] + [c for c, _ in clients]:
+            c.is_aborted = True
+        await asyncio.gather(seed_task, *tasks)
+        return elapsed, connected, newcomer
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def bench_pex(size=64 << 20, others=6):
+    """Time to full connection slots when the tracker only knows one peer: PEX off vs on."""
+    data, meta = make_payload_torrent(size)
+    for label, pex in (('off', False), ('on', True)):
+        elapsed, connected, c = quiet(asyncio.run, loopback_pex(data, meta, others, pex=pex))
+        full = f"full after {elapsed * 1000:.0f} ms" if elapsed is not None else "never full"
+        print(f"pex {label}: {connected}/{others + 1} slots connected, {full}, "
+              f"{c.pex_received} addresses received, {len(c.pool)} peers known")
+        assert (c.pex_received > 0) == pex
+    # BEP 27: a private torrent's peers come from its tracker only, even with pex=True
+    data, meta = make_payload_torrent(size, private=True)
+    elapsed, connected, c = quiet(asyncio.run, loopback_pex(data, meta, others, pex=True))
+    print(f"pex on, private torrent: {connected}/{others + 1} slots connected, "
+          f"{c.pex_received} addresses received, {len(c.pool)} peers known")
+    assert not c.pex and c.pex_received == 0 and len(c.pool) == 1
+
+def _compact(peers):
+    return b''.join(socket.inet_aton(ip) + struct.pack('>H', port) for ip, port in peers)
+
+class FakeHttpTracker:
+    """HTTP tracker on 127.0.0.1 answering every announce with `peers` after `delay` s (None: never)."""
+
+    def __init__(self, peers, delay=0.0, interval=1800, min_interval=None):
+        self.peers, self.delay, self.interval, self.min_interval = peers, delay, interval, min_interval
+        self.server = None
+        self.announces = []    # query strings received
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/announce"
+
+    def close(self):
+        self.server.close()
+
+    async def _handle(self, r, w):
+        try:
+            request = await r.readuntil(b'\r\n\r\n')
+            self.announces.append(request.split(b' ')[1].partition(b'?')[2].decode())
+            if self.delay is None:
+                await r.read()   # until the client gives up
+                return
+            await asyncio.sleep(self.delay)
+            reply = {b'interval': self.interval, b'peers': _compact(self.peers)}
+            if self.min_interval: reply[b'min interval'] = self.min_interval
+            body = bencode(reply)
+            w.write(b'HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+            await w.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            w.close()
+
+class FakeUdpTracker(asyncio.DatagramProtocol):
+    """
+    UDP tracker (BEP 15) on 127.0.0.1 answering announces with `peers` and
+    scrapes with made-up counts. silent=True never answers; drop=n ignores
+    the first n datagrams (lost packets); connection ids expire after
+    conn_ttl s; reply='garbage' / 'wrong_action' answers announces wrongly.
+    """
+
+    def __init__(self, peers, interval=1800, silent=False, drop=0, conn_ttl=120.0, reply=None):
+        self.peers, self.interval, self.silent = peers, interval, silent
+        self.drop, self.conn_ttl, self.reply = drop, conn_ttl, reply
+        self.transport = None
+        self.received = self.connects = self.announces = self.scrapes = 0
+        self.conn_ids = {}    # connection id -> when it was issued
+        self.senders = set()  # addresses datagrams came from
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=('127.0.0.1', 0))
+        return f"udp://127.0.0.1:{self.transport.get_extra_info('sockname')[1]}"
+
+    def close(self):
+        self.transport.close()
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        self.senders.add(addr)
+        if self.silent or len(data) < 16: return
+        if self.drop:
+            self.drop -= 1
+            return
+        conn_id, action, tid = struct.unpack_from('>QII', data)
+        if action == 0 and conn_id == 0x41727101980:
+            self.connects += 1
+            new_id = random.getrandbits(64)
+            self.conn_ids[new_id] = time.monotonic()
+            self.transport.sendto(struct.pack('>IIQ', 0, tid, new_id), addr)
+        elif time.monotonic() - self.conn_ids.get(conn_id, -1e9) > self.conn_ttl:
+            self.transport.sendto(struct.pack('>II', 3, tid) + b'connection id expired', addr)
+        elif action == 1 and len(data) >= 98:
+            self.announces += 1
+            if self.reply == 'garbage':
+                self.transport.sendto(struct.pack('>II', 1, tid) + b'xx', addr)
+            elif self.reply == 'wrong_action':
+                self.transport.sendto(struct.pack('>IIIII', 2, tid, 0, 0, 0), addr)
+            else:
+                self.transport.sendto(struct.pack('>IIIII', 1, tid, self.interval, 0, len(self.peers))
+                                      + _compact(self.peers), addr)
+        elif action == 2 and (len(data) - 16) % 20 == 0:
+            self.scrapes += 1
+            n = (len(data) - 16) // 20
+            self.transport.sendto(struct.pack('>II', 2, tid) + struct.pack('>III', 5, 10, 3) * n, addr)
+        else:
+            self.transport.sendto(struct.pack('>II', 3, tid) + b'bad request', addr)
+
+def legacy_announce(urls, info_hash, peer_id):
+    """The sequential, blocking announce loop before tracker.TrackerTiers, kept for comparison."""
+    import urllib.request
+    import urllib.parse
+    peers = set()
+    for url in urls:
+        try:
+            if url.startswith('udp://'):
+                parsed = urllib.parse.urlparse(url)
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.settimeout(5)
+                trans_id = random.randint(0, 2**31 - 1)
+                sock.sendto(struct.pack(">QII", 0x41727101980, 0, trans_id), (parsed.hostname, parsed.port))
+                res, _ = sock.recvfrom(1024)
+                conn_id = struct.unpack(">IIQ", res[:16])[2]
+                # As it was: 13 values for 12 fields, so this raises and UDP trackers never worked
+                sock.sendto(struct.pack(">QII20s20sQQQIIIH", conn_id, 1, trans_id, info_hash, peer_id,
+                                        0, 0, 0, 0, 0, 0, -1, 6881), (parsed.hostname, parsed.port))
+                res, _ = sock.recvfrom(4096)
+                for i in range(20, len(res), 6):
+                    peers.add((socket.inet_ntoa(res[i:i+4]), struct.unpack(">H", res[i+4:i+6])[0]))
+            else:
+                params = urllib.parse.urlencode({'info_hash': info_hash, 'peer_id': peer_id, 'port': 6881, 'compact': 1})
+                with urllib.request.urlopen(url + "?" + params, timeout=3) as r:
+                    d = bdecode(r.read())
+                    peers.update(parse_peers(d[b'peers']))
+        except Exception:
+            pass
+    return peers
+
+async def _max_lag_during(coro, interval=0.01):
+    """(result of coro, worst event-loop lag while it ran)."""
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal worst
+        while not done:
+            t = loop.time()
+            await asyncio.sleep(interval)
+            worst = max(worst, loop.time() - t - interval)
+    tick = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0)
+    try:
+        return await coro, worst
+    finally:
+        done = True
+        await tick
+
+def bench_announce(timeout=3.0):
+    """Announce to a hanging HTTP, a silent UDP, a UDP and an HTTP tracker: old blocking loop vs TrackerTiers."""
+    info_hash, peer_id = os.urandom(20), b'-NT0000-' + os.urandom(12)
+
+    async def run():
+        udp_peers = [('10.0.0.%d' % i, 6881) for i in range(1, 31)]
+        http_peers = [('10.0.1.%d' % i, 6881) for i in range(1, 31)]
+        hang, fast_http = FakeHttpTracker([], delay=None), FakeHttpTracker(http_peers, delay=0.05)
+        silent, fast_udp = FakeUdpTracker([], silent=True), FakeUdpTracker(udp_peers)
+        urls = [await hang.start(), await silent.start(), await fast_udp.start(), await fast_http.start()]
+        try:
+            # Run in a thread here so the fake trackers on this loop can answer; in
+            # the client it ran on the loop, blocking it for the whole time
+            t = time.perf_counter()
+            peers = await asyncio.get_running_loop().run_in_executor(None, legacy_announce, urls, info_hash, peer_id)
+            print(f"announce legacy: {len(peers)} peers after {time.perf_counter() - t:.2f} s "
+                  f"(event loop blocked that long in the client)")
+
+            tiers = TrackerTiers([[u] for u in urls], timeout=timeout, udp_retries=0)
+            peers, first = set(), None
+
+            async def collect():
+                nonlocal first
+                async for url, res in tiers.announce(info_hash, peer_id, 6881, left=1):
+                    if not isinstance(res, Exception):
+                        peers.update(res.peers)
+                        first = first or time.perf_counter() - t
+            t = time.perf_counter()
+            _, lag = await _max_lag_during(collect())
+            tiers.close()
+            print(f"announce async: first peers after {first * 1000:.0f} ms, {len(peers)} peers, all trackers done "
+                  f"after {time.perf_counter() - t:.2f} s ({timeout:.0f} s timeout), max loop lag {lag * 1000:.1f} ms")
+        finally:
+            for tr in (hang, fast_http, silent, fast_udp):
+                tr.close()
+    asyncio.run(run())
+
+def bench_udp_tracker(announces=20, hashes=500):
+    """UDP tracker client against a local fake tracker: connection-id cache, retransmits, batched scrape, validation."""
+    info_hash, peer_id = os.urandom(20), b'-NT0000-' + os.urandom(12)
+
+    async def run():
+        peers = [('10.0.0.%d' % i, 6881) for i in range(1, 51)]
+        for label, ttl in (('connect every time', 0.0), ('cached connection id', 60.0)):
+            tracker = FakeUdpTracker(peers)
+            url = await tracker.start()
+            async with UdpTrackerClient(base_timeout=1.0, conn_id_ttl=ttl) as client:
+                t = time.perf_counter()
+                for _ in range(announces):
+                    got = await client.announce(url, info_hash, peer_id, 6881, left=1, numwant=50)
+                elapsed = time.perf_counter() - t
+            tracker.close()
+            print(f"udp {label}: {announces} announces, {client.packets_sent} packets, "
+                  f"{elapsed / announces * 1e6:.0f} us/announce, {len(got[3])} peers each")
+            assert got[3] == peers
+            assert client.packets_sent == (2 * announces if ttl == 0 else announces + 1)
+
+        tracker = FakeUdpTracker(peers, drop=3)
+        url = await tracker.start()
+        async with UdpTrackerClient(base_timeout=0.05) as client:
+            t = time.perf_counter()
+            got = await client.announce(url, info_hash, peer_id, 6881)
+            print(f"udp retransmit: first 3 packets lost, announce done after {time.perf_counter() - t:.2f} s "
+                  f"with {client.retransmits} retransmits (backoff 0.05 * 2^n s), {len(got[3])} peers")
+            assert client.retransmits == 3 and got[3] == peers
+
+        tracker.conn_ttl = 0.1
+        async with UdpTrackerClient(base_timeout=0.5, conn_id_ttl=60.0) as client:
+            await client.announce(url, info_hash, peer_id, 6881)
+            await asyncio.sleep(0.2)
+            await client.announce(url, info_hash, peer_id, 6881)
+            print(f"udp expired connection id: recovered with {client.connects} connects")
+            assert client.connects == 2
+        tracker.close()
+
+        # Announcing to several trackers at once, as TrackerTiers does, opens one socket
+        trackers = [FakeUdpTracker(peers) for _ in range(3)]
+        urls = [await tr.start() for tr in trackers]
+        client = UdpTrackerClient(base_timeout=1.0)
+        await asyncio.gather(*(client.announce(u, info_hash, peer_id, 6881) for u in urls))
+        client.close()
+        senders = set().union(*(tr.senders for tr in trackers))
+        print(f"udp concurrent announces to {len(urls)} trackers: {len(senders)} socket(s)")
+        assert len(senders) == 1
+        for tr in trackers:
+            tr.close()
+
+        tracker = FakeUdpTracker(peers)
+        url = await tracker.start()
+        many = [os.urandom(20) for _ in range(hashes)]
+        async with UdpTrackerClient(base_timeout=1.0) as client:
+            t = time.perf_counter()
+            stats = await client.scrape(url, many)
+            elapsed = time.perf_counter() - t
+        print(f"udp scrape: {len(stats)} torrents in {tracker.scrapes} packets, {elapsed * 1000:.1f} ms")
+        assert set(stats) == set(many) and tracker.scrapes == -(-hashes // MAX_SCRAPE)
+        tracker.close()
+
+        rejected = 0
+        for reply in ('garbage', 'wrong_action'):
+            tracker = FakeUdpTracker(peers, reply=reply)
+            url = await tracker.start()
+            async with UdpTrackerClient(base_timeout=0.2, max_retries=0) as client:
+                try:
+                    await client.announce(url, info_hash, peer_id, 6881)
+                except UdpTrackerError as e:
+                    rejected += 1
+                    print(f"udp {reply} reply rejected: {e}")
+            tracker.close()
+        assert rejected == 2
+    asyncio.run(run())
+
+def bench_reannounce(size=4 << 20, new_seed_after=0.5):
+    """
+    A tracker first knows only a slow seed; a fast one joins `new_seed_after` s
+    later. Single announce vs periodic re-announce (interval 1 s) vs early
+    re-announce when short of peers (interval 1 h, min interval 1 s).
+    """
+    from urllib.parse import parse_qs
+    data, meta = make_payload_torrent(size)
+    variants = (('single announce', 3600, None, dict(announce_low_peers=0)),
+                ('periodic, interval 1 s', 1, 1, dict(announce_low_peers=0)),
+                ('early when short of peers', 3600, 1, dict()))
+
+    async def run(interval, min_interval, kw):
+        slow, fast = LoopbackSeed(data, meta, latency=0.25), LoopbackSeed(data, meta)
+        slow_addr, fast_addr = await slow.start(), await fast.start()
+        tracker = FakeHttpTracker([slow_addr], interval=interval, min_interval=min_interval)
+        url = await tracker.start()
+        asyncio.get_running_loop().call_later(new_seed_after, tracker.peers.append, fast_addr)
+        tmp = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            d = TorrentDownloader(meta, [], max_peers=8, adaptive_requests=False, max_request_depth=4,
+                                  trackers=TrackerTiers([[url]]), **kw)
+            t = time.perf_counter()
+            assert await d.download(os.path.join(tmp, 'payload.bin'))
+            return time.perf_counter() - t, [parse_qs(q) for q in tracker.announces]
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp, ignore_errors=True)
+            for s in (slow, fast, tracker):
+                s.close()
+
+    from connect_to_peer_async import TorrentDownloader
+    for label, interval, min_interval, kw in variants:
+        elapsed, announces = quiet(asyncio.run, run(interval, min_interval, kw))
+        log = ", ".join(f"{q.get('event', ['-'])[0]}(numwant {q['numwant'][0]}, left {int(q['left'][0]) >> 10} KiB)"
+                        for q in announces)
+        print(f"reannounce {label}: {elapsed:.2f} s; tracker saw {len(announces)} announces: {log}")
+
+async def dht_swarm(n, **node_kw):
+    """n DHT nodes on loopback; the first is the bootstrap router of all others, which join one by one."""
+    router = await DhtNode(bootstrap_nodes=(), **node_kw).start(host='127.0.0.1')
+    nodes = [router]
+    for _ in range(n - 1):
+        node = await DhtNode(bootstrap_nodes=[('127.0.0.1', router.port)], **node_kw).start(host='127.0.0.1')
+        await node.bootstrap()
+        nodes.append(node)
+    return nodes
+
+async def _dht_newcomer(router, **node_kw):
+    node = await DhtNode(bootstrap_nodes=[('127.0.0.1', router.port)], **node_kw).start(host='127.0.0.1')
+    await node.bootstrap()
+    return node
+
+def bench_dht(size=300, holders=8, dead=0.2, searches=10, timeout=0.3):
+    """
+    get_peers against an in-process swarm of `size` nodes with a share of them
+    gone: lookup latency and message counts for alpha 1 vs 3, bootstrap from
+    the router vs from a saved routing table, and a download whose only peer
+    source is the DHT.
+    """
+    info_hash = os.urandom(20)
+    rng = random.Random(1)
+
+    async def run():
+        nodes = await dht_swarm(size, query_timeout=timeout)
+        router = nodes[0]
+        for i, holder in enumerate(nodes[1:holders + 1]):
+            await holder.announce(await holder.lookup(info_hash, get_peers=True).wait(), 7000 + i)
+        for node in rng.sample(nodes[holders + 1:], int(size * dead)):
+            node.close()
+
+        for alpha in (1, 3):
+            first, total, queries, timeouts, found = [], [], 0, 0, 0
+            for _ in range(searches):
+                node = await _dht_newcomer(router, alpha=alpha, query_timeout=timeout)
+                lookup = await node.lookup(info_hash, get_peers=True).wait()
+                node.close()
+                if lookup.first_peers_after is not None: first.append(lookup.first_peers_after)
+                total.append(lookup.elapsed)
+                queries, timeouts, found = queries + lookup.queries, timeouts + lookup.timeouts, found + len(lookup.peers)
+            print(f"dht get_peers alpha={alpha}: first peers after {sum(first) / max(len(first), 1) * 1000:.0f} ms "
+                  f"({len(first)}/{searches} found any), done after {sum(total) / searches * 1000:.0f} ms, "
+                  f"{queries / searches:.1f} queries ({timeouts / searches:.1f} timed out), "
+                  f"{found / searches:.1f}/{holders} peers ({size} nodes, {dead:.0%} gone, {timeout} s timeout)")
+            assert found == searches * holders, (alpha, found)
+
+        tmp = tempfile.mkdtemp()
+        try:
+            state = os.path.join(tmp, 'dht.state')
+            node = DhtNode(state_file=state, bootstrap_nodes=[('127.0.0.1', router.port)], query_timeout=timeout)
+            await node.start(host='127.0.0.1')
+            t = time.perf_counter()
+            await node.bootstrap()
+            print(f"dht bootstrap via router: {len(node.table)} nodes, {node.queries_sent} queries, "
+                  f"{(time.perf_counter() - t) * 1000:.0f} ms")
+            assert len(node.table) > 0
+            node.close()
+            # The router is gone by the next start; the saved table is all there is
+            router.close()
+            for label, state_file in (('without saved table', None), ('from saved table', state)):
+                node = DhtNode(state_file=state_file, bootstrap_nodes=[('127.0.0.1', router.port)],
+                               query_timeout=timeout)
+                await node.start(host='127.0.0.1')
+                t = time.perf_counter()
+                await node.bootstrap()
+                lookup = await node.lookup(info_hash, get_peers=True).wait()
+                print(f"dht restart {label}, router down: {len(node.table)} nodes, {node.queries_sent} queries, "
+                      f"{(time.perf_counter() - t) * 1000:.0f} ms to bootstrap and look up, "
+                      f"{len(lookup.peers)}/{holders} peers")
+                assert len(lookup.peers) == (holders if state_file else 0), (label, len(lookup.peers))
+                node.close()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        # Malformed queries get KRPC errors (garbage: nothing) and leave the node up
+        loop = asyncio.get_running_loop()
+        target = ('127.0.0.1', nodes[-1].port)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.setblocking(False)
+            for packet, expected in (
+                    (b'garbage', None),
+                    (bencode({b't': b'aa', b'y': b'q', b'q': b'find_node', b'a': {b'id': b'x'}}), 203),
+                    (bencode({b't': b'ab', b'y': b'q', b'q': b'nope', b'a': {b'id': b'x' * 20}}), 204),
+                    (bencode({b't': b'ac', b'y': b'q', b'q': b'announce_peer',
+                              b'a': {b'id': b'y' * 20, b'info_hash': info_hash, b'port': 5, b'token': b'bad'}}), 203),
+                    (bencode({b't': b'ad', b'y': b'q', b'q': b'ping', b'a': {b'id': b'y' * 20}}), 'r')):
+                s.sendto(packet, target)
+                try:
+                    reply = bdecode(await asyncio.wait_for(loop.sock_recv(s, 1500), 0.2))
+                except asyncio.TimeoutError:
+                    reply = None
+                got = reply and (reply[b'e'][0] if reply[b'y'] == b'e' else reply[b'y'].decode())
+                assert got == expected, (packet, reply)
+        print("dht malformed queries: garbage ignored, errors 203/204/203, node still answers ping")
+        for node in nodes:
+            node.close()
+
+    async def download():
+        from connect_to_peer_async import TorrentDownloader
+        data, meta = make_payload_torrent(4 << 20)
+        nodes = await dht_swarm(50, query_timeout=timeout)
+        seed = LoopbackSeed(data, meta)
+        seed_port = (await seed.start())[1]
+        holder = nodes[-1]
+        await holder.announce(await holder.lookup(meta.info_hash, get_peers=True).wait(), seed_port)
+        tmp = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            results = []
+            for label, dht in (('trackers only', None),
+                               ('with DHT', DhtNode(bootstrap_nodes=[('127.0.0.1', nodes[0].port)],
+                                                   query_timeout=timeout))):
+                d = TorrentDownloader(meta, [], max_peers=8, trackers=TrackerTiers([]), dht=dht)
+                t = time.perf_counter()
+                ok = await d.download(os.path.join(tmp, 'payload.bin'))
+                results.append((label, ok, time.perf_counter() - t))
+            return results
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp, ignore_errors=True)
+            seed.close()
+            for node in nodes:
+                node.close()
+
+    asyncio.run(run())
+    results = quiet(asyncio.run, download())
+    for label, ok, elapsed in results:
+        print(f"dht download, no working tracker, {label}: {'complete' if ok else 'gave up'} after {elapsed:.2f} s")
+    assert [ok for _, ok, _ in results] == [False, True]
+
+class _SimPeer:
+    def __init__(self, bitfield, is_seed=False):
+        self.bitfield = bitfield
+        self.is_seed = is_seed
+
+    def has_piece(self, index):
+        return bool(self.bitfield[index >> 3] & (0x80 >> (index & 7)))
+
+def bench_picker(num_pieces=100_000, num_peers=200, num_seeds=10, picks=20_000):
+    """Rarest-first picker vs the old lowest-index linear scan on a large swarm."""
+    rng = random.Random(1)
+    nbytes = (num_pieces + 7) // 8
+    peers = []
+    for p in range(num_peers):
+        if p < num_seeds:
+            bf = bytearray(b'\xff' * nbytes)
+            bf[-1] &= (0xFF << (8 - num_pieces % 8)) & 0xFF if num_pieces % 8 else 0xFF
+        else:
+            # Half the peers hold ~50% of the pieces, the other half ~25%
+            bf = rng.getrandbits(8 * nbytes)
+            if p % 2: bf &= rng.getrandbits(8 * nbytes)
+            bf = bytearray(bf.to_bytes(nbytes, 'big'))
+        peers.append(_SimPeer(bf))
+
+    picker = PiecePicker(num_pieces, rng=random.Random(2))
+    t = time.perf_counter()
+    for peer in peers:
+        peer.is_seed = picker.add_bitfield(peer.bitfield)
+    t_bitfields = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for _ in range(picks):
+        picker.add_have(rng.randrange(num_pieces))
+    t_haves = time.perf_counter() - t
+
+    order = [rng.choice(peers) for _ in range(picks)]
+    t = time.perf_counter()
+    chosen = []
+    for peer in order:
+        idx = picker.pick(peer, peer.is_seed)
+        if idx is not None:
+            picker.take(idx)
+            chosen.append(idx)
+    t_rarest = time.perf_counter() - t
+
+    started = set()
+    t = time.perf_counter()
+    linear = []
+    for peer in order:
+        for i in range(num_pieces):
+            if i not in started and peer.has_piece(i):
+                started.add(i)
+                linear.append(i)
+                break
+    t_linear = time.perf_counter() - t
+
+    avg = lambda idxs: sum(map(picker.count, idxs)) / max(1, len(idxs))
+    print(f"picker: {num_peers} peers x {num_pieces} pieces, bitfields counted in {t_bitfields:.2f} s, "
+          f"{picks} haves in {t_haves * 1e3:.1f} ms")
+    print(f"picker rarest-first: {t_rarest / picks * 1e6:.1f} us/pick, avg availability of picked pieces {avg(chosen):.1f}")
+    print(f"picker linear scan:  {t_linear / picks * 1e6:.1f} us/pick, avg availability of picked pieces {avg(linear):.1f}")
+
+BENCHES = {
+    'info_hash': bench_info_hash,
+    'bdecode': bench_bdecode,
+    'fuzz_bdecode': fuzz_bdecode,
+    'metainfo': bench_metainfo,
+    'bencode': bench_bencode,
+    'recheck': bench_recheck,
+    'loop_lag': bench_loop_lag,
+    'pipeline': bench_pipeline,
+    'picker': bench_picker,
+    'endgame': bench_endgame,
+    'ttfb': bench_ttfb,
+    'wire': bench_wire,
+    'requests': bench_requests,
+    'swarm': bench_swarm,
+    'pex': bench_pex,
+    'announce': bench_announce,
+    'udp_tracker': bench_udp_tracker,
+    'reannounce': bench_reannounce,
+    'dht': bench_dht,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        BENCHES[name]()
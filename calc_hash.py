@@ -1,7 +1,6 @@
 # In this file we calculate the SHA-1 info_hash of the 'info' dictionary in a .torrent file.
 # This is just a practice file and does not get imported anywhere
-from parser import bdecode, bencode
-import hashlib
+from metainfo import Metainfo
 import pprint
 
 def calculate_info_hash(torrent_file_path):
@@ -18,23 +17,8 @@ def calculate_info_hash(torrent_file_path):
         ValueError: If the file is invalid or missing the 'info' key.
         FileNotFoundError: If the torrent file does not exist.
     """
-    with open(torrent_file_path, 'rb') as f:
-        torrent_data = f.read()
-    
-    decoded = bdecode(torrent_data)
-    
-    # Extract the 'info' dictionary
-    if b'info' not in decoded:
-        raise ValueError("Torrent file does not contain 'info' dictionary")
-    info_dict = decoded[b'info']
-    
-    # Re-encode the 'info' dictionary
-    info_bencoded = bencode(info_dict)
-    
-    # Calculate SHA-1 hash
-    info_hash = hashlib.sha1(info_bencoded).digest()
-    
-    return info_hash
+    # Metainfo hashes the raw 'info' bytes exactly as they appear in the file
+    return Metainfo.load(torrent_file_path).info_hash
 
 
 try:
@@ -0,0 +1,43 @@
+# In this file we decide which peers we upload to: the classic rate-based
+# (tit-for-tat) choker with a rotating optimistic unchoke.
+
+import random
+
+class Choker:
+    """
+    Every rechoke() the slots - 1 interested peers that upload to us fastest
+    (while downloading) or that we upload to fastest (once seeding) are
+    unchoked. One more slot is an optimistic unchoke: a random other
+    interested peer, rotated every optimistic_every rounds, so newcomers
+    get a chance to prove themselves.
+    """
+
+    def __init__(self, slots=4, optimistic_every=3, rng=None):
+        self.slots = slots
+        self.optimistic_every = optimistic_every
+        self.rng = rng or random.Random()
+        self.optimistic = None
+        self.round = 0
+
+    def rechoke(self, peers, seeding=False):
+        """The set of peers that should be unchoked now."""
+        interested = [p for p in peers if p.peer_interested and not p.closed]
+        if seeding:
+            ranked = sorted(interested, key=lambda p: p.stats.upload_rate, reverse=True)
+        else:
+            ranked = sorted(interested, key=lambda p: p.stats.rate, reverse=True)
+        regular = ranked[:max(0, self.slots - 1)]
+        unchoked = set(regular)
+
+        self.round += 1
+        stale = (self.optimistic is None or self.optimistic not in interested
+                 or self.optimistic in unchoked or self.round % self.optimistic_every == 0)
+        if stale:
+            others = [p for p in interested if p not in unchoked]
+            self.optimistic = self.rng.choice(others) if others else None
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        return unchoked
+
+    def has_free_slot(self, peers):
+        return sum(1 for p in peers if not p.am_choking) < self.slots
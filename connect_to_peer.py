@@ -5,7 +5,7 @@ import socket
 import struct
 import hashlib
 import time
-from parser import bdecode, bencode
+from metainfo import Metainfo
 
 class BitTorrentPeer:
     """Handles communication with a single BitTorrent peer."""
@@ -284,32 +284,22 @@ def download_piece(peer, piece_index, piece_length, piece_hash, block_size=16384
     return complete_piece
 
 
-def download_from_peers(torrent_file_path, peers, output_file):
+def download_from_peers(torrent, peers, output_file):
     """
     Download a torrent file from peers.
     
     Args:
-        torrent_file_path: Path to .torrent file
+        torrent: Metainfo object or path to .torrent file
         peers: List of (ip, port) tuples
         output_file: Path to save downloaded file
     """
     # Read torrent metadata
-    with open(torrent_file_path, 'rb') as f:
-        torrent_data = bdecode(f.read())
-    
-    info = torrent_data[b'info']
-    info_hash = hashlib.sha1(bencode(info)).digest()
-    piece_length = info[b'piece length']
-    pieces_hash = info[b'pieces']
-    
-    # Calculate number of pieces
-    num_pieces = len(pieces_hash) // 20
-    
-    # Get total length
-    if b'length' in info:
-        total_length = info[b'length']
-    else:
-        total_length = sum(f[b'length'] for f in info[b'files'])
+    metainfo = Metainfo.coerce(torrent)
+    info_hash = metainfo.info_hash
+    piece_length = metainfo.piece_length
+    pieces_hash = metainfo.piece_hashes
+    num_pieces = metainfo.num_pieces
+    total_length = metainfo.total_length
     
     print(f"Torrent info: {num_pieces} pieces, {total_length} bytes total")
     
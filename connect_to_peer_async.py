@@ -4,242 +4,991 @@ import struct
 import hashlib
 import time
 import os  # FIX: name 'os' is not defined
-from parser import bdecode, bencode
-from collections import defaultdict
+from metainfo import Metainfo
+from storage import PieceStorage, WriteCache, ReadCache
+from resume import ResumeData, stat_files, pieces_to_bitfield
+from recheck import recheck
+from pipeline import RequestPipeline
+from scheduler import BlockScheduler
+from picker import PiecePicker
+from wire import PeerProtocol, FAST_EXTENSION_BIT, allowed_fast_set
+from peer_pool import PeerPool
+from peer_stats import PeerStats
+from choker import Choker
+from pex import (EXTENSION_BIT, EXTENDED, HANDSHAKE, UT_PEX, MAX_PEX_PEERS, PexState,
+                 handshake_payload, parse_handshake, pex_payload, parse_pex)
+from dht import DHT_BIT, PORT
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 class AsyncBitTorrentPeer:
-    def __init__(self, ip, port, info_hash, peer_id, timeout=10):
+    def __init__(self, ip, port, info_hash, peer_id, timeout=10, idle_timeout=120, block_buffer=None, fast=True,
+                 extensions=True, dht=False, num_pieces=None):
         self.ip, self.port, self.info_hash, self.peer_id = ip, port, info_hash, peer_id
+        self.num_pieces = num_pieces       # have messages past it are a protocol violation
         self.timeout = timeout
-        self.reader = self.writer = self.bitfield = None
+        self.idle_timeout = idle_timeout
+        self.block_buffer = block_buffer   # (index, begin, length) -> memoryview to receive into, or None
+        self.transport = self.protocol = self.bitfield = None
         self.peer_choking = True
         self.interested = False
+        self.is_seed = False   # counted as a seed by the piece picker
+        self.stats = PeerStats()
+        self.drop_reason = None
+        # Upload side: we start out choking them
+        self.am_choking = True
+        self.peer_interested = False
+        self.upload_queue = deque()        # (index, begin, length) they asked for
+        self.upload_ready = asyncio.Event()
+        # Fast extension (BEP 6): offered if fast, used if the peer offers it too
+        self.fast_extension = fast
+        self.fast = False
+        self.allowed_fast = set()          # pieces we may request while they choke us
+        self.allowed_fast_out = set()      # pieces we serve them while we choke them
+        self.suggested = deque(maxlen=32)  # pieces they suggested, tried first by the scheduler
+        # Extension protocol (BEP 10), same negotiation
+        self.extension_protocol = extensions
+        self.extended = False
+        self.extension_ids = {}            # extension name -> id the peer wants in messages to it
+        self.listen_addr = None            # where the peer accepts connections, for PEX
+        self.pex = PexState()
+        # DHT (BEP 5): PORT messages tell each other where our DHT nodes listen
+        self.dht_support = dht
+        self.dht = False
+
+    @property
+    def closed(self):
+        return self.protocol is None or self.protocol.closed
 
     async def connect(self):
         try:
-            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), timeout=self.timeout)
+            loop = asyncio.get_running_loop()
+            factory = lambda: PeerProtocol(self.block_buffer, self.idle_timeout)
+            self.transport, self.protocol = await asyncio.wait_for(
+                loop.create_connection(factory, self.ip, self.port), timeout=self.timeout)
             return True
-        except: return False
+        except (OSError, asyncio.TimeoutError): return False
 
-    async def handshake(self):
-        msg = struct.pack("B", 19) + b"BitTorrent protocol" + b'\x00'*8 + self.info_hash + self.peer_id
-        try:
-            self.writer.write(msg)
-            await self.writer.drain()
-            res = await asyncio.wait_for(self.reader.readexactly(68), timeout=self.timeout)
-            return res[28:48] == self.info_hash
-        except: return False
-
-    async def send_interested(self):
-        self.writer.write(struct.pack(">IB", 1, 2))
-        await self.writer.drain()
+    def accept(self, protocol):
+        # Inbound connection made by our listener
+        self.protocol, self.transport = protocol, protocol.transport
+        self.ip, self.port = self.transport.get_extra_info('peername')[:2]
+
+    async def handshake(self, inbound=False):
+        # Inbound peers speak first; we answer only if they want our torrent
+        reserved = bytearray(8)
+        if self.fast_extension: reserved[7] |= FAST_EXTENSION_BIT
+        if self.extension_protocol: reserved[5] |= EXTENSION_BIT
+        if self.dht_support: reserved[7] |= DHT_BIT
+        msg = struct.pack("B", 19) + b"BitTorrent protocol" + reserved + self.info_hash + self.peer_id
+        if not inbound: self.transport.write(msg)
+        await self.protocol.wait_message(self.timeout)
+        if not self.protocol.messages: return False
+        kind, res = self.protocol.messages.popleft()
+        # A peer with our own id is ourselves (e.g. our address came back through PEX)
+        ok = kind == 'handshake' and res[28:48] == self.info_hash and res[48:68] != self.peer_id
+        if ok and inbound: self.transport.write(msg)
+        if ok:
+            self.fast = self.fast_extension and bool(res[27] & FAST_EXTENSION_BIT)
+            self.extended = self.extension_protocol and bool(res[25] & EXTENSION_BIT)
+            self.dht = self.dht_support and bool(res[27] & DHT_BIT)
+        return ok
+
+    # Outgoing messages are queued and written together once per loop
+    # iteration; call drain() after a burst for backpressure
+
+    def send_interested(self):
+        self.protocol.queue_simple(2)
         self.interested = True
 
-    async def send_request(self, index, begin, length):
-        self.writer.write(struct.pack(">IBIII", 13, 6, index, begin, length))
-        await self.writer.drain()
+    def send_request(self, index, begin, length):
+        self.protocol.queue_request(index, begin, length)
+
+    def send_cancel(self, index, begin, length):
+        self.protocol.queue_request(index, begin, length, msg_id=8)
+
+    def send_have(self, index):
+        self.protocol.queue_have(index)
+
+    def send_bitfield(self, bitfield):
+        self.protocol.queue_message(5, bitfield)
+
+    def send_have_all(self):
+        self.protocol.queue_simple(0x0E)
+
+    def send_have_none(self):
+        self.protocol.queue_simple(0x0F)
+
+    def send_reject(self, index, begin, length):
+        self.protocol.queue_request(index, begin, length, msg_id=0x10)
+
+    def send_allowed_fast(self, index):
+        self.protocol.queue_have(index, msg_id=0x11)
+
+    def send_extended(self, ext_id, body):
+        self.protocol.queue_message(EXTENDED, bytes([ext_id]) + body)
+
+    def send_port(self, port):
+        self.protocol.queue_message(PORT, struct.pack(">H", port))
+
+    def send_choke(self):
+        self.protocol.queue_simple(0)
+        self.am_choking = True
+        # A choke discards their pending requests; with the fast extension each
+        # one is rejected explicitly and allowed-fast requests are still served
+        if not self.fast:
+            self.upload_queue.clear()
+            return
+        keep = deque()
+        for req in self.upload_queue:
+            if req[0] in self.allowed_fast_out: keep.append(req)
+            else: self.send_reject(*req)
+        self.upload_queue = keep
+
+    def send_unchoke(self):
+        self.protocol.queue_simple(1)
+        self.am_choking = False
+
+    def send_block(self, index, begin, data):
+        self.protocol.send_block(index, begin, data)
+        self.stats.on_upload(len(data))
+
+    async def drain(self):
+        await self.protocol.drain()
 
     async def receive_message(self):
-        try:
-            length_data = await asyncio.wait_for(self.reader.readexactly(4), timeout=self.timeout)
-            length = struct.unpack(">I", length_data)[0]
-            if length == 0: return None, None
-            msg_data = await asyncio.wait_for(self.reader.readexactly(length), timeout=self.timeout)
-            return msg_data[0], msg_data[1:]
-        except: return None, None
+        # Messages are parsed by the protocol as data arrives; this only
+        # waits (up to timeout) when none are queued
+        p = self.protocol
+        await p.wait_message(self.timeout)
+        if p.messages: return p.messages.popleft()
+        return None, None
 
     def handle_message(self, msg_id, payload):
         if msg_id == 0: self.peer_choking = True
         elif msg_id == 1: self.peer_choking = False
-        elif msg_id == 5: self.bitfield = payload
+        elif msg_id == 2:
+            self.peer_interested = True
+            return ('interested',)
+        elif msg_id == 3:
+            self.peer_interested = False
+            return ('not_interested',)
+        elif msg_id == 4:
+            index = struct.unpack(">I", payload[:4])[0] if len(payload) >= 4 else None
+            if index is None or (self.num_pieces is not None and index >= self.num_pieces):
+                # Checked before set_piece, which would grow the bitfield up to the index
+                self.drop(f"invalid have message ({index if index is not None else len(payload)})")
+                return None
+            if not self.has_piece(index):
+                self.set_piece(index)
+                return ('have', index)
+        elif msg_id == 5:
+            # Only valid as the first message; a late one would corrupt availability counts
+            if self.bitfield is None:
+                self.bitfield = bytearray(payload)
+                return ('bitfield',)
         elif msg_id == 7:
-            return ('piece', struct.unpack(">I", payload[0:4])[0], struct.unpack(">I", payload[4:8])[0], payload[8:])
+            # payload is (index, begin, length, data), data None if received in place
+            return ('piece',) + payload
+        elif msg_id in (6, 8, 0x10) and len(payload) >= 12:
+            index, begin, length = struct.unpack(">III", payload[:12])
+            return ({6: 'request', 8: 'cancel', 0x10: 'reject'}[msg_id], index, begin, length)
+        elif msg_id in (0x0D, 0x11) and self.fast and len(payload) >= 4:
+            return ('suggest' if msg_id == 0x0D else 'allowed_fast', struct.unpack(">I", payload[:4])[0])
+        elif msg_id == 0x0E and self.fast and self.bitfield is None:
+            return ('have_all',)   # the caller knows how many pieces there are
+        elif msg_id == 0x0F and self.fast and self.bitfield is None:
+            self.bitfield = bytearray()
+            return ('bitfield',)
+        elif msg_id == EXTENDED and self.extended and payload:
+            return ('extended', payload[0], payload[1:])
+        elif msg_id == PORT and self.dht and len(payload) >= 2:
+            return ('port', struct.unpack(">H", payload[:2])[0])
         return None
 
+    def set_piece(self, index):
+        byte_idx = index // 8
+        if self.bitfield is None: self.bitfield = bytearray()
+        if byte_idx >= len(self.bitfield): self.bitfield.extend(bytes(byte_idx + 1 - len(self.bitfield)))
+        self.bitfield[byte_idx] |= 0x80 >> (index % 8)
+
     def has_piece(self, index):
         if not self.bitfield: return False
         byte_idx, bit_idx = index // 8, 7 - (index % 8)
         return byte_idx < len(self.bitfield) and bool((self.bitfield[byte_idx] >> bit_idx) & 1)
 
+    def drop(self, reason):
+        # Close from outside the worker; its receive_message() then sees closed
+        self.drop_reason = reason
+        if self.transport: self.transport.close()
+
     async def close(self):
-        if self.writer: self.writer.close()
-
-async def download_piece_from_peer(peer, piece_index, piece_length, block_size=16384):
-    if not peer.interested: await peer.send_interested()
-    wait_t = 0
-    while peer.peer_choking and wait_t < 5:
-        mid, pld = await peer.receive_message()
-        peer.handle_message(mid, pld)
-        await asyncio.sleep(0.1); wait_t += 0.1
-    if peer.peer_choking: return None
-    for b in range(0, piece_length, block_size):
-        await peer.send_request(piece_index, b, min(block_size, piece_length - b))
-    data, blocks_count = {}, (piece_length + block_size - 1) // block_size
-    for _ in range(blocks_count * 2):
-        mid, pld = await peer.receive_message()
-        res = peer.handle_message(mid, pld)
-        if res and res[0] == 'piece' and res[1] == piece_index:
-            data[res[2]] = res[3]
-            if len(data) == blocks_count: return data
-    return None
+        if self.transport: self.transport.close()
 
 class TorrentDownloader:
-    def __init__(self, torrent_file_path, peers, max_peers=5):
-        self.torrent_file_path = torrent_file_path
+    def __init__(self, torrent, peers, max_peers=5, resume_interval=5, io_workers=2, max_pending_pieces=8,
+                 max_request_depth=250, adaptive_requests=True, endgame=True, max_connecting=10,
+                 snub_timeout=60, max_hash_failures=2, replace_interval=10, replace_grace=30,
+                 listen_port=None, upload_slots=4, rechoke_interval=10, max_upload_queue=500,
+                 fast_extension=True, pex=True, trackers=None, numwant=50, announce_low_peers=None,
+                 dht=None, dht_interval=900):
+        # torrent: a Metainfo (preferred, parsed once by the caller) or a .torrent path
+        self.metainfo = Metainfo.coerce(torrent)
+        self.torrent_file_path = self.metainfo.path
         self.peers = peers
         self.max_peers = max_peers
+        # Every known peer lives in the pool; download() keeps max_peers of them
+        # connected, with at most max_connecting attempts in flight
+        self.pool = PeerPool(peers)
+        self.max_connecting = max_connecting
+        self.worker_tasks = set()
+        # Peer policing: snub after snub_timeout s without a block, ban after
+        # max_hash_failures bad pieces, swap the worst peer for a waiting
+        # candidate at most every replace_interval s
+        self.snub_timeout = snub_timeout
+        self.max_hash_failures = max_hash_failures
+        self.replace_interval, self.replace_grace = replace_interval, replace_grace
+        self.last_replace = 0.0
+        self.wakeup = asyncio.Event()   # a slot freed up, peers were added or we are done
         self.is_aborted = False
-        self.state_file = torrent_file_path + ".state"
-        
-        with open(torrent_file_path, 'rb') as f:
-            torrent_data = bdecode(f.read())
-        
-        self.info = torrent_data[b'info']
-        self.info_hash = hashlib.sha1(bencode(self.info)).digest()
-        self.piece_length = self.info[b'piece length']
-        self.pieces_hash = self.info[b'pieces']
-        self.num_pieces = len(self.pieces_hash) // 20
+        self.resume_file = (self.metainfo.path or self.metainfo.info_hash.hex()) + ".resume"
+        self.resume_interval = resume_interval
         
-        # Calculate Total Length
-        if b'length' in self.info:
-            self.total_length = self.info[b'length']
-        else:
-            self.total_length = sum(f[b'length'] for f in self.info[b'files'])
+        self.info = self.metainfo.info
+        self.info_hash = self.metainfo.info_hash
+        self.piece_length = self.metainfo.piece_length
+        self.pieces_hash = self.metainfo.piece_hashes
+        self.num_pieces = self.metainfo.num_pieces
+        self.total_length = self.metainfo.total_length
         
         # Unique Peer ID
         self.peer_id = b'-PY0001-' + hashlib.sha1(str(time.time()).encode()).digest()[:12]
         
-        # Data Management
-        self.downloaded_pieces = self.load_data_from_disk()
-        self.verified_indices = set(self.downloaded_pieces.keys()) 
-        self.piece_locks = {i: asyncio.Lock() for i in range(self.num_pieces)}
-        self.pieces_in_progress = set()
+        # Data Management: verified pieces go straight to disk through self.storage,
+        # only pieces still being downloaded live in memory
+        self.storage = None
+        self.resume = ResumeData.load(self.resume_file, self.metainfo)
+        self.verified_indices = set()
+        if self.resume and self.resume.is_valid_for(self.resume.output_path):
+            self.verified_indices.update(self.resume.pieces)
+        self.resume_dirty = False
+        # Block-level scheduling and rarest-first picking, built in download()
+        # once the resume state is final
+        self.picker = self.scheduler = None
+        self.pipelines = {}   # peer -> its RequestPipeline, for endgame cancels
+        self.max_request_depth = max_request_depth
+        self.adaptive_requests = adaptive_requests
+        self.allow_endgame = endgame
+
+        # Uploading: an optional listener for incoming peers, a tit-for-tat
+        # choker run every rechoke_interval s, and a read cache for serving
+        self.listen_port = listen_port
+        self.server = None
+        self.choker = Choker(upload_slots)
+        self.rechoke_interval = rechoke_interval
+        self.max_upload_queue = max_upload_queue
+        self.read_cache = ReadCache()
+        self.reads_pending = {}
+        self.seeding = False
+        self.finalized = False
+        self.progress_callback = None
+        # Fast extension (BEP 6): have_all/have_none, reject, allowed-fast and suggest
+        self.fast_extension = fast_extension
+        # Peer exchange (BEP 10 + ut_pex; never for private torrents, BEP 27):
+        # connected peers' addresses go into the pool
+        self.pex = pex and self.metainfo.info.get(b'private') != 1
+        self.pex_received = 0
+        # Trackers (a tracker.TrackerTiers) are announced to from download()
+        # at the intervals they ask for, their peers streamed into the pool as
+        # each one answers; below announce_low_peers connections (and no
+        # untried peers) we re-announce early, asking for 4 * numwant peers
+        self.trackers = trackers
+        self.numwant = numwant
+        self.announce_low_peers = max(1, max_peers // 2) if announce_low_peers is None else announce_low_peers
+        self.announce_task = None
+        self.announce_tasks = {}   # task -> the event it announces
+        # Mainline DHT (a dht.DhtNode, BEP 5; never for private torrents):
+        # get_peers for our info hash every dht_interval s, every minute while
+        # short of peers, found peers streamed into the pool like the trackers'
+        self.dht = dht if self.metainfo.info.get(b'private') != 1 else None
+        self.dht_interval = dht_interval
+        self.dht_task = None
+        self.discovering = set()   # peer sources whose first round is still out
+        
+        # SHA-1 + disk writes run on this executor, never on the event loop.
+        # io_slots caps how many finished pieces may wait for it (backpressure).
+        self.io_executor = ThreadPoolExecutor(max_workers=io_workers) if io_workers else None
+        self.io_slots = asyncio.Semaphore(max_pending_pieces)
+        self.io_tasks = set()
+        self.io_error = None      # the disk error that stopped the download, if any
         
         self.total_downloaded_session = 0
+        self.total_uploaded = 0
+        self.cancels_sent = 0
         self.current_speed = 0
+        self.loop_lag = self.loop_lag_max = 0.0
+        self.started_at = None
+        self.time_to_first_block = None
 
         print(f"\n🚀 NovaTorrent Engine Started")
-        print(f"[*] Torrent: {os.path.basename(torrent_file_path)}")
+        print(f"[*] Torrent: {self.metainfo.name}")
         print(f"[*] Total Pieces: {self.num_pieces}")
         print(f"[*] Resume State: {len(self.verified_indices)} pieces already on disk.\n", flush=True)
 
-    def load_data_from_disk(self):
-        data = {}
-        if os.path.exists(self.state_file):
-            try:
-                with open(self.state_file, 'rb') as f:
-                    while True:
-                        h = f.read(8)
-                        if not h: break
-                        idx, l = struct.unpack(">II", h)
-                        data[idx] = f.read(l)
-            except: pass
-        return data
+    def is_complete(self):
+        return len(self.verified_indices) == self.num_pieces
+
+    def bytes_left(self):
+        return self.total_length - sum(self.get_piece_length(i) for i in self.verified_indices)
+
+    def add_peers(self, peers):
+        """Feed newly discovered (ip, port) peers into the pool while downloading."""
+        if self.pool.add_many(peers):
+            self.wakeup.set()
+
+    def fill_slots(self, progress_callback):
+        # Start connection attempts until both caps are reached or the pool runs dry
+        pool = self.pool
+        while (pool.connecting < self.max_connecting and pool.connecting + pool.connected < self.max_peers
+               and not self.is_aborted):
+            entry = pool.next_candidate()
+            if entry is None: break
+            pool.on_connecting(entry)
+            t = asyncio.create_task(self.peer_worker(entry, progress_callback))
+            self.worker_tasks.add(t)
+            t.add_done_callback(self._worker_done)
+
+    def _worker_done(self, task):
+        self.worker_tasks.discard(task)
+        self.wakeup.set()
+
+    async def prepare_resume(self, output_file, progress_callback=None):
+        # Resume record matches the files on disk: trust its bitfield, read nothing.
+        # Otherwise fall back to a full recheck, but only if there is data to check.
+        if self.resume and self.resume.is_valid_for(output_file):
+            return
+        # A finalized download (no .part files, real files present) is rechecked too, for seeding
+        had_data = any(stat_files(self.storage.layout)) or self.storage.detect_complete()
+        self.verified_indices.clear()
+        self.resume = ResumeData(self.metainfo, output_file)
+        self.storage.open()
+        if had_data:
+            print(f"[*] Resume data missing or stale, rechecking existing files...", flush=True)
+            good = await asyncio.get_running_loop().run_in_executor(
+                None, recheck, self.metainfo, self.storage, progress_callback)
+            self.verified_indices.update(good)
+            print(f"[*] Recheck done: {len(good)}/{self.num_pieces} pieces valid.", flush=True)
+        self.resume_dirty = True
+        await self.checkpoint_resume()
 
-    def save_piece_to_disk(self, index, data):
-        with open(self.state_file, 'ab') as f:
-            f.write(struct.pack(">II", index, len(data)) + data)
+    async def checkpoint_resume(self):
+        # Batched: the piece set is snapshotted here, on the loop thread.
+        # After a disk error no record is trusted, so none is written.
+        if not self.resume_dirty or self.storage is None or self.io_error: return
+        self.resume_dirty = False
+        await self.run_io(self.save_resume, set(self.verified_indices))
+
+    def save_resume(self, pieces):
+        # Data is fsynced first so the record never claims unsynced pieces
+        self.storage.sync()
+        self.resume.pieces = pieces
+        self.resume.save(self.resume_file, self.storage.layout)
 
     def verify_piece(self, idx, data):
         return hashlib.sha1(data).digest() == self.pieces_hash[idx*20:(idx+1)*20]
 
+    def verify_and_write(self, idx, data):
+        # Runs on self.io_executor
+        if not self.verify_piece(idx, data): return False
+        self.storage.write_piece(idx, data)
+        return True
+
+    async def commit_piece(self, idx, data, progress_callback):
+        # Caller already holds one io_slot; released when the piece is on disk
+        try:
+            try:
+                ok = await self.run_io(self.verify_and_write, idx, data)
+            except OSError as e:
+                # Not the senders' fault: the piece goes back to be fetched again,
+                # but a disk that fails a write will fail the next one too
+                self.scheduler.piece_failed(idx)
+                self.on_io_error(e, f"writing piece {idx}")
+                return
+            if ok: self.scheduler.piece_done(idx)
+            else: self.on_hash_failure(idx, self.scheduler.piece_failed(idx))
+            if ok and idx not in self.verified_indices:
+                self.verified_indices.add(idx)
+                for peer in self.pipelines:
+                    if not peer.closed: peer.send_have(idx)
+                self.resume_dirty = True
+                self.total_downloaded_session += len(data)
+                
+                # Terminal Log for Verification
+                progress = (len(self.verified_indices)/self.num_pieces)*100
+                print(f"✅ Piece {idx} Verified! | Total Progress: {progress:.2f}%", flush=True)
+                
+                if self.is_complete():
+                    self.wakeup.set()
+                    if self.trackers: self.spawn_announce('completed')
+                    for peer in self.pipelines:
+                        if not peer.closed: peer.protocol.queue_simple(3)   # not interested any more
+                if progress_callback: 
+                    kb = self.current_speed / 1024
+                    s_str = f"{kb/1024:.2f} MB/s" if kb > 1024 else f"{kb:.2f} KB/s"
+                    progress_callback(len(self.verified_indices)/self.num_pieces, s_str)
+        finally:
+            self.io_slots.release()
+
+    def on_io_error(self, error, what):
+        print(f"[!] Disk error {what}: {error}. Stopping the download.", flush=True)
+        self.io_error = error
+        # Pieces the write cache could not write out are not ours after all
+        if self.storage: self.verified_indices.difference_update(self.storage.unwritten())
+        self.is_aborted = True
+        self.wakeup.set()
+
+    def on_hash_failure(self, idx, senders):
+        # Everyone who sent part of the piece is charged for it; a peer that sent
+        # all of it, or keeps sending bad data, is banned
+        print(f"[-] Piece {idx} failed its hash check", flush=True)
+        for peer, nbytes in senders.items():
+            peer.stats.on_hash_failure(nbytes)
+            if len(senders) == 1 or peer.stats.hash_failures >= self.max_hash_failures:
+                self.ban(peer, f"sent bad data for piece {idx}")
+
+    def ban(self, peer, reason):
+        if peer.drop_reason: return   # already on its way out
+        entry = self.pool.entries.get((peer.ip, peer.port))
+        if entry: self.pool.ban(entry)
+        print(f"[-] Banned {peer.ip}:{peer.port}: {reason}", flush=True)
+        peer.drop(reason)
+
+    def release_block(self, peer, idx, begin):
+        # The block goes back to the scheduler for another peer; if it is still
+        # arriving into the piece buffer from this one, the rest lands elsewhere
+        self.scheduler.release(peer, idx, begin)
+        peer.protocol.divert_block(idx, begin)
+
+    def police_peers(self, now):
+        # Called once a second: update rates, flag snubbing peers and hand their
+        # requests to others, and replace the worst peer when candidates wait
+        for peer, pipe in self.pipelines.items():
+            peer.stats.tick(now)
+            if not peer.stats.snubbed and len(pipe) and now - peer.stats.last_progress > self.snub_timeout:
+                peer.stats.snubbed = True
+                print(f"[-] {peer.ip}:{peer.port} is snubbing us", flush=True)
+                for idx, begin in pipe.drop_all():
+                    self.release_block(peer, idx, begin)
+                    peer.send_cancel(idx, begin, min(self.scheduler.block_size, self.get_piece_length(idx) - begin))
+        if (now - self.last_replace < self.replace_interval or self.pool.connected < self.max_peers
+                or not self.pool.has_candidate()):
+            return
+        settled = [p for p in self.pipelines if not p.closed and now - p.stats.connected_at >= self.replace_grace]
+        if len(settled) < 2: return
+        worst = min(settled, key=lambda p: p.stats.score())
+        mean_rate = sum(p.stats.rate for p in settled) / len(settled)
+        if worst.stats.snubbed or worst.stats.rate < 0.25 * mean_rate:
+            self.last_replace = now
+            worst.drop(f"slowest peer ({worst.stats.rate / 1024:.1f} KB/s), replaced")
+
+    # --- peer exchange ---
+
+    def on_extended(self, peer, ext_id, body):
+        try:
+            if ext_id == HANDSHAKE:
+                peer.extension_ids, port = parse_handshake(body)
+                if port and peer.listen_addr is None: peer.listen_addr = (peer.ip, port)
+                if self.pex: self.send_pex(peer, self.pex_addrs(), time.monotonic())
+            elif ext_id == UT_PEX and self.pex and peer.pex.accept(time.monotonic()):
+                # Rate-limited per peer and capped per message; the pool drops known
+                # addresses, peers connected to us are skipped here
+                connected = self.pex_addrs()
+                added = [a for a in parse_pex(body)[:MAX_PEX_PEERS] if a not in connected]
+                self.pex_received += len(added)
+                self.add_peers(added)
+        except ValueError:
+            pass   # malformed extension message: ignore it
+
+    def pex_addrs(self):
+        """Dialable addresses of our current connections."""
+        return {p.listen_addr for p in self.pipelines if p.listen_addr and not p.closed}
+
+    def send_pex(self, peer, current, now):
+        ut_pex = peer.extension_ids.get(b'ut_pex')
+        if not ut_pex or peer.closed: return
+        update = peer.pex.update(current - {peer.listen_addr}, now)
+        if update:
+            seeds = {p.listen_addr for p in self.pipelines if p.is_seed}
+            peer.send_extended(ut_pex, pex_payload(*update, seeds=seeds))
+
+    def exchange_peers(self, now):
+        # Called once a second; each peer gets at most one PEX message per PEX_INTERVAL
+        current = self.pex_addrs()
+        for peer in list(self.pipelines):
+            if peer.pex.due(now): self.send_pex(peer, current, now)
+
+    # --- trackers ---
+
+    async def announce(self, event=None, urls=None, numwant=None):
+        """Announce to urls (default: every tracker) at once; returns how many new peers they gave us."""
+        found = 0
+        numwant = self.numwant if numwant is None else numwant
+        async for url, res in self.trackers.announce(self.info_hash, self.peer_id, self.listen_port or 6881,
+                                                     self.total_uploaded, self.total_downloaded_session,
+                                                     self.bytes_left(), event, numwant, urls):
+            if isinstance(res, Exception):
+                print(f"[-] Tracker {url[:60]}: {res or type(res).__name__}", flush=True)
+                continue
+            n = self.pool.add_many(res.peers)
+            found += n
+            print(f"[+] Tracker {url[:60]}: {len(res.peers)} peers ({n} new)", flush=True)
+            if n: self.wakeup.set()
+        return found
+
+    def spawn_announce(self, event=None, urls=None, numwant=None):
+        t = asyncio.create_task(self.announce(event, urls, numwant))
+        self.announce_tasks[t] = event
+        t.add_done_callback(lambda t: self.announce_tasks.pop(t, None))
+
+    def short_of_peers(self):
+        return (not self.is_complete() and self.pool.connected < self.announce_low_peers
+                and not self.pool.has_candidate())
+
+    def discovered(self, source):
+        # The first round of every peer source is in: no peers at all means we give up
+        self.discovering.discard(source)
+        if not self.discovering and not len(self.pool) and not self.pipelines and not self.seeding:
+            print(f"[!] No active peers found on any tracker{' or the DHT' if self.dht else ''}.", flush=True)
+            self.is_aborted = True
+            self.wakeup.set()
+
+    async def announce_loop(self):
+        await self.announce()   # 'started' to every tracker
+        self.discovered('trackers')
+        while not self.is_aborted:
+            await asyncio.sleep(1)
+            # Short of peers with none left to try: ask for more as soon as trackers allow
+            low = self.short_of_peers()
+            due = self.trackers.due(early=low)
+            if due:
+                if low: print(f"[*] Only {self.pool.connected} peers connected, re-announcing early", flush=True)
+                self.spawn_announce(None, due, 4 * self.numwant if low else self.numwant)
+
+    async def announce_stopped(self, timeout=5.0):
+        # Let a 'completed' still in flight finish first, then tell the trackers
+        # that know us that we are gone, without holding up shutdown for long
+        self.announce_task.cancel()
+        events = [t for t, event in self.announce_tasks.items() if event]
+        for t, event in list(self.announce_tasks.items()):
+            if not event: t.cancel()
+        if events:
+            await asyncio.wait(events, timeout=timeout)
+            for t in events: t.cancel()
+        started = [url for url in self.trackers.urls() if self.trackers.status[url].started]
+        if not started: return
+        try: await asyncio.wait_for(self.announce('stopped', started, 0), timeout)
+        except asyncio.TimeoutError: pass
+
+    # --- DHT ---
+
+    async def dht_lookup(self):
+        """get_peers for our torrent over the DHT, announcing ourselves if we listen; how many new peers it gave us."""
+        lookup = self.dht.lookup(self.info_hash, get_peers=True)
+        found = 0
+        async for peers in lookup:
+            n = self.pool.add_many(peers)
+            found += n
+            if n: self.wakeup.set()
+        if self.server: await self.dht.announce(lookup, self.listen_port)
+        print(f"[+] DHT: {len(lookup.peers)} peers ({found} new), {lookup.queries} queries "
+              f"in {lookup.elapsed * 1000:.0f} ms", flush=True)
+        return found
+
+    async def dht_loop(self):
+        try:
+            await self.dht.start(self.listen_port or 0)
+        except OSError:
+            await self.dht.start()   # our port is taken for UDP: any port will do
+        boot = await self.dht.bootstrap()
+        print(f"[*] DHT: {len(self.dht.table)} nodes after bootstrap ({boot.queries} queries)", flush=True)
+        await self.dht_lookup()
+        self.discovered('dht')
+        last = time.monotonic()
+        while not self.is_aborted:
+            await asyncio.sleep(1)
+            if time.monotonic() - last >= (60 if self.short_of_peers() else self.dht_interval):
+                await self.dht_lookup()
+                last = time.monotonic()
+
+    async def run_io(self, fn, *args):
+        # Blocking disk work goes to the I/O executor (inline when io_workers=0)
+        if self.io_executor:
+            return await asyncio.get_running_loop().run_in_executor(self.io_executor, fn, *args)
+        return fn(*args)
+
+    async def measure_loop_lag(self, interval=0.05):
+        # How late the loop wakes us up is how long something blocked it
+        loop = asyncio.get_running_loop()
+        while not self.is_aborted:
+            t = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - t - interval)
+            self.loop_lag = 0.9 * self.loop_lag + 0.1 * lag
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+
     async def calculate_speed(self):
+        ticks = 0
         while not self.is_aborted:
             b = self.total_downloaded_session
             await asyncio.sleep(1)
             self.current_speed = self.total_downloaded_session - b
+            ticks += 1
+            if self.scheduler:
+                self.police_peers(time.monotonic())
+                if self.pex: self.exchange_peers(time.monotonic())
+                if ticks % self.rechoke_interval == 0: self.rechoke()
+            if self.storage and not self.io_error:
+                # A disk error must not end this task: policing, rechoke and PEX run here too
+                try:
+                    if ticks % self.resume_interval == 0: await self.checkpoint_resume()
+                    else: await self.run_io(self.storage.flush_if_due)
+                except OSError as e:
+                    self.on_io_error(e, "flushing to disk")
 
-    async def peer_worker(self, ip, port, progress_callback):
-        if self.is_aborted: return
-        
+    async def peer_worker(self, entry, progress_callback):
+        ip, port = entry.addr
         print(f"[*] Connecting to {ip}:{port}...", flush=True)
-        peer = AsyncBitTorrentPeer(ip, port, self.info_hash, self.peer_id)
+        peer = AsyncBitTorrentPeer(ip, port, self.info_hash, self.peer_id, fast=self.fast_extension,
+                                   extensions=self.pex, dht=self.dht is not None, num_pieces=self.num_pieces,
+                                   block_buffer=lambda i, b, n: self.scheduler.block_buffer(peer, i, b, n))
         
-        if not await peer.connect(): return
+        if not await peer.connect():
+            self.pool.on_failed(entry)
+            return
         if not await peer.handshake(): 
+            self.pool.on_failed(entry)
             await peer.close()
             return
         
         print(f"[+] Handshake Successful: {ip}:{port}", flush=True)
-        await peer.send_interested()
+        peer.listen_addr = entry.addr
+        self.pool.on_connected(entry)
+        self.wakeup.set()   # a connecting slot is free again
+        await self.run_session(peer, entry, progress_callback)
 
+    async def inbound_worker(self, peer, entry, progress_callback):
+        if not await peer.handshake(inbound=True):
+            self.pool.on_disconnected(entry)
+            await peer.close()
+            return
+        print(f"[+] Incoming peer: {peer.ip}:{peer.port}", flush=True)
+        await self.run_session(peer, entry, progress_callback)
+
+    async def run_session(self, peer, entry, progress_callback):
+        # One established connection, outbound or inbound, until either side is done
+        if peer.extended:
+            peer.send_extended(HANDSHAKE, handshake_payload(self.listen_port if self.server else None))
+        if peer.dht and self.dht.port: peer.send_port(self.dht.port)
+        if peer.fast and self.is_complete(): peer.send_have_all()
+        elif peer.fast and not self.verified_indices: peer.send_have_none()
+        elif self.verified_indices:
+            peer.send_bitfield(pieces_to_bitfield(self.verified_indices, self.num_pieces))
+        if peer.fast:
+            # A few pieces the peer may fetch before we unchoke it, to get it started
+            peer.allowed_fast_out = allowed_fast_set(peer.ip, self.info_hash, self.num_pieces)
+            for idx in peer.allowed_fast_out & self.verified_indices: peer.send_allowed_fast(idx)
+        if not self.is_complete(): peer.send_interested()
+
+        # Requests stay outstanding across piece boundaries; which blocks to
+        # ask for is decided by the shared scheduler
+        pipe = RequestPipeline(max_depth=self.max_request_depth, adaptive=self.adaptive_requests,
+                               initial_depth=4 if self.adaptive_requests else self.max_request_depth)
+        self.pipelines[peer] = pipe
+        uploader = asyncio.create_task(self.upload_worker(peer))
         try:
-            while len(self.verified_indices) < self.num_pieces and not self.is_aborted:
+            while not self.is_aborted and (self.seeding or not self.is_complete()):
+                if self.is_complete() and peer.bitfield and self.picker.is_seed_bitfield(peer.bitfield):
+                    break   # both sides have everything
                 msg_id, payload = await peer.receive_message()
-                if msg_id is not None: peer.handle_message(msg_id, payload)
-                
-                if peer.peer_choking: 
-                    await asyncio.sleep(0.5)
-                    continue
-                
-                piece_idx = None
-                rem = self.num_pieces - len(self.verified_indices)
+                if msg_id is None and peer.closed: break
+                res = peer.handle_message(msg_id, payload)
                 
-                for i in range(self.num_pieces):
-                    if i not in self.verified_indices and peer.has_piece(i):
-                        if rem <= 2: piece_idx = i; break
-                        async with self.piece_locks[i]:
-                            if i not in self.pieces_in_progress:
-                                self.pieces_in_progress.add(i); piece_idx = i; break
+                if res and res[0] == 'bitfield':
+                    peer.is_seed = self.picker.add_bitfield(peer.bitfield)
+                elif res and res[0] == 'have_all':
+                    peer.bitfield = bytearray(self.picker.full)
+                    peer.is_seed = self.picker.add_bitfield(peer.bitfield)
+                elif res and res[0] == 'have':
+                    self.picker.add_have(res[1])
+                elif res and res[0] == 'piece':
+                    _, idx, begin, length, block = res
+                    solicited = pipe.received(idx, begin, length)
+                    peer.stats.on_block(length, rtt=pipe.last_rtt if solicited else None)
+                    if self.time_to_first_block is None:
+                        self.time_to_first_block = time.monotonic() - self.started_at
+                    st, others = self.scheduler.on_block(peer, idx, begin, length, block)
+                    for other in others:
+                        # Endgame: this block is in, withdraw the duplicate requests
+                        if self.pipelines[other].cancel(idx, begin):
+                            other.send_cancel(idx, begin, length)
+                            self.cancels_sent += 1
+                    if st: await self.submit_piece(idx, st.data, progress_callback)
+                elif res and res[0] == 'request':
+                    self.on_request(peer, *res[1:])
+                elif res and res[0] == 'cancel':
+                    try: peer.upload_queue.remove(res[1:])
+                    except ValueError: pass
+                    else:
+                        if peer.fast: peer.send_reject(*res[1:])   # BEP 6: every request gets an answer
+                elif res and res[0] == 'reject':
+                    # Hand the block to another peer right away instead of waiting for a snub
+                    if pipe.cancel(res[1], res[2]): self.release_block(peer, res[1], res[2])
+                elif res and res[0] == 'allowed_fast':
+                    if res[1] < self.num_pieces: peer.allowed_fast.add(res[1])
+                elif res and res[0] == 'suggest':
+                    if res[1] < self.num_pieces: peer.suggested.append(res[1])
+                elif res and res[0] == 'extended':
+                    self.on_extended(peer, res[1], res[2])
+                elif res and res[0] == 'port':
+                    if self.dht and res[1]: self.dht.add_node((peer.ip, res[1]))
+                elif res and res[0] == 'interested':
+                    # Don't make a new peer wait for the next rechoke if a slot is free
+                    if peer.am_choking and self.choker.has_free_slot(self.pipelines): peer.send_unchoke()
+                elif res and res[0] == 'not_interested':
+                    if not peer.am_choking: peer.send_choke()
+                elif msg_id == 0 and not peer.fast:
+                    # Choked: the peer drops our queued requests, hand them to other peers
+                    # (with the fast extension it rejects each one it won't serve instead)
+                    for idx, begin in pipe.drop_all():
+                        self.release_block(peer, idx, begin)
                 
-                if piece_idx is None:
-                    await asyncio.sleep(1)
-                    continue
+                # While choked only allowed-fast pieces may be requested
+                allowed = None
+                if peer.peer_choking:
+                    if not peer.allowed_fast: continue
+                    allowed = peer.allowed_fast
                 
-                # Terminal Log for Piece Request
-                print(f"[-] Requesting Piece {piece_idx} from {ip}:{port}...", flush=True)
-                
-                d = await download_piece_from_peer(peer, piece_idx, self.get_piece_length(piece_idx))
-                if d:
-                    full = b''.join(d[o] for o in sorted(d.keys()))
-                    if self.verify_piece(piece_idx, full) and piece_idx not in self.verified_indices:
-                        self.downloaded_pieces[piece_idx] = full
-                        self.verified_indices.add(piece_idx)
-                        self.save_piece_to_disk(piece_idx, full)
-                        self.total_downloaded_session += len(full)
-                        
-                        # Terminal Log for Verification
-                        progress = (len(self.verified_indices)/self.num_pieces)*100
-                        print(f"✅ Piece {piece_idx} Verified! | Total Progress: {progress:.2f}%", flush=True)
-                        
-                        if progress_callback: 
-                            kb = self.current_speed / 1024
-                            s_str = f"{kb/1024:.2f} MB/s" if kb > 1024 else f"{kb:.2f} KB/s"
-                            progress_callback(len(self.verified_indices)/self.num_pieces, s_str)
-                
-                if rem > 2:
-                    async with self.piece_locks[piece_idx]: self.pieces_in_progress.discard(piece_idx)
+                if not len(pipe): peer.stats.waiting()
+                # A snubbing peer gets one request at a time until it delivers
+                while pipe.has_room() and not (peer.stats.snubbed and len(pipe)):
+                    blk = self.scheduler.next_block(peer, allowed)
+                    if blk is None: break
+                    idx, begin, length = blk
+                    peer.send_request(idx, begin, length)
+                    pipe.sent(idx, begin)
+                await peer.drain()
         finally: 
+            uploader.cancel()
+            reason = peer.drop_reason or peer.protocol.error
+            if reason: print(f"[-] {peer.ip}:{peer.port} disconnected: {reason}", flush=True)
+            self.pool.on_disconnected(entry)
+            self.pipelines.pop(peer, None)
+            self.scheduler.release_peer(peer)
+            if peer.bitfield is not None: self.picker.remove_bitfield(peer.bitfield, peer.is_seed)
             await peer.close()
 
+    # --- uploading ---
+
+    def on_request(self, peer, idx, begin, length):
+        # Requests from choked peers (except for allowed-fast pieces), for pieces
+        # we don't have or past the end of a piece are refused, as are blocks
+        # over 128 KiB; only fast-extension peers are told so
+        if ((peer.am_choking and idx not in peer.allowed_fast_out) or idx not in self.verified_indices
+                or length > 131072 or length <= 0 or begin + length > self.get_piece_length(idx)
+                or len(peer.upload_queue) >= self.max_upload_queue):
+            if peer.fast: peer.send_reject(idx, begin, length)
+            return
+        peer.upload_queue.append((idx, begin, length))
+        peer.upload_ready.set()
+
+    async def upload_worker(self, peer):
+        # Serves the peer's requests in order; reads go through the read cache
+        while not peer.closed:
+            if not peer.upload_queue:
+                peer.upload_ready.clear()
+                await peer.upload_ready.wait()
+                continue
+            idx, begin, length = peer.upload_queue.popleft()
+            try:
+                data = await self.read_piece_cached(idx)
+            except OSError as e:
+                peer.drop(f"could not read piece {idx}: {e}")
+                return
+            if peer.closed: return
+            if peer.am_choking and idx not in peer.allowed_fast_out:
+                # Choked while we were reading
+                if peer.fast: peer.send_reject(idx, begin, length)
+                continue
+            peer.send_block(idx, begin, memoryview(data)[begin:begin + length])
+            self.total_uploaded += length
+            await peer.drain()
+
+    async def read_piece_cached(self, idx):
+        data = self.read_cache.get(idx)
+        if data is not None: return data
+        # Concurrent requests for the same piece share one disk read
+        fut = self.reads_pending.get(idx)
+        if fut is None:
+            fut = self.reads_pending[idx] = asyncio.ensure_future(self.run_io(self.storage.read_piece, idx))
+            fut.add_done_callback(lambda f: self.reads_pending.pop(idx, None))
+        data = await fut
+        self.read_cache.put(idx, data)
+        return data
+
+    def rechoke(self):
+        unchoke = self.choker.rechoke(self.pipelines, seeding=self.is_complete())
+        for peer in self.pipelines:
+            if peer.closed: continue
+            if peer in unchoke and peer.am_choking: peer.send_unchoke()
+            elif peer not in unchoke and not peer.am_choking: peer.send_choke()
+
+    def peer_rates(self):
+        """Per-peer transfer stats of the current connections."""
+        return [{'peer': f"{p.ip}:{p.port}", 'download_rate': p.stats.rate, 'upload_rate': p.stats.upload_rate,
+                 'downloaded': p.stats.downloaded, 'uploaded': p.stats.uploaded, 'rtt': p.stats.rtt,
+                 'choked': p.am_choking, 'snubbed': p.stats.snubbed} for p in self.pipelines]
+
+    # --- listening ---
+
+    async def listen(self, port, host='0.0.0.0'):
+        try:
+            self.server = await asyncio.get_running_loop().create_server(self._inbound_protocol, host, port)
+        except OSError as e:
+            # e.g. port already taken by another client: download without uploading to inbound peers
+            print(f"[!] Cannot listen on port {port}: {e}", flush=True)
+            return
+        self.listen_port = self.server.sockets[0].getsockname()[1]
+        print(f"[*] Listening for peers on port {self.listen_port}", flush=True)
+
+    def _inbound_protocol(self):
+        peer = AsyncBitTorrentPeer(None, None, self.info_hash, self.peer_id, fast=self.fast_extension,
+                                   extensions=self.pex, dht=self.dht is not None, num_pieces=self.num_pieces,
+                                   block_buffer=lambda i, b, n: self.scheduler.block_buffer(peer, i, b, n))
+        return PeerProtocol(peer.block_buffer, peer.idle_timeout, on_connect=lambda proto: self._accept(peer, proto))
+
+    def _accept(self, peer, proto):
+        peer.accept(proto)
+        entry = None
+        if not self.is_aborted and self.scheduler and self.pool.connected < self.max_peers:
+            entry = self.pool.accept((peer.ip, peer.port))
+        if entry is None:
+            proto.transport.close()
+            return
+        t = asyncio.create_task(self.inbound_worker(peer, entry, self.progress_callback))
+        self.worker_tasks.add(t)
+        t.add_done_callback(self._worker_done)
+
+    async def submit_piece(self, idx, data, progress_callback):
+        # Hand off to the I/O executor and keep downloading;
+        # only wait here when too many pieces are already queued
+        await self.io_slots.acquire()
+        t = asyncio.create_task(self.commit_piece(idx, data, progress_callback))
+        self.io_tasks.add(t)
+        t.add_done_callback(self.io_tasks.discard)
+
+    async def drain_io(self):
+        # Let pieces already handed to the executor reach the disk
+        await asyncio.gather(*self.io_tasks, return_exceptions=True)
+
     def get_piece_length(self, idx):
-        return self.total_length - (idx * self.piece_length) if idx == self.num_pieces - 1 else self.piece_length
+        return self.metainfo.piece_size(idx)
+
+    async def finalize(self, output_file):
+        if self.finalized: return
+        print("\n🎉 ALL PIECES DOWNLOADED! Finalizing file...", flush=True)
+        # Flushes the write cache, fsyncs and renames: too slow for the loop, peers are still served
+        await self.run_io(self.storage.finalize)
+        self.finalized = True
+        if os.path.exists(self.resume_file): os.remove(self.resume_file)
+        print(f"✅ File Saved: {output_file}\n", flush=True)
 
-    async def download(self, output_file, progress_callback=None):
+    async def download(self, output_file, progress_callback=None, seed=False):
+        # seed=True keeps serving peers after the download is complete, until aborted
+        self.seeding = seed
+        self.progress_callback = progress_callback
+        self.started_at = time.monotonic()
+        self.storage = WriteCache(PieceStorage(self.metainfo, output_file))
+        await self.prepare_resume(output_file, progress_callback)
+        self.storage.open()
+        self.picker = PiecePicker(self.num_pieces, have=self.verified_indices)
+        self.scheduler = BlockScheduler(self.metainfo, self.verified_indices, self.picker,
+                                        allow_endgame=self.allow_endgame)
+        
+        if self.listen_port is not None: await self.listen(self.listen_port)
+        if self.trackers is not None:
+            self.discovering.add('trackers')
+            self.announce_task = asyncio.create_task(self.announce_loop())
+        if self.dht:
+            self.discovering.add('dht')
+            self.dht_task = asyncio.create_task(self.dht_loop())
+        
         stask = asyncio.create_task(self.calculate_speed())
-        tasks = [asyncio.create_task(self.peer_worker(ip, port, progress_callback)) for ip, port in self.peers[:self.max_peers]]
+        ltask = asyncio.create_task(self.measure_loop_lag())
         
         try:
-            while len(self.verified_indices) < self.num_pieces and not self.is_aborted: 
-                await asyncio.sleep(1)
+            while (self.seeding or not self.is_complete()) and not self.is_aborted: 
+                if self.is_complete() and not self.finalized:
+                    await self.drain_io()
+                    try:
+                        await self.finalize(output_file)
+                    except OSError as e:
+                        self.on_io_error(e, "finalizing the files")
+                        break
+                    print(f"[*] Seeding...", flush=True)
+                self.fill_slots(progress_callback)
+                self.wakeup.clear()
+                # Woken early by slot/pool changes and completion; the timeout
+                # covers backoff expiry and an abort from another thread
+                try: await asyncio.wait_for(self.wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError: pass
         finally:
             self.is_aborted = True
-            stask.cancel()
-            for t in tasks: t.cancel()
-            await asyncio.gather(*tasks, return_exceptions=True)
+            print(f"[*] Peers: {self.pool.summary()}", flush=True)
+            if self.server: self.server.close()
+            if self.trackers is not None:
+                await self.announce_stopped()
+                self.trackers.close()
+            if self.dht_task:
+                self.dht_task.cancel()
+                await asyncio.gather(self.dht_task, return_exceptions=True)
+                self.dht.close()
+            stask.cancel(); ltask.cancel()
+            for t in self.worker_tasks: t.cancel()
+            await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+            await self.drain_io()
+            if self.time_to_first_block is not None:
+                print(f"[*] First block after {self.time_to_first_block * 1000:.0f} ms", flush=True)
+            print(f"[*] Event loop lag: avg {self.loop_lag*1000:.1f} ms, max {self.loop_lag_max*1000:.1f} ms", flush=True)
+            if self.scheduler.endgame:
+                print(f"[*] Endgame: {self.scheduler.duplicate_requests} duplicate requests, {self.cancels_sent} cancels, "
+                      f"{self.scheduler.wasted_bytes / 1024:.0f} KB wasted", flush=True)
+            if self.total_uploaded:
+                print(f"[*] Uploaded {self.total_uploaded / 1e6:.1f} MB, read cache: {self.read_cache.summary()}", flush=True)
             
-        if len(self.verified_indices) == self.num_pieces:
-            print("\n🎉 ALL PIECES DOWNLOADED! Finalizing file...", flush=True)
-            with open(output_file, 'wb') as f:
-                for i in range(self.num_pieces): f.write(self.downloaded_pieces[i])
-            if os.path.exists(self.state_file): os.remove(self.state_file)
-            print(f"✅ File Saved: {output_file}\n", flush=True)
-            return True
-        return False
+        # A disk error here (or earlier) ends the download with False, never an exception
+        try:
+            if self.is_complete() and not self.io_error:
+                await self.finalize(output_file)
+            else:
+                await self.checkpoint_resume()   # skipped after a disk error
+        except OSError as e:
+            self.on_io_error(e, "saving the download")
+        finally:
+            try:
+                await self.run_io(self.storage.close)   # reads while seeding reopen the finished files
+            except OSError as e:
+                if not self.io_error: self.on_io_error(e, "closing the files")
+            if self.io_executor: self.io_executor.shutdown(wait=True)
+        if self.io_error and os.path.exists(self.resume_file):
+            # Which writes made it is unknown: the next run rechecks the files
+            os.remove(self.resume_file)
+        print(f"[*] Write cache: {self.storage.summary()}", flush=True)
+        return self.finalized and not self.io_error
 
-async def download_from_peers_async(torrent_file, peers, output_file, max_peers=5, progress_callback=None):
+async def download_from_peers_async(torrent, peers, output_file, max_peers=5, progress_callback=None, listen_port=None,
+                                    trackers=None, dht=None):
     print(f"\n[*] Initializing Engine for: {output_file}")
     print(f"[*] Target Peers: {len(peers)}")
     
-    downloader = TorrentDownloader(torrent_file, peers, max_peers)
+    downloader = TorrentDownloader(torrent, peers, max_peers, listen_port=listen_port, trackers=trackers, dht=dht)
     return await downloader.download(output_file, progress_callback)
\ No newline at end of file
@@ -0,0 +1,488 @@
+# In this file we find peers without a tracker: a Mainline DHT node (BEP 5) on
+# one UDP socket, with a k-bucket routing table that is kept across restarts
+# and iterative lookups that keep ALPHA queries in flight at a time.
+
+import asyncio
+import bisect
+import hashlib
+import heapq
+import os
+import socket
+import struct
+import time
+from collections import OrderedDict
+from parser import bdecode, bencode_into, BencodeWriter
+from pex import parse_compact
+
+K = 8                          # contacts per bucket, nodes per reply
+ALPHA = 3                      # queries in flight per lookup
+ID_BITS = 160
+QUERY_TIMEOUT = 2.0
+MAX_FAILURES = 2               # unanswered queries in a row before a contact is bad
+QUESTIONABLE_AFTER = 15 * 60   # a contact not heard from for this long is pinged
+REFRESH_AFTER = 15 * 60        # a bucket without activity for this long is refreshed
+TOKEN_ROTATE = 5 * 60          # a token is accepted for one to two rotations
+PEER_TTL = 30 * 60             # how long an announce_peer is remembered
+MAX_STORED_PEERS = 200         # per info hash
+MAX_STORED_TORRENTS = 1000
+MAX_VALUES = 50                # peers per get_peers reply, to stay within one datagram
+DHT_BIT = 0x01                 # reserved[7]: we are a DHT node and send PORT messages
+PORT = 9                       # message id of the PORT message
+STATE_FILE = 'dht.state'       # where main / ui keep the routing table between runs
+BOOTSTRAP_NODES = (('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881),
+                   ('router.utorrent.com', 6881))
+
+def compact_nodes(nodes):
+    """Compact node info: 20-byte id + IPv4 + port per (node id, (ip, port)); IPv6 nodes are skipped."""
+    out = bytearray()
+    for node_id, (ip, port) in nodes:
+        try:
+            out += node_id + socket.inet_aton(ip) + struct.pack('>H', port)
+        except OSError:
+            continue
+    return bytes(out)
+
+def parse_nodes(data):
+    nodes = []
+    for i in range(0, len(data) - 25, 26):
+        port = int.from_bytes(data[i + 24:i + 26], 'big')
+        if port:
+            nodes.append((bytes(data[i:i + 20]), (socket.inet_ntoa(data[i + 20:i + 24]), port)))
+    return nodes
+
+def compact_peer(addr):
+    return socket.inet_aton(addr[0]) + struct.pack('>H', addr[1])
+
+class Contact:
+    __slots__ = ('id', 'addr', 'last_seen', 'failures')
+
+    def __init__(self, node_id, addr, last_seen=0.0):
+        self.id, self.addr = node_id, addr
+        self.last_seen = last_seen
+        self.failures = 0
+
+class RoutingTable:
+    """
+    Contacts bucketed by their XOR distance to our id: bucket i holds up to
+    k nodes at a distance in [2**i, 2**(i+1)), least recently seen first.
+    A full bucket takes a new node only in place of a bad one, so nodes that
+    have been up for long (the likeliest to stay up) are kept.
+    """
+
+    def __init__(self, own_id, k=K):
+        self.own_id, self.k = own_id, k
+        self.own = int.from_bytes(own_id, 'big')
+        self.buckets = [OrderedDict() for _ in range(ID_BITS)]   # node id -> Contact
+        self.touched = [0.0] * ID_BITS    # when each bucket last gained or heard from a node
+
+    def __len__(self):
+        return sum(map(len, self.buckets))
+
+    def bucket_index(self, node_id):
+        return max((int.from_bytes(node_id, 'big') ^ self.own).bit_length() - 1, 0)
+
+    def contacts(self):
+        return [c for bucket in self.buckets for c in bucket.values()]
+
+    def get(self, node_id):
+        return self.buckets[self.bucket_index(node_id)].get(node_id)
+
+    def seen(self, node_id, addr, now):
+        """A node answered or queried us: refresh or add it; False if there is no room for it."""
+        if len(node_id) != 20 or node_id == self.own_id:
+            return False
+        i = self.bucket_index(node_id)
+        bucket = self.buckets[i]
+        contact = bucket.get(node_id)
+        if contact is not None:
+            if contact.addr != addr:
+                return False   # same id from elsewhere: keep the node we know
+            contact.last_seen, contact.failures = now, 0
+            bucket.move_to_end(node_id)
+        else:
+            if len(bucket) >= self.k:
+                bad = next((c for c in bucket.values() if c.failures >= MAX_FAILURES), None)
+                if bad is None:
+                    return False
+                del bucket[bad.id]
+            bucket[node_id] = Contact(node_id, addr, now)
+        self.touched[i] = now
+        return True
+
+    def failed(self, node_id):
+        contact = self.get(node_id)
+        if contact: contact.failures += 1
+
+    def closest(self, target, n=None):
+        """The n (default k) good contacts closest to target, closest first."""
+        t = int.from_bytes(target, 'big')
+        good = (c for bucket in self.buckets for c in bucket.values() if c.failures < MAX_FAILURES)
+        return heapq.nsmallest(n or self.k, good, key=lambda c: int.from_bytes(c.id, 'big') ^ t)
+
+    def stale_buckets(self, now):
+        return [i for i, bucket in enumerate(self.buckets) if bucket and now - self.touched[i] >= REFRESH_AFTER]
+
+    def random_id(self, i):
+        """A random id that falls into bucket i, the target of its refresh lookup."""
+        offset = int.from_bytes(os.urandom(20), 'big') % (1 << i)
+        return (self.own ^ ((1 << i) | offset)).to_bytes(20, 'big')
+
+    @classmethod
+    def load(cls, path, k=K):
+        """A saved table, every contact questionable until it answers; None if missing or corrupt."""
+        try:
+            with open(path, 'rb') as f:
+                d = bdecode(f.read())
+            if len(d[b'id']) != 20:
+                return None
+            table = cls(bytes(d[b'id']), k)
+            for node_id, addr in parse_nodes(d[b'nodes']):
+                table.seen(node_id, addr, 0.0)
+            return table
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, path):
+        """Our id and the good contacts, atomically replacing the file."""
+        good = [(c.id, c.addr) for c in self.contacts() if c.failures < MAX_FAILURES]
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f, BencodeWriter(f) as w:
+            w.write({b'id': self.own_id, b'nodes': compact_nodes(good)})
+        os.replace(tmp, path)
+
+class Lookup:
+    """
+    One iterative lookup of target: the closest nodes known are asked, alpha
+    at a time, for nodes closer still, until the k closest nodes that
+    answered have all been asked. With get_peers=True they are asked
+    get_peers instead of find_node, and iterating over the lookup yields the
+    new peers of each reply as it arrives. Afterwards closest() has the k
+    closest nodes that answered, with the tokens to announce to them.
+    """
+
+    def __init__(self, node, target, get_peers=False, seeds=()):
+        self.node, self.target, self.get_peers = node, target, get_peers
+        self.t = int.from_bytes(target, 'big')
+        self.candidates = []     # heap of (distance, node id, addr), not asked yet
+        self.known = set()       # node ids ever added as candidates
+        self.responded = []      # (distance, node id, addr, token), sorted
+        self.peers = set()
+        self.queries = self.timeouts = 0
+        self.elapsed = self.first_peers_after = None
+        for c in node.table.closest(target):
+            self.add(c.id, c.addr)
+        for node_id, addr in seeds:
+            self.add(node_id, addr)
+
+    def add(self, node_id, addr):
+        if node_id in self.known or node_id == self.node.id:
+            return
+        self.known.add(node_id)
+        heapq.heappush(self.candidates, (int.from_bytes(node_id, 'big') ^ self.t, node_id, addr))
+
+    def closest(self):
+        return self.responded[:self.node.table.k]
+
+    def _worth_asking(self, distance):
+        k = self.node.table.k
+        return len(self.responded) < k or distance < self.responded[k - 1][0]
+
+    def __aiter__(self):
+        return self._run()
+
+    async def _run(self):
+        node = self.node
+        method, key = ('get_peers', b'info_hash') if self.get_peers else ('find_node', b'target')
+        started = time.monotonic()
+        inflight = {}   # query task -> (distance, node id, addr)
+        try:
+            while True:
+                # A query to a node farther than the k closest that answered can't
+                # change the result: stop waiting for it, its slot goes to a closer one
+                for task, (distance, _, _) in list(inflight.items()):
+                    if not self._worth_asking(distance):
+                        task.cancel()
+                        del inflight[task]
+                while (len(inflight) < node.alpha and self.candidates
+                       and self._worth_asking(self.candidates[0][0])):
+                    distance, node_id, addr = heapq.heappop(self.candidates)
+                    task = asyncio.ensure_future(node.query(addr, method, {key: self.target}, node_id))
+                    inflight[task] = (distance, node_id, addr)
+                    self.queries += 1
+                if not inflight:
+                    break
+                done, _ = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    distance, node_id, addr = inflight.pop(task)
+                    r = task.result()
+                    if r is None:
+                        self.timeouts += 1
+                        continue
+                    bisect.insort(self.responded, (distance, node_id, addr, r.get(b'token')))
+                    if isinstance(r.get(b'nodes'), bytes):
+                        for found_id, found_addr in parse_nodes(r[b'nodes']):
+                            self.add(found_id, found_addr)
+                    values = r.get(b'values')
+                    if not self.get_peers or not isinstance(values, list):
+                        continue
+                    new = []
+                    for value in values:
+                        for peer in parse_compact(value) if isinstance(value, bytes) else ():
+                            if peer not in self.peers:
+                                self.peers.add(peer)
+                                new.append(peer)
+                    if new:
+                        if self.first_peers_after is None:
+                            self.first_peers_after = time.monotonic() - started
+                        yield new
+        finally:
+            for task in inflight:
+                task.cancel()
+            self.elapsed = time.monotonic() - started
+
+    async def wait(self):
+        """Run the lookup to the end without looking at the peers on the way."""
+        async for _ in self:
+            pass
+        return self
+
+class _Protocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def datagram_received(self, data, addr):
+        self.node.on_datagram(data, addr[:2])
+
+    def error_received(self, exc):
+        pass   # e.g. ICMP port unreachable: the query it belongs to times out
+
+class DhtNode:
+    """
+    A DHT node: answers ping, find_node, get_peers and announce_peer from
+    other nodes and runs lookups of its own. With a state_file the node id
+    and routing table are loaded from it and saved to it on close, so the
+    next start bootstraps through the nodes of the last session instead of
+    the bootstrap routers.
+
+    Counters for measuring: queries_sent, responses, timeouts, queries_received.
+    """
+
+    def __init__(self, node_id=None, state_file=None, bootstrap_nodes=BOOTSTRAP_NODES, k=K, alpha=ALPHA,
+                 query_timeout=QUERY_TIMEOUT):
+        self.state_file = state_file
+        table = RoutingTable.load(state_file, k) if state_file and node_id is None else None
+        self.table = table or RoutingTable(node_id or os.urandom(20), k)
+        self.id = self.table.own_id
+        self.bootstrap_nodes = bootstrap_nodes
+        self.alpha, self.query_timeout = alpha, query_timeout
+        self.transport = None
+        self.port = None
+        self.waiters = {}          # transaction id -> (future of the reply, addr it was sent to)
+        self.tid = 0
+        self.secrets = [os.urandom(8), os.urandom(8)]   # current and previous token secret
+        self.rotated_at = time.monotonic()
+        self.stored = {}           # info hash -> OrderedDict of (ip, port) -> when announced
+        self.maintain_task = None
+        self.pings = set()
+        self.queries_sent = self.responses = self.timeouts = self.queries_received = 0
+
+    async def start(self, port=0, host='0.0.0.0'):
+        if self.transport is None:
+            loop = asyncio.get_running_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(lambda: _Protocol(self), local_addr=(host, port))
+            self.port = self.transport.get_extra_info('sockname')[1]
+            self.maintain_task = asyncio.ensure_future(self._maintain())
+        return self
+
+    def close(self):
+        if self.transport is None:
+            return
+        self.transport.close()
+        self.transport = None
+        self.maintain_task.cancel()
+        for task in self.pings:
+            task.cancel()
+        for fut, _ in self.waiters.values():
+            if not fut.done(): fut.set_result(None)
+        if self.state_file and len(self.table):
+            try:
+                self.table.save(self.state_file)
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    # --- KRPC ---
+
+    async def query(self, addr, method, args, node_id=None):
+        """One KRPC query; the reply's 'r' dict, or None if it timed out, failed or was malformed."""
+        if self.transport is None:
+            return None
+        self.tid = (self.tid + 1) & 0xFFFF
+        tid = self.tid.to_bytes(2, 'big')
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[tid] = (fut, addr)
+        msg = {b't': tid, b'y': b'q', b'q': method.encode(), b'a': {b'id': self.id, **args}}
+        try:
+            self.transport.sendto(bencode_into(msg), addr)
+            self.queries_sent += 1
+            reply = await asyncio.wait_for(fut, self.query_timeout)
+        except (asyncio.TimeoutError, OSError):
+            reply = None
+        finally:
+            self.waiters.pop(tid, None)
+        r = reply.get(b'r') if isinstance(reply, dict) and reply.get(b'y') == b'r' else None
+        rid = r.get(b'id') if isinstance(r, dict) else None
+        if not isinstance(rid, bytes) or len(rid) != 20:
+            if reply is None: self.timeouts += 1
+            if node_id: self.table.failed(node_id)
+            return None
+        self.responses += 1
+        self.table.seen(rid, addr, time.monotonic())
+        return r
+
+    def on_datagram(self, data, addr):
+        try:
+            msg = bdecode(data)
+        except ValueError:
+            return
+        if not isinstance(msg, dict) or not isinstance(msg.get(b't'), bytes):
+            return
+        kind = msg.get(b'y')
+        if kind in (b'r', b'e'):
+            # Only an answer to a pending query, from the node it was sent to
+            waiter = self.waiters.get(msg[b't'])
+            if waiter and not waiter[0].done() and waiter[1] == addr:
+                waiter[0].set_result(msg)
+        elif kind == b'q' and self.transport:
+            self.queries_received += 1
+            kind, body = self.on_query(msg.get(b'q'), msg.get(b'a'), addr)
+            self.transport.sendto(bencode_into({b't': msg[b't'], b'y': kind, kind: body}), addr)
+
+    def on_query(self, method, a, addr):
+        """(b'r', reply) or (b'e', [code, message]) for a query from addr."""
+        if not isinstance(a, dict) or not isinstance(a.get(b'id'), bytes) or len(a[b'id']) != 20:
+            return b'e', [203, b'Protocol Error']
+        if a.get(b'ro') != 1:   # read-only nodes (BEP 43) don't answer queries
+            self.table.seen(a[b'id'], addr, time.monotonic())
+        r = {b'id': self.id}
+        if method == b'ping':
+            return b'r', r
+        if method not in (b'find_node', b'get_peers', b'announce_peer'):
+            return b'e', [204, b'Method Unknown']
+        target = a.get(b'info_hash' if method in (b'get_peers', b'announce_peer') else b'target')
+        if not isinstance(target, bytes) or len(target) != 20:
+            return b'e', [203, b'Protocol Error']
+        if method == b'find_node':
+            r[b'nodes'] = compact_nodes((c.id, c.addr) for c in self.table.closest(target))
+        elif method == b'get_peers':
+            r[b'token'] = self.token(addr[0])
+            r[b'nodes'] = compact_nodes((c.id, c.addr) for c in self.table.closest(target))
+            peers = self.stored.get(target)
+            if peers:
+                r[b'values'] = [compact_peer(p) for p in list(peers)[-MAX_VALUES:]]
+        elif method == b'announce_peer':
+            if not self.token_ok(addr[0], a.get(b'token')):
+                return b'e', [203, b'Bad token']
+            port = addr[1] if a.get(b'implied_port') == 1 else a.get(b'port')
+            if not isinstance(port, int) or not 0 < port < 65536:
+                return b'e', [203, b'Protocol Error']
+            self.store(target, (addr[0], port), time.monotonic())
+        return b'r', r
+
+    # --- tokens and announced peers ---
+
+    def token(self, ip, secret=None):
+        return hashlib.sha1((secret or self.secrets[0]) + ip.encode()).digest()[:8]
+
+    def token_ok(self, ip, token):
+        return isinstance(token, bytes) and any(token == self.token(ip, s) for s in self.secrets)
+
+    def store(self, info_hash, addr, now):
+        peers = self.stored.get(info_hash)
+        if peers is None:
+            if len(self.stored) >= MAX_STORED_TORRENTS: return
+            peers = self.stored[info_hash] = OrderedDict()
+        peers.pop(addr, None)
+        peers[addr] = now
+        if len(peers) > MAX_STORED_PEERS:
+            peers.popitem(last=False)
+
+    # --- lookups ---
+
+    def lookup(self, target, get_peers=False, seeds=()):
+        """A Lookup of target; iterate over it (get_peers=True: peers as they arrive) or await its wait()."""
+        return Lookup(self, target, get_peers, seeds)
+
+    async def announce(self, lookup, port):
+        """announce_peer to the closest nodes of a finished get_peers lookup; how many accepted it."""
+        replies = await asyncio.gather(*(
+            self.query(addr, 'announce_peer', {b'info_hash': lookup.target, b'port': port, b'token': token}, node_id)
+            for _, node_id, addr, token in lookup.closest() if isinstance(token, bytes)))
+        return sum(r is not None for r in replies)
+
+    def add_node(self, addr):
+        """A node we heard of from elsewhere (e.g. a peer's PORT message): ping it, it joins the table if it answers."""
+        if self.transport is None or any(c.addr == addr for c in self.table.contacts()):
+            return
+        task = asyncio.ensure_future(self.query(addr, 'ping', {}))
+        self.pings.add(task)
+        task.add_done_callback(self.pings.discard)
+
+    async def resolve(self, hosts):
+        loop = asyncio.get_running_loop()
+        addrs = []
+        for host, port in hosts:
+            try:
+                infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            except OSError:
+                continue
+            addrs.extend(info[4][:2] for info in infos[:1])
+        return addrs
+
+    async def bootstrap(self):
+        """
+        Fill the routing table with a lookup of our own id: through the saved
+        contacts if there are any, else (or if none of them answers) through
+        the bootstrap routers. Then the buckets farther out than our closest
+        neighbour are refreshed. Returns the Lookup of our own id.
+        """
+        lookup = None
+        if len(self.table):
+            lookup = await self.lookup(self.id).wait()
+        if not lookup or not lookup.responded:
+            seeds = []
+            addrs = await self.resolve(self.bootstrap_nodes)
+            for r in await asyncio.gather(*(self.query(addr, 'find_node', {b'target': self.id}) for addr in addrs)):
+                if r and isinstance(r.get(b'nodes'), bytes):
+                    seeds.extend(parse_nodes(r[b'nodes']))
+            lookup = await self.lookup(self.id, seeds=seeds).wait()
+        # The lookup of our own id only meets nodes near us: without this the
+        # far buckets stay empty and lookups of far targets can end up in the
+        # wrong part of the id space (the join of the Kademlia paper, 2.3)
+        if lookup.responded:
+            nearest = self.table.bucket_index(lookup.responded[0][1])
+            await asyncio.gather(*(self.lookup(self.table.random_id(i)).wait()
+                                   for i in range(nearest + 1, ID_BITS) if len(self.table.buckets[i]) < self.table.k))
+        return lookup
+
+    async def _maintain(self, interval=60.0):
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            if now - self.rotated_at >= TOKEN_ROTATE:
+                self.secrets = [os.urandom(8), self.secrets[0]]
+                self.rotated_at = now
+            for info_hash, peers in list(self.stored.items()):
+                while peers and now - next(iter(peers.values())) >= PEER_TTL:
+                    peers.popitem(last=False)
+                if not peers: del self.stored[info_hash]
+            # A questionable contact that does not answer turns bad and makes room for a new node
+            await asyncio.gather(*(self.query(c.addr, 'ping', {}, c.id) for c in self.table.contacts()
+                                   if c.failures < MAX_FAILURES and now - c.last_seen >= QUESTIONABLE_AFTER))
+            for i in self.table.stale_buckets(now):
+                await self.lookup(self.table.random_id(i)).wait()
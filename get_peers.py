@@ -2,36 +2,25 @@
 
 import urllib.parse
 import urllib.request
-import hashlib
 import os
 import random
-from parser import bdecode, bencode
+from parser import bdecode
+from metainfo import Metainfo
 
-def get_peers_from_tracker(torrent_file_path, port=6881, numwant=50):
+def get_peers_from_tracker(torrent, port=6881, numwant=50):
     """
     Communicate with the tracker to fetch a list of peers for the torrent.
+    torrent can be a Metainfo or a path to the .torrent file.
     """
-    # Read and decode the torrent file
-    with open(torrent_file_path, 'rb') as f:
-        torrent_data = f.read()
-    decoded = bdecode(torrent_data)
+    metainfo = Metainfo.coerce(torrent)
     
-    if b'announce' not in decoded:
+    if not metainfo.announce:
         raise ValueError("Torrent file missing 'announce' key")
-    announce_url = decoded[b'announce'].decode('utf-8')
+    announce_url = metainfo.announce
+    info_hash = metainfo.info_hash
     
-    info = decoded[b'info']
-    # Re-encode info to compute info_hash
-    info_bencoded = bencode(info)
-    info_hash = hashlib.sha1(info_bencoded).digest()
-    
-    # Calculate total bytes left
-    if b'length' in info:
-        left = info[b'length']
-    elif b'files' in info:
-        left = sum(f[b'length'] for f in info[b'files'])
-    else:
-        raise ValueError("Invalid info dictionary")
+    # Total bytes left
+    left = metainfo.total_length
     
     # Generate a peer_id
     peer_id = b'-PY0001-' + os.urandom(12)
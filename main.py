@@ -1,9 +1,9 @@
 import asyncio
 import tkinter as tk
 from tkinter import filedialog
-from parser import bencode
-from parser import bdecode
-from get_peers import get_peers_from_tracker
+from metainfo import Metainfo
+from tracker import TrackerTiers
+from dht import DhtNode, STATE_FILE
 from connect_to_peer_async import download_from_peers_async
 
 def select_torrent_file():
@@ -21,26 +21,22 @@ async def main():
         return
 
     # 2. Torrent file parse karke metadata nikaalna
-    with open(torrent_path, 'rb') as f:
-        torrent_data = bdecode(f.read())
+    metainfo = Metainfo.load(torrent_path)
     
     # Torrent ke andar jo asli file ka naam hai wo nikaalna
-    original_file_name = torrent_data[b'info'][b'name'].decode()
+    original_file_name = metainfo.name
     print(f"Target File: {original_file_name}")
 
-    # 3. Get peers
-    peers = get_peers_from_tracker(torrent_path)
-    if len(peers) == 0:
-        print("No peers found in tracker. Exiting...")
-        return
-    
-    # 4. Connect with peers and start downloading
+    # 3. Announce to every tracker, look the torrent up in the DHT and download from peers as they come in
     # Ab 'downloaded_file.mkv' ki jagah original_file_name use hoga
     success = await download_from_peers_async(
-        torrent_path,
-        peers,
+        metainfo,
+        [],
         original_file_name,
-        max_peers=50
+        max_peers=50,
+        listen_port=6881,   # the port announced to the trackers
+        trackers=TrackerTiers.from_metainfo(metainfo),
+        dht=DhtNode(state_file=STATE_FILE)   # routing table kept for a fast start next time
     )
     
     if success:
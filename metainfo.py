@@ -0,0 +1,148 @@
+# In this file we parse a .torrent file once into an immutable Metainfo object
+# that every other module (tracker, downloader, UI) shares instead of a path.
+
+import hashlib
+import marshal
+import os
+from parser import bdecode_with_spans
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".meta"
+
+def _text(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+
+class Metainfo:
+    """
+    Everything the client needs from a .torrent, computed once:
+    info_hash, piece geometry, the file layout and a flat piece-hash table
+    (piece i's SHA-1 lives at piece_hashes[20*i:20*i+20]).
+    """
+
+    __slots__ = (
+        'path', 'announce', 'announce_list', 'info', 'info_hash', 'name',
+        'piece_length', 'num_pieces', 'total_length', 'last_piece_length',
+        'piece_hashes', 'files',
+    )
+
+    def __init__(self, info, info_hash, announce=None, announce_list=None, path=None):
+        piece_length = info[b'piece length']
+        piece_hashes = bytes(info[b'pieces'])
+        if piece_length <= 0 or len(piece_hashes) % 20:
+            raise ValueError("Invalid info dictionary")
+        name = _text(info[b'name'])
+
+        # File layout: (path parts, length, offset in the torrent's byte stream)
+        if b'length' in info:
+            files = (((name,), info[b'length'], 0),)
+        elif b'files' in info:
+            files, offset = [], 0
+            for f in info[b'files']:
+                parts = f[b'path.utf-8'] if b'path.utf-8' in f else f[b'path']
+                files.append(((name,) + tuple(_text(p) for p in parts), f[b'length'], offset))
+                offset += f[b'length']
+            files = tuple(files)
+        else:
+            raise ValueError("Invalid info dictionary")
+
+        total_length = sum(length for _, length, _ in files)
+        num_pieces = len(piece_hashes) // 20
+        if num_pieces != (total_length + piece_length - 1) // piece_length:
+            raise ValueError("Piece count does not match total length")
+
+        if not announce_list:
+            announce_list = ((announce,),) if announce else ()
+
+        s = object.__setattr__
+        s(self, 'path', path)
+        s(self, 'announce', announce)
+        s(self, 'announce_list', tuple(tuple(tier) for tier in announce_list))
+        s(self, 'info', info)
+        s(self, 'info_hash', info_hash)
+        s(self, 'name', name)
+        s(self, 'piece_length', piece_length)
+        s(self, 'num_pieces', num_pieces)
+        s(self, 'total_length', total_length)
+        s(self, 'last_piece_length', total_length - piece_length * (num_pieces - 1) if num_pieces else 0)
+        s(self, 'piece_hashes', piece_hashes)
+        s(self, 'files', files)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Metainfo is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Metainfo is immutable")
+
+    def __repr__(self):
+        return f"<Metainfo {self.name!r} {self.info_hash.hex()} {self.num_pieces} pieces>"
+
+    @property
+    def is_multi_file(self):
+        return b'files' in self.info
+
+    def piece_size(self, idx):
+        return self.last_piece_length if idx == self.num_pieces - 1 else self.piece_length
+
+    def piece_hash(self, idx):
+        return self.piece_hashes[idx * 20:idx * 20 + 20]
+
+    @classmethod
+    def from_bytes(cls, data, path=None):
+        decoded, spans = bdecode_with_spans(data)
+        if b'info' not in spans:
+            raise ValueError("Torrent file does not contain 'info' dictionary")
+        start, end = spans[b'info']
+        info_hash = hashlib.sha1(memoryview(data)[start:end]).digest()
+
+        announce = _text(decoded[b'announce']) if b'announce' in decoded else None
+        tiers = [[_text(url) for url in tier] for tier in decoded.get(b'announce-list', []) if tier]
+        return cls(decoded[b'info'], info_hash, announce, tiers, path)
+
+    @classmethod
+    def load(cls, path, use_cache=True):
+        """Parse a .torrent file, reusing <path>.meta if the file has not changed."""
+        st = os.stat(path)
+        key = (CACHE_VERSION, st.st_size, st.st_mtime_ns)
+        cache_path = path + CACHE_SUFFIX
+        if use_cache:
+            meta = cls._read_cache(cache_path, key, path)
+            if meta is not None:
+                return meta
+
+        with open(path, 'rb') as f:
+            meta = cls.from_bytes(f.read(), path)
+        if use_cache:
+            meta._write_cache(cache_path, key)
+        return meta
+
+    @classmethod
+    def coerce(cls, torrent):
+        """Accept either a Metainfo or a path to a .torrent file."""
+        return torrent if isinstance(torrent, cls) else cls.load(torrent)
+
+    # --- On-disk cache ---
+    # marshal only round-trips plain dicts/tuples/bytes/ints, which is all we store,
+    # and loads far faster than bdecoding + hashing the torrent again.
+
+    @classmethod
+    def _read_cache(cls, cache_path, key, path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = marshal.load(f)
+            if cached[0] != key:
+                return None
+            _, info, info_hash, announce, announce_list = cached
+            return cls(info, info_hash, announce, announce_list, path)
+        except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError):
+            return None
+
+    def _write_cache(self, cache_path, key):
+        tmp = cache_path + ".tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                marshal.dump((key, self.info, self.info_hash, self.announce, self.announce_list), f)
+            os.replace(tmp, cache_path)
+        except (OSError, ValueError):
+            # Read-only directory or unmarshallable data: caching is best-effort
+            try: os.remove(tmp)
+            except OSError: pass
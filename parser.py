@@ -1,4 +1,5 @@
 # In this file we write helper functions to parse .torrent data
+import hashlib
 import pprint
 
 def parse_int(data, i):
@@ -46,42 +47,342 @@ def parse_any(data, i):
     else:
         raise ValueError(f"Invalid bencode type at index {i}: {chr(data[i])}")
 
-def bdecode(data):
-    if not isinstance(data, bytes):
+# --- Iterative decoder ---
+# parse_any and friends above recurse once per value and copy every string.
+# The decoder below walks the buffer with an explicit stack, can hand back
+# large strings as memoryview slices, and can leave nested containers
+# undecoded until someone actually touches them.
+
+_D, _L, _I, _E, _COLON = ord('d'), ord('l'), ord('i'), ord('e'), ord(':')
+_DIGITS = frozenset(b'0123456789')
+
+def _as_buffer(data):
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    elif not isinstance(data, (bytes, bytearray)):
         raise ValueError("Input must be a byte string")
+    return data
+
+def _skip(data, i):
+    """Return the index just past the value starting at i, without building it."""
+    depth = 0
+    n = len(data)
+    while True:
+        if i >= n:
+            raise ValueError("Unexpected end of input")
+        c = data[i]
+        if c == _D or c == _L:
+            depth += 1
+            i += 1
+        elif c == _E:
+            if depth == 0:
+                raise ValueError(f"Unexpected end marker at index {i}")
+            depth -= 1
+            i += 1
+        elif c == _I:
+            i = data.index(b'e', i) + 1
+        elif c in _DIGITS:
+            j = data.index(b':', i)
+            i = j + 1 + int(data[i:j])
+            if i > len(data):
+                raise ValueError(f"String at index {j} runs past end of input")
+        else:
+            raise ValueError(f"Invalid bencode type at index {i}: {chr(c)}")
+        if depth == 0:
+            return i
+
+def _decode(data, i, view_threshold=None, lazy=False, mv=None):
+    """
+    Decode one value starting at i. Returns (value, next_index).
+    Strings of at least view_threshold bytes come back as memoryview slices.
+    With lazy=True, containers below the outermost one are returned as
+    LazyDict/LazyList and only parsed on first access.
+    """
+    if mv is None and (view_threshold is not None or lazy):
+        mv = memoryview(data)
+    to_bytes = bytes if not isinstance(data, bytes) else None
+    n = len(data)
+    stack = []   # open containers
+    keys = []    # pending dict key per open container (None for lists / no key yet)
+    while True:
+        if i >= n:
+            raise ValueError("Unexpected end of input")
+        c = data[i]
+        if c == _I:
+            j = data.index(b'e', i)
+            val = int(data[i + 1:j])
+            i = j + 1
+        elif c in _DIGITS:
+            j = data.index(b':', i)
+            length = int(data[i:j])
+            j += 1
+            i = j + length
+            if i > n:
+                raise ValueError(f"String at index {j} runs past end of input")
+            if view_threshold is not None and length >= view_threshold:
+                val = mv[j:i]
+            else:
+                val = data[j:i]
+                if to_bytes:
+                    val = to_bytes(val)
+        elif c == _L or c == _D:
+            if lazy and stack:
+                end = _skip(data, i)
+                cls = LazyList if c == _L else LazyDict
+                val = cls(data, i, end, view_threshold, mv)
+                i = end
+            else:
+                stack.append([] if c == _L else {})
+                keys.append(None)
+                i += 1
+                continue
+        elif c == _E:
+            if not stack:
+                raise ValueError(f"Unexpected end marker at index {i}")
+            if keys[-1] is not None:
+                raise ValueError(f"Dictionary key without value before index {i}")
+            val = stack.pop()
+            keys.pop()
+            i += 1
+        else:
+            raise ValueError(f"Invalid bencode type at index {i}: {chr(c)}")
+
+        if not stack:
+            return val, i
+        top = stack[-1]
+        if top.__class__ is list:
+            top.append(val)
+        elif keys[-1] is None:
+            if not isinstance(val, (bytes, memoryview)):
+                raise ValueError(f"Dictionary key must be a string (before index {i})")
+            keys[-1] = bytes(val)
+        else:
+            top[keys[-1]] = val
+            keys[-1] = None
+
+# Everything the base type does (read, compare, mutate, copy, pickle) must
+# see the decoded body, so every method it defines decodes it first
+_NOT_LOADING = {'__new__', '__init__', '__getattribute__', '__class_getitem__', 'fromkeys'}
+
+def _loads_first(cls):
+    base = cls.__mro__[1]
+    def loading(method):
+        def wrapper(self, *args, **kwargs):
+            self._load()
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        return wrapper
+    for name, method in list(vars(base).items()) + [('__reduce_ex__', base.__reduce_ex__)]:
+        if callable(method) and name not in _NOT_LOADING and name not in vars(cls):
+            setattr(cls, name, loading(method))
+    return cls
+
+@_loads_first
+class LazyDict(dict):
+    """dict that decodes its bencoded body the first time it is accessed."""
+    _raw = None
+
+    def __init__(self, data, start, end, view_threshold=None, mv=None):
+        super().__init__()
+        self._raw = (data, start, end, view_threshold, mv)
+
+    def _load(self):
+        raw = self._raw
+        if raw is not None:
+            self._raw = None
+            data, start, _, view_threshold, mv = raw
+            val, _ = _decode(data, start, view_threshold, True, mv)
+            dict.update(self, val)
+
+    __hash__ = None
+
+@_loads_first
+class LazyList(list):
+    """list that decodes its bencoded body the first time it is accessed."""
+    _raw = None
+
+    def __init__(self, data, start, end, view_threshold=None, mv=None):
+        super().__init__()
+        self._raw = (data, start, end, view_threshold, mv)
+
+    def _load(self):
+        raw = self._raw
+        if raw is not None:
+            self._raw = None
+            data, start, _, view_threshold, mv = raw
+            val, _ = _decode(data, start, view_threshold, True, mv)
+            list.extend(self, val)
+
+    def __radd__(self, other):
+        # [...] + lazy would otherwise concatenate the still empty list
+        self._load()
+        return other + list(self) if isinstance(other, list) else NotImplemented
+
+    __hash__ = None
+
+def bdecode(data, view_threshold=None, lazy=False):
+    """
+    Decode bencoded data. With the defaults the result is plain dicts, lists,
+    ints and bytes. view_threshold=N returns strings of N+ bytes as zero-copy
+    memoryview slices; lazy=True defers decoding of nested containers.
+    """
+    data = _as_buffer(data)
     if not data:
         raise ValueError("Empty input")
-    
-    result, index = parse_any(data, 0)
+
+    result, index = _decode(data, 0, view_threshold, lazy)
     if index < len(data):
         raise ValueError(f"Extra data after parsing at index {index}")
     return result
 
-def bencode(data):
-    if isinstance(data, int):
-        return b'i' + str(data).encode() + b'e'
-    elif isinstance(data, bytes):
-        return str(len(data)).encode() + b':' + data
-    elif isinstance(data, str):
-        # Convert string to bytes (assuming UTF-8)
+def bdecode_with_spans(data, keys=(b'info',)):
+    """
+    Decode a top-level dict and record where the values of the chosen keys sit.
+    Returns (result, spans) where spans[key] = (start, end) offsets into data,
+    so the raw bytes of a value can be read back without re-encoding it.
+    """
+    data = _as_buffer(data)
+    if not data or data[0] != _D:
+        raise ValueError("Input must be a bencoded dictionary")
+
+    spans = {}
+    d = {}
+    i = 1
+    while i < len(data) and data[i] != _E:
+        key, i = parse_str(data, i)
+        key = bytes(key)
+        start = i
+        val, i = _decode(data, i)
+        if key in keys:
+            spans[key] = (start, i)
+        d[key] = val
+    if i >= len(data):
+        raise ValueError("Unexpected end of input")
+    i += 1
+    if i < len(data):
+        raise ValueError(f"Extra data after parsing at index {i}")
+    return d, spans
+
+def info_hash_from_bytes(data):
+    """SHA-1 of the raw 'info' value, hashed straight from the original bytes."""
+    decoded, spans = bdecode_with_spans(data)
+    if b'info' not in spans:
+        raise ValueError("Torrent file does not contain 'info' dictionary")
+    start, end = spans[b'info']
+    return decoded, hashlib.sha1(memoryview(data)[start:end]).digest()
+
+# --- Encoder ---
+# Everything is appended into one growing bytearray, so nested containers
+# never build their own intermediate bytes objects.
+
+def _sorted_items(data):
+    """(key, value) pairs with byte-string keys in sorted order."""
+    keys = list(data)
+    prev = None
+    for k in keys:
+        if type(k) is not bytes or (prev is not None and k <= prev):
+            break
+        prev = k
+    else:
+        # Fast path: dicts built in key order (everything we decode, most of
+        # what we build) need neither a copy of their keys nor a sort.
+        return [(k, data[k]) for k in keys]
+    items = []
+    for k, v in data.items():
+        if type(k) is str:
+            k = k.encode('utf-8')
+        elif type(k) is not bytes:
+            raise ValueError(f"Unsupported type for dictionary key: {type(k)}")
+        items.append((k, v))
+    # BitTorrent requires keys sorted as raw byte strings
+    items.sort(key=lambda kv: kv[0])
+    return items
+
+def _encode_into(data, out):
+    t = type(data)
+    if t is bytes or t is bytearray:
+        out += b'%d:' % len(data)
+        out += data
+    elif t is int or t is bool:
+        out += b'i%de' % data
+    elif t is str:
         data = data.encode('utf-8')
-        return str(len(data)).encode() + b':' + data
-    elif isinstance(data, list):
-        result = [b'l']
-        for item in data:
-            result.append(bencode(item))
-        result.append(b'e')
-        return b''.join(result)
-    elif isinstance(data, dict):
-        result = [b'd']
-        # Sort keys to ensure consistent encoding (BitTorrent requires sorted keys)
-        for key in sorted(data.keys()):
-            if not isinstance(key, bytes):
-                key = key.encode('utf-8')  # Convert string keys to bytes
-            result.append(bencode(key))
-            result.append(bencode(data[key]))
-        result.append(b'e')
-        return b''.join(result)
+        out += b'%d:' % len(data)
+        out += data
+    elif t is dict or isinstance(data, dict):
+        out += b'd'
+        for k, v in _sorted_items(data):
+            out += b'%d:' % len(k)
+            out += k
+            # Leaves are inlined; only containers recurse
+            tv = type(v)
+            if tv is bytes:
+                out += b'%d:' % len(v)
+                out += v
+            elif tv is int:
+                out += b'i%de' % v
+            else:
+                _encode_into(v, out)
+        out += b'e'
+    elif t is list or t is tuple or isinstance(data, list):
+        out += b'l'
+        for v in data:
+            tv = type(v)
+            if tv is bytes:
+                out += b'%d:' % len(v)
+                out += v
+            elif tv is int:
+                out += b'i%de' % v
+            else:
+                _encode_into(v, out)
+        out += b'e'
+    elif t is memoryview:
+        out += b'%d:' % data.nbytes
+        out += data
+    elif isinstance(data, int):
+        out += b'i%de' % data
     else:
         raise ValueError(f"Unsupported type for bencoding: {type(data)}")
-    
+    return out
+
+def bencode_into(data, out=None):
+    """Append the encoding of data to the bytearray out (a new one if None) and return it."""
+    if out is None:
+        out = bytearray()
+    return _encode_into(data, out)
+
+def bencode(data):
+    return bytes(_encode_into(data, bytearray()))
+
+class BencodeWriter:
+    """
+    Streams bencoded values to anything with a write() method: a file,
+    a socket wrapper or an asyncio transport/StreamWriter.
+    Small values are batched in a buffer; once it reaches buffer_size the
+    buffer object itself is handed to sink.write() and a fresh one started,
+    so nothing is copied and nothing the sink still holds gets mutated.
+    """
+
+    def __init__(self, sink, buffer_size=65536):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self._buf = bytearray()
+
+    def write(self, data):
+        _encode_into(data, self._buf)
+        if len(self._buf) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            buf, self._buf = self._buf, bytearray()
+            self.sink.write(buf)
+        flush = getattr(self.sink, 'flush', None)
+        if flush:
+            flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
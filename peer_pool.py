@@ -0,0 +1,128 @@
+# In this file we keep every peer address we have heard of, with its connection
+# state, so freed connection slots can be refilled from the whole swarm.
+
+import heapq
+import time
+from collections import deque
+
+UNTRIED, CONNECTING, CONNECTED, FAILED, BANNED = 'untried', 'connecting', 'connected', 'failed', 'banned'
+
+class PeerEntry:
+    __slots__ = ('addr', 'state', 'failures', 'retry_at', 'inbound')
+
+    def __init__(self, addr, inbound=False):
+        self.addr = addr
+        self.inbound = inbound     # connected to us; addr has their ephemeral port
+        self.state = UNTRIED
+        self.failures = 0
+        self.retry_at = 0.0
+
+class PeerPool:
+    """
+    All known peers and their state:
+    untried -> connecting -> connected -> failed (retry with backoff) / banned.
+
+    Untried peers are handed out first, in the order they were added, then
+    failed peers whose backoff has passed (backoff doubles per failure up to
+    max_backoff; after max_failures in a row a peer is given up on).
+    Peers that connected to us are tracked while connected, but their
+    address is never dialled; a ban also refuses inbound connections from
+    that IP (their source port changes every time).
+    """
+
+    def __init__(self, peers=(), backoff=5.0, max_backoff=600.0, max_failures=8):
+        self.backoff, self.max_backoff, self.max_failures = backoff, max_backoff, max_failures
+        self.entries = {}          # addr -> PeerEntry
+        self.untried = deque()
+        self.retry = []            # heap of (retry_at, addr)
+        self.connecting = self.connected = 0
+        self.banned_ips = set()    # checked for inbound connections
+        self.add_many(peers)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, addr):
+        """Remember a newly discovered peer; False if it is already known."""
+        addr = (addr[0], int(addr[1]))
+        if addr in self.entries:
+            return False
+        self.entries[addr] = PeerEntry(addr)
+        self.untried.append(addr)
+        return True
+
+    def add_many(self, peers):
+        return sum(self.add(addr) for addr in peers)
+
+    def has_candidate(self, now=None):
+        if self.untried:
+            return True
+        return bool(self.retry) and self.retry[0][0] <= (time.monotonic() if now is None else now)
+
+    def next_candidate(self, now=None):
+        """The next peer to try, or None if all are busy, backing off or banned."""
+        while self.untried:
+            entry = self.entries[self.untried.popleft()]
+            if entry.state == UNTRIED:
+                return entry
+        now = time.monotonic() if now is None else now
+        while self.retry and self.retry[0][0] <= now:
+            retry_at, addr = heapq.heappop(self.retry)
+            entry = self.entries[addr]
+            if entry.state == FAILED and entry.retry_at == retry_at:
+                return entry
+        return None
+
+    def _set_state(self, entry, state):
+        if entry.state == CONNECTING: self.connecting -= 1
+        elif entry.state == CONNECTED: self.connected -= 1
+        entry.state = state
+        if state == CONNECTING: self.connecting += 1
+        elif state == CONNECTED: self.connected += 1
+
+    def accept(self, addr):
+        """An inbound connection: its entry, already connected, or None if not welcome."""
+        if addr[0] in self.banned_ips or addr in self.entries:
+            return None
+        entry = self.entries[addr] = PeerEntry(addr, inbound=True)
+        self._set_state(entry, CONNECTED)
+        return entry
+
+    def on_connecting(self, entry):
+        self._set_state(entry, CONNECTING)
+
+    def on_connected(self, entry):
+        entry.failures = 0
+        self._set_state(entry, CONNECTED)
+
+    def on_failed(self, entry, now=None):
+        """Connection attempt or session ended badly: retry later with backoff."""
+        if entry.state == BANNED:
+            return
+        self._set_state(entry, FAILED)
+        entry.failures += 1
+        if entry.failures > self.max_failures:
+            return   # stays FAILED, never scheduled again
+        delay = min(self.max_backoff, self.backoff * 2 ** (entry.failures - 1))
+        entry.retry_at = (time.monotonic() if now is None else now) + delay
+        heapq.heappush(self.retry, (entry.retry_at, entry.addr))
+
+    def on_disconnected(self, entry, now=None):
+        """An established session ended: the peer may come back after the base backoff."""
+        if entry.inbound:
+            if entry.state != BANNED: self._set_state(entry, FAILED)
+            del self.entries[entry.addr]
+            return
+        if entry.state == CONNECTED:
+            entry.failures = 0
+        self.on_failed(entry, now)
+
+    def ban(self, entry):
+        self._set_state(entry, BANNED)
+        self.banned_ips.add(entry.addr[0])
+
+    def summary(self):
+        counts = {}
+        for entry in self.entries.values():
+            counts[entry.state] = counts.get(entry.state, 0) + 1
+        return ", ".join(f"{n} {state}" for state, n in sorted(counts.items()))
@@ -0,0 +1,67 @@
+# In this file we keep rolling per-connection numbers (download/upload rate,
+# request round trip, wasted bytes, hash failures, snubbing) that decide which
+# peers keep their slot and which ones we upload to.
+
+import time
+
+class PeerStats:
+    """
+    Accounting for one peer connection.
+    rate / upload_rate are EWMAs of bytes/s from / to the peer, updated
+    once per tick(); rtt is a smoothed request round trip (seconds, None
+    until the first answer); last_progress is when the peer last delivered
+    a block (or we started waiting on it), so a peer sitting on our
+    requests for too long can be flagged as snubbing.
+    """
+
+    def __init__(self, alpha=0.3, now=None):
+        now = time.monotonic() if now is None else now
+        self.alpha = alpha
+        self.connected_at = self.last_progress = self._tick_at = now
+        self.downloaded = self.uploaded = 0
+        self.rate = self.upload_rate = 0.0
+        self.rtt = None
+        self.wasted = 0            # bytes of pieces that failed their hash check
+        self.hash_failures = 0
+        self.snubbed = False
+        self._tick_bytes = self._tick_up = 0
+
+    def on_block(self, length, now=None, rtt=None):
+        """A block arrived; rtt is how long its request took, None if we never asked for it."""
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        self.downloaded += length
+        self._tick_bytes += length
+        self.last_progress = time.monotonic() if now is None else now
+        self.snubbed = False
+
+    def on_upload(self, length):
+        self.uploaded += length
+        self._tick_up += length
+
+    def waiting(self, now=None):
+        """We just sent requests to an idle peer: the snub clock starts now."""
+        self.last_progress = time.monotonic() if now is None else now
+
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        elapsed = now - self._tick_at
+        if elapsed <= 0: return
+        a = self.alpha
+        self.rate = a * self._tick_bytes / elapsed + (1 - a) * self.rate
+        self.upload_rate = a * self._tick_up / elapsed + (1 - a) * self.upload_rate
+        self._tick_bytes = self._tick_up = 0
+        self._tick_at = now
+
+    def on_hash_failure(self, nbytes):
+        self.wasted += nbytes
+        self.hash_failures += 1
+
+    def score(self):
+        """
+        Higher is better: the download rate, discounted by the request round
+        trip (blocks we wait longer for hold up their pieces longer).
+        Snubbing peers rank below everyone.
+        """
+        if self.snubbed: return -1.0
+        return self.rate / (1.0 + self.rtt) if self.rtt else self.rate
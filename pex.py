@@ -0,0 +1,110 @@
+# In this file we speak the extension protocol (BEP 10) handshake and Peer
+# Exchange (ut_pex, BEP 11): connected peers tell each other which peers they
+# are connected to, so the swarm we can reach keeps growing without a tracker.
+
+import ipaddress
+import socket
+import struct
+from parser import bdecode, bencode
+
+EXTENSION_BIT = 0x10     # reserved[5], BEP 10
+EXTENDED = 20            # message id of every extension message
+HANDSHAKE = 0            # extended id of the extension handshake
+UT_PEX = 1               # extended id we ask peers to use for ut_pex messages to us
+PEX_INTERVAL = 60.0      # BEP 11: at most one PEX message per minute per peer
+MAX_PEX_PEERS = 50       # added / dropped entries per message
+SEED_FLAG = 0x02         # added.f: peer is a seed
+
+def handshake_payload(listen_port=None, client=b'NovaTorrent'):
+    """Our extension handshake: the extensions we understand and our listen port."""
+    d = {b'm': {b'ut_pex': UT_PEX}, b'v': client}
+    if listen_port: d[b'p'] = listen_port
+    return bencode(d)
+
+def parse_handshake(body):
+    """(their extension name -> id, their listen port or None); ValueError if malformed."""
+    d = bdecode(body)
+    m = d.get(b'm') if isinstance(d, dict) else None
+    if not isinstance(m, dict):
+        raise ValueError("extension handshake without 'm'")
+    ids = {name: i for name, i in m.items() if isinstance(i, int) and i > 0}
+    port = d.get(b'p')
+    return ids, (port if isinstance(port, int) and 0 < port < 65536 else None)
+
+def compact_peers(addrs):
+    """(IPv4 compact bytes, IPv6 compact bytes) for (ip, port) pairs."""
+    v4, v6 = bytearray(), bytearray()
+    for ip, port in addrs:
+        try:
+            packed = socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+        except OSError:
+            continue
+        (v6 if len(packed) == 16 else v4).extend(packed + struct.pack('>H', port))
+    return bytes(v4), bytes(v6)
+
+def parse_compact(data, ipv6=False):
+    size = 18 if ipv6 else 6
+    peers = []
+    for i in range(0, len(data) - size + 1, size):
+        port = int.from_bytes(data[i + size - 2:i + size], 'big')
+        if port:
+            peers.append((str(ipaddress.ip_address(bytes(data[i:i + size - 2]))), port))
+    return peers
+
+def pex_payload(added, dropped, seeds=()):
+    """Bencoded ut_pex body; added/dropped are lists of (ip, port), seeds a set of them."""
+    add4, add6 = compact_peers(added)
+    drop4, drop6 = compact_peers(dropped)
+    v4 = [a for a in added if ':' not in a[0]]
+    v6 = [a for a in added if ':' in a[0]]
+    return bencode({
+        b'added': add4, b'added.f': bytes(SEED_FLAG if a in seeds else 0 for a in v4),
+        b'added6': add6, b'added6.f': bytes(SEED_FLAG if a in seeds else 0 for a in v6),
+        b'dropped': drop4, b'dropped6': drop6,
+    })
+
+def parse_pex(body):
+    """Peers added in a ut_pex body (IPv4 and IPv6); ValueError if malformed."""
+    d = bdecode(body)
+    if not isinstance(d, dict):
+        raise ValueError("ut_pex message is not a dict")
+    added = []
+    for key, ipv6 in ((b'added', False), (b'added6', True)):
+        data = d.get(key)
+        if isinstance(data, bytes):
+            added.extend(parse_compact(data, ipv6))
+    return added
+
+class PexState:
+    """
+    What we told one peer so far: each message carries only the difference
+    (newly connected peers in added, gone ones in dropped) since the last.
+    """
+
+    __slots__ = ('sent', 'sent_at', 'received_at')
+
+    def __init__(self):
+        self.sent = set()          # addresses the peer currently knows from us
+        self.sent_at = None
+        self.received_at = None
+
+    def due(self, now):
+        return self.sent_at is None or now - self.sent_at >= PEX_INTERVAL
+
+    def update(self, current, now):
+        """(added, dropped) to send now, at most MAX_PEX_PEERS of each; None if nothing changed."""
+        added = list(current - self.sent)[:MAX_PEX_PEERS]
+        dropped = list(self.sent - current)[:MAX_PEX_PEERS]
+        if not added and not dropped:
+            return None
+        self.sent.update(added)
+        self.sent.difference_update(dropped)
+        self.sent_at = now
+        return added, dropped
+
+    def accept(self, now):
+        """Rate limit for incoming PEX: True if this message should be used."""
+        if self.received_at is not None and now - self.received_at < PEX_INTERVAL / 2:
+            return False
+        self.received_at = now
+        return True
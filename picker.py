@@ -0,0 +1,145 @@
+# In this file we pick which piece to start next: the rarest one in the swarm,
+# using availability counts that are updated incrementally.
+
+import random
+
+# Bit offsets set in each byte value, MSB first
+_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256)]
+
+class PiecePicker:
+    """
+    Rarest-first piece picker.
+
+    availability[i] counts the connected peers that have piece i, kept up to
+    date from bitfield, have and disconnect events. Pieces we still want are
+    kept in buckets by availability; every bucket is a list with an index
+    map, so moving a piece between buckets is O(1). Peers that have every
+    piece are only counted in `seeds`: they raise every count equally, so
+    they never change the order.
+    """
+
+    def __init__(self, num_pieces, have=(), rng=None):
+        self.num_pieces = num_pieces
+        self.availability = [0] * num_pieces
+        self.seeds = 0
+        self.buckets = [[]]                  # availability -> wanted pieces
+        self.pos = [-1] * num_pieces         # index within its bucket, -1 if not wanted
+        self.wanted = 0                      # pieces in all buckets
+        self.rng = rng or random.Random()
+        self.full = bytes([0xFF]) * (num_pieces // 8) + (bytes([(0xFF << (8 - num_pieces % 8)) & 0xFF]) if num_pieces % 8 else b'')
+        have = set(have)
+        for i in range(num_pieces):
+            if i not in have:
+                self._insert(i)
+
+    # --- bucket bookkeeping ---
+
+    def _insert(self, i):
+        c = self.availability[i]
+        while len(self.buckets) <= c:
+            self.buckets.append([])
+        bucket = self.buckets[c]
+        self.pos[i] = len(bucket)
+        bucket.append(i)
+        self.wanted += 1
+
+    def _remove(self, i):
+        bucket = self.buckets[self.availability[i]]
+        p = self.pos[i]
+        last = bucket.pop()
+        if last != i:
+            bucket[p] = last
+            self.pos[last] = p
+        self.pos[i] = -1
+        self.wanted -= 1
+
+    def _bump(self, i, delta):
+        if self.pos[i] >= 0:
+            self._remove(i)
+            self.availability[i] += delta
+            self._insert(i)
+        else:
+            self.availability[i] += delta
+
+    def _bump_bitfield(self, bitfield, delta):
+        # Hot on connect: a whole bitfield moves up to num_pieces entries,
+        # so _remove/_bump/_insert are inlined here
+        availability, pos, buckets, n = self.availability, self.pos, self.buckets, self.num_pieces
+        for byte_idx, byte in enumerate(bitfield[:len(self.full)]):
+            if not byte: continue
+            base = byte_idx * 8
+            for bit in _BITS[byte]:
+                i = base + bit
+                if i >= n: break
+                c = availability[i]
+                availability[i] = c + delta
+                p = pos[i]
+                if p < 0: continue
+                bucket = buckets[c]
+                last = bucket.pop()
+                if last != i:
+                    bucket[p] = last
+                    pos[last] = p
+                if c + delta == len(buckets): buckets.append([])
+                bucket = buckets[c + delta]
+                pos[i] = len(bucket)
+                bucket.append(i)
+
+    # --- swarm events ---
+
+    def is_seed_bitfield(self, bitfield):
+        return bytes(bitfield[:len(self.full)]) == self.full
+
+    def add_bitfield(self, bitfield):
+        """Count a new peer's pieces; returns True if it was counted as a seed."""
+        if self.is_seed_bitfield(bitfield):
+            self.seeds += 1
+            return True
+        self._bump_bitfield(bitfield, 1)
+        return False
+
+    def remove_bitfield(self, bitfield, is_seed=False):
+        """Peer disconnected: pass the bitfield it had then and what add_bitfield returned."""
+        if is_seed:
+            self.seeds -= 1
+            return
+        self._bump_bitfield(bitfield, -1)
+
+    def add_have(self, index):
+        self._bump(index, 1)
+
+    # --- our own progress ---
+
+    def take(self, index):
+        """We started (or finished) this piece: stop offering it."""
+        if self.pos[index] >= 0:
+            self._remove(index)
+
+    def is_wanted(self, index):
+        """Still on offer: not ours, not started."""
+        return self.pos[index] >= 0
+
+    def put_back(self, index):
+        """Piece is wanted again (e.g. abandoned before it was started)."""
+        if self.pos[index] < 0:
+            self._insert(index)
+
+    def pick(self, peer, is_seed=False):
+        """
+        A rarest wanted piece that peer has, ties broken at random, or None.
+        Each bucket is probed from a random offset; for typical peers
+        (which have most pieces) the first probe hits. Bucket 0 holds pieces
+        no counted non-seed peer has, so only seeds need to look there.
+        """
+        for bucket in self.buckets[0 if is_seed else 1:]:
+            n = len(bucket)
+            if not n: continue
+            start = self.rng.randrange(n)
+            for k in range(n):
+                i = bucket[(start + k) % n]
+                if peer.has_piece(i):
+                    return i
+        return None
+
+    def count(self, index):
+        return self.availability[index] + self.seeds
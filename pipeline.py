@@ -0,0 +1,79 @@
+# In this file we keep several block requests outstanding per peer, across piece
+# boundaries, so a connection never idles for a round trip between pieces.
+
+import math
+import time
+
+BLOCK_SIZE = 16384
+
+class RequestPipeline:
+    """
+    Outstanding block requests of one peer with an adaptive queue depth.
+    The depth follows the bandwidth-delay product: measured download rate
+    times the minimum request round trip (the path's delay without our own
+    queueing), times `gain` so the pipeline keeps probing for more bandwidth
+    while the connection is latency-bound. It is clamped to [min_depth, max_depth].
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE, min_depth=2, max_depth=250, initial_depth=4, gain=2.0, adaptive=True):
+        self.block_size = block_size
+        self.min_depth, self.max_depth = min_depth, max_depth
+        self.depth = max(min_depth, min(initial_depth, max_depth))
+        self.gain = gain
+        self.adaptive = adaptive
+        self.outstanding = {}        # (index, begin) -> send time
+        self.rate = 0.0              # EWMA bytes/s
+        self.rtt_min = None          # seconds, re-estimated every 10 s
+        self.last_rtt = None         # round trip of the request answered last (PeerStats smooths it)
+        self._window_min = None
+        self._window_start = self._rate_start = time.monotonic()
+        self._rate_bytes = 0
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def has_room(self):
+        return len(self.outstanding) < self.depth
+
+    def sent(self, index, begin):
+        self.outstanding[(index, begin)] = time.monotonic()
+
+    def received(self, index, begin, length):
+        """Record an incoming block; False if we never asked for it (or it was cancelled)."""
+        sent_at = self.outstanding.pop((index, begin), None)
+        if sent_at is None:
+            return False
+        now = time.monotonic()
+        rtt = now - sent_at
+        self._window_min = rtt if self._window_min is None else min(self._window_min, rtt)
+        self.last_rtt = rtt
+        if self.rtt_min is None or rtt < self.rtt_min:
+            self.rtt_min = rtt
+        if now - self._window_start > 10.0:
+            # Let the minimum drift up if the path got slower
+            self.rtt_min, self._window_min, self._window_start = self._window_min, None, now
+        self._rate_bytes += length
+        elapsed = now - self._rate_start
+        if elapsed >= 0.25:
+            sample = self._rate_bytes / elapsed
+            # Fast attack, slow decay: ramp up quickly, don't collapse on one slow window
+            self.rate = sample if sample > self.rate else 0.7 * self.rate + 0.3 * sample
+            self._rate_bytes, self._rate_start = 0, now
+            self._adapt()
+        return True
+
+    def _adapt(self):
+        if not self.adaptive or not self.rtt_min:
+            return
+        bdp_blocks = self.rate * self.rtt_min / self.block_size
+        self.depth = max(self.min_depth, min(self.max_depth, math.ceil(bdp_blocks * self.gain) + 1))
+
+    def cancel(self, index, begin):
+        """Forget one outstanding request (we sent cancel, or they rejected it); False if it was not outstanding."""
+        return self.outstanding.pop((index, begin), None) is not None
+
+    def drop_all(self):
+        """Forget every outstanding request (e.g. we were choked); returns their keys."""
+        keys = list(self.outstanding)
+        self.outstanding.clear()
+        return keys
@@ -0,0 +1,57 @@
+# In this file we re-verify data that is already on disk against the torrent's
+# piece hashes, e.g. when the resume record is missing or stale.
+
+import hashlib
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+def _check(view, expected):
+    # hashlib releases the GIL for large buffers, so these run truly in parallel
+    return hashlib.sha1(view).digest() == expected
+
+def recheck(metainfo, storage, progress_callback=None, workers=None, read_size=8 * 1024 * 1024):
+    """
+    Hash every piece stored on disk and return the set of pieces that match.
+    Data is read sequentially in read_size batches (whole pieces at a time)
+    while a thread pool hashes the previous batches; at most 2*workers
+    batches are held in memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    piece_length = metainfo.piece_length
+    per_batch = max(1, read_size // piece_length)
+    good = set()
+    pending = deque()      # (futures, batch) still being hashed
+    done = 0
+    started = last_report = time.monotonic()
+
+    def drain_oldest():
+        nonlocal done, last_report
+        futures, _ = pending.popleft()
+        for idx, fut in futures:
+            if fut.result():
+                good.add(idx)
+        done += len(futures)
+        now = time.monotonic()
+        if progress_callback and (now - last_report >= 0.5 or done == metainfo.num_pieces):
+            last_report = now
+            mb_s = done * piece_length / max(now - started, 1e-9) / 1e6
+            progress_callback(done / metainfo.num_pieces, f"Rechecking {mb_s:.0f} MB/s")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for first in range(0, metainfo.num_pieces, per_batch):
+            last = min(first + per_batch, metainfo.num_pieces)
+            length = (last - first - 1) * piece_length + metainfo.piece_size(last - 1)
+            batch = memoryview(storage.read_block(first, 0, length))
+            futures = []
+            for idx in range(first, last):
+                off = (idx - first) * piece_length
+                view = batch[off:off + metainfo.piece_size(idx)]
+                futures.append((idx, pool.submit(_check, view, metainfo.piece_hash(idx))))
+            pending.append((futures, batch))
+            while len(pending) > 2 * workers:
+                drain_oldest()
+        while pending:
+            drain_oldest()
+    return good
@@ -0,0 +1,80 @@
+# In this file we keep a small resume record per torrent: which pieces are done
+# plus the size/mtime of every output file, so restarting a download never has
+# to re-read data that is already on disk.
+
+import os
+from parser import bdecode, BencodeWriter
+from storage import FileLayout, PART_SUFFIX
+
+RESUME_VERSION = 1
+
+def pieces_to_bitfield(pieces, num_pieces):
+    bf = bytearray((num_pieces + 7) // 8)
+    for i in pieces:
+        bf[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(bf)
+
+def bitfield_to_pieces(bitfield, num_pieces):
+    pieces = set()
+    for byte_idx, byte in enumerate(bitfield):
+        if not byte: continue
+        base = byte_idx * 8
+        for bit in range(8):
+            if byte & (0x80 >> bit) and base + bit < num_pieces:
+                pieces.add(base + bit)
+    return pieces
+
+def stat_files(layout):
+    """(size, mtime_ns) of every .part file of the layout, None for missing files."""
+    stats = []
+    for path in layout.paths:
+        try:
+            st = os.stat(path + PART_SUFFIX)
+            stats.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            stats.append(None)
+    return stats
+
+class ResumeData:
+    """Completed-piece bitfield for one torrent, tied to the exact files it describes."""
+
+    def __init__(self, metainfo, output_path, pieces=(), files=None):
+        self.metainfo = metainfo
+        self.output_path = output_path
+        self.pieces = set(pieces)
+        self.files = files
+
+    def is_valid_for(self, output_path):
+        """True if the record belongs to output_path and its files are untouched since."""
+        if output_path != self.output_path or self.files is None:
+            return False
+        return stat_files(FileLayout(self.metainfo, output_path)) == self.files
+
+    @classmethod
+    def load(cls, path, metainfo):
+        """Read a resume record; None if missing, corrupt or for another torrent."""
+        try:
+            with open(path, 'rb') as f:
+                d = bdecode(f.read())
+            if d[b'version'] != RESUME_VERSION or d[b'info-hash'] != metainfo.info_hash:
+                return None
+            files = [tuple(f) if f else None for f in d[b'files']]
+            pieces = bitfield_to_pieces(d[b'pieces'], metainfo.num_pieces)
+            return cls(metainfo, d[b'output'].decode('utf-8'), pieces, files)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def save(self, path, layout):
+        """Snapshot the current file metadata and atomically replace the record on disk."""
+        self.files = stat_files(layout)
+        record = {
+            b'version': RESUME_VERSION,
+            b'info-hash': self.metainfo.info_hash,
+            b'output': self.output_path,
+            b'pieces': pieces_to_bitfield(self.pieces, self.metainfo.num_pieces),
+            b'files': [list(f) if f else [] for f in self.files],
+        }
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f, BencodeWriter(f) as w:
+            w.write(record)
+        os.replace(tmp, path)
@@ -0,0 +1,210 @@
+# In this file we schedule individual 16 KiB blocks instead of whole pieces,
+# so several peers can fill one piece and a slow peer cannot hold it hostage.
+
+from pipeline import BLOCK_SIZE
+
+class PieceState:
+    """
+    Per-block bookkeeping for one piece being downloaded:
+    missing -> requested (by one or more peers) -> received.
+    """
+
+    def __init__(self, index, length, block_size=BLOCK_SIZE):
+        self.index = index
+        self.length = length
+        self.block_size = block_size
+        self.num_blocks = (length + block_size - 1) // block_size
+        self.data = bytearray(length)
+        self.reset()
+
+    def reset(self):
+        self.missing = list(range(self.num_blocks - 1, -1, -1))   # stack, lowest block on top
+        self.requested = {}                                        # block -> set of peers
+        self.received = set()
+        self.inflight = {}                                         # block -> peer receiving it into data
+        self.sources = {}                                          # block -> peer that delivered it
+
+    def block_length(self, block):
+        return min(self.block_size, self.length - block * self.block_size)
+
+    def is_complete(self):
+        return len(self.received) == self.num_blocks
+
+class BlockScheduler:
+    """
+    Central block-level scheduler shared by all peer workers.
+    next_block() hands out missing blocks of pieces already in progress
+    first (any peer's), then starts a new piece; on_block() assembles
+    pieces; release()/release_peer() put dropped requests back.
+
+    Endgame: once every block we still need has been requested, blocks
+    outstanding at other peers are handed out again to every peer that
+    has the piece. The first copy wins and on_block() names the other
+    requesters so the caller can cancel theirs.
+    """
+
+    def __init__(self, metainfo, have, picker, block_size=BLOCK_SIZE, allow_endgame=True):
+        self.metainfo = metainfo
+        self.have = have              # verified piece indices (shared set, owned by the downloader)
+        self.picker = picker          # decides which new piece to start
+        self.block_size = block_size
+        self.partial = {}             # index -> PieceState for pieces in progress
+        self.by_peer = {}             # peer -> set of (index, block) it has outstanding
+        self.allow_endgame = allow_endgame
+        self.endgame = False
+        self.duplicate_requests = 0   # endgame requests for blocks already requested elsewhere
+        self.wasted_bytes = 0         # block data that arrived but was not needed
+
+    def next_block(self, peer, allowed=None):
+        """
+        (index, begin, length) for peer to request next, or None.
+        allowed restricts the choice to those pieces (a peer that chokes us
+        but lets us fetch its allowed-fast pieces, BEP 6).
+        """
+        if allowed is not None:
+            return self._next_allowed(peer, allowed)
+        for st in self.partial.values():
+            if st.missing and peer.has_piece(st.index):
+                return self._assign(peer, st, st.missing.pop())
+
+        idx = self.pick_piece(peer)
+        if idx is not None:
+            st = self.partial[idx] = PieceState(idx, self.metainfo.piece_size(idx), self.block_size)
+            return self._assign(peer, st, st.missing.pop())
+
+        if not self.endgame:
+            if not self.allow_endgame or self.picker.wanted or any(st.missing for st in self.partial.values()):
+                return None
+            self.endgame = True
+        return self._duplicate(peer)
+
+    def _next_allowed(self, peer, allowed):
+        # The allowed-fast set may name pieces the peer doesn't have: asking for those gets a reject
+        for idx in allowed:
+            st = self.partial.get(idx)
+            if st is not None and st.missing and peer.has_piece(idx):
+                return self._assign(peer, st, st.missing.pop())
+        for idx in allowed:
+            if self.picker.is_wanted(idx) and peer.has_piece(idx):
+                self.picker.take(idx)
+                st = self.partial[idx] = PieceState(idx, self.metainfo.piece_size(idx), self.block_size)
+                return self._assign(peer, st, st.missing.pop())
+        return None
+
+    def _duplicate(self, peer):
+        # Least-duplicated block this peer has not asked for yet
+        best = best_st = None
+        for st in self.partial.values():
+            if not peer.has_piece(st.index): continue
+            for block, peers in st.requested.items():
+                if peer not in peers and (best is None or len(peers) < len(best_st.requested[best])):
+                    best, best_st = block, st
+                    if len(peers) == 1: break
+        if best is None:
+            return None
+        self.duplicate_requests += 1
+        return self._assign(peer, best_st, best)
+
+    def pick_piece(self, peer):
+        # Pieces the peer suggested (BEP 6, e.g. ones in its cache) go first
+        idx = None
+        while peer.suggested and idx is None:
+            i = peer.suggested.popleft()
+            if self.picker.is_wanted(i) and peer.has_piece(i): idx = i
+        if idx is None:
+            idx = self.picker.pick(peer, peer.is_seed)
+        if idx is not None:
+            self.picker.take(idx)
+        return idx
+
+    def _assign(self, peer, st, block):
+        st.requested.setdefault(block, set()).add(peer)
+        self.by_peer.setdefault(peer, set()).add((st.index, block))
+        return st.index, block * self.block_size, st.block_length(block)
+
+    def block_buffer(self, peer, index, begin, length):
+        """
+        Where peer may receive this block directly: a view into the piece's
+        buffer, or None (not wanted, or another peer is already writing it).
+        """
+        st = self.partial.get(index)
+        block = begin // self.block_size
+        if (st is None or begin % self.block_size or block >= st.num_blocks or block in st.received
+                or block in st.inflight or length != st.block_length(block)):
+            return None
+        st.inflight[block] = peer
+        return memoryview(st.data)[begin:begin + length]
+
+    def on_block(self, peer, index, begin, length, data=None):
+        """
+        Store a received block; data is None if it was already received into
+        the view from block_buffer(). Returns (PieceState once its last block
+        is in, else None; other peers that still have this block requested).
+        """
+        block = begin // self.block_size
+        self._forget(peer, index, block)
+        st = self.partial.get(index)
+        if data is None and st is not None and st.inflight.get(block) is peer:
+            del st.inflight[block]
+        elif data is None and (st is None or block in st.received or block in st.inflight):
+            # Released while it was landing in place, and taken over since
+            self.wasted_bytes += length
+            return None, ()
+        elif data is not None and (st is None or begin % self.block_size or block >= st.num_blocks or block in st.received
+                or block in st.inflight or length != st.block_length(block)):
+            self.wasted_bytes += length
+            return None, ()
+        peers = st.requested.pop(block, None)
+        if peers is None:
+            # Released earlier (e.g. after a choke) but arrived anyway
+            if block in st.missing: st.missing.remove(block)
+            peers = ()
+        others = [p for p in peers if p is not peer]
+        for other in others:
+            self._forget(other, index, block)
+        if data is not None:
+            st.data[begin:begin + length] = data
+        st.received.add(block)
+        st.sources[block] = peer
+        return (st if st.is_complete() else None), others
+
+    def _forget(self, peer, index, block):
+        outstanding = self.by_peer.get(peer)
+        if outstanding: outstanding.discard((index, block))
+
+    def release(self, peer, index, begin):
+        """peer will not deliver this block (choked/rejected): make it missing again."""
+        block = begin // self.block_size
+        self._forget(peer, index, block)
+        st = self.partial.get(index)
+        if st is None or block in st.received: return
+        # Another peer may receive it in place now (the caller diverts this peer's copy)
+        if st.inflight.get(block) is peer: del st.inflight[block]
+        peers = st.requested.get(block)
+        if peers is not None:
+            peers.discard(peer)
+            if not peers:
+                del st.requested[block]
+                st.missing.append(block)
+
+    def release_peer(self, peer):
+        """Peer went away: everything it had outstanding becomes missing again."""
+        for st in self.partial.values():
+            for block in [b for b, p in st.inflight.items() if p is peer]:
+                del st.inflight[block]
+        for index, block in list(self.by_peer.pop(peer, ())):
+            self.release(peer, index, block * self.block_size)
+
+    def piece_done(self, index):
+        self.partial.pop(index, None)
+
+    def piece_failed(self, index):
+        """Hash check failed: download the whole piece again. Returns {peer: bytes it sent}."""
+        st = self.partial.get(index)
+        if not st:
+            return {}
+        sent = {}
+        for block, peer in st.sources.items():
+            sent[peer] = sent.get(peer, 0) + st.block_length(block)
+        st.reset()
+        return sent
@@ -0,0 +1,368 @@
+# In this file we write verified pieces straight into preallocated output files,
+# so memory use does not grow with the size of the torrent.
+
+import bisect
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PART_SUFFIX = ".part"
+
+def preallocate(fd, length):
+    """Reserve length bytes for fd: fallocate where available, otherwise a sparse truncate."""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, length)
+            return
+        except OSError:
+            pass  # e.g. filesystems without fallocate support
+    os.ftruncate(fd, length)
+
+def _safe_component(part):
+    # Never let a path inside the torrent climb out of (or replace) the download dir:
+    # no separators, and no ':' either, so no Windows drive prefix ('C:evil.exe',
+    # which ntpath.join treats as a path of its own) or alternate data stream
+    part = part.replace('/', '_').replace('\\', '_').replace(':', '_')
+    return '_' if part in ('', '.', '..') else part
+
+class FileLayout:
+    """
+    Maps byte ranges of the torrent stream onto the files they belong to.
+    Built once from metainfo.files; lookups bisect over the cumulative
+    file offsets, so they cost O(log n) even with tens of thousands of files.
+    """
+
+    def __init__(self, metainfo, output_path):
+        self.piece_length = metainfo.piece_length
+        self.paths = []
+        self.lengths = []
+        self.offsets = []
+        for parts, length, offset in metainfo.files:
+            # parts[0] is the torrent name; output_path takes its place
+            self.paths.append(os.path.join(output_path, *map(_safe_component, parts[1:])))
+            self.lengths.append(length)
+            self.offsets.append(offset)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def segments(self, piece, begin, length):
+        """List of (file_index, file_offset, length) covering length bytes at piece:begin."""
+        pos = piece * self.piece_length + begin
+        i = bisect.bisect_right(self.offsets, pos) - 1
+        out = []
+        while length > 0 and i < len(self.paths):
+            file_off = pos - self.offsets[i]
+            n = min(length, self.lengths[i] - file_off)
+            if n > 0:
+                out.append((i, file_off, n))
+                pos += n
+                length -= n
+            i += 1
+        return out
+
+class PieceStorage:
+    """
+    Owns the on-disk output for one torrent. Each file of the torrent is
+    written as <path>.part with positional writes at the offsets given by
+    the FileLayout; finalize() renames them to their real names once
+    everything is verified, after which reads (for seeding) go to the real
+    files. For single-file torrents output_path is the file itself, for
+    multi-file torrents it is the root directory.
+    """
+
+    def __init__(self, metainfo, output_path, max_open_files=64):
+        self.metainfo = metainfo
+        self.output_path = output_path
+        self.layout = FileLayout(metainfo, output_path)
+        self.max_open_files = max_open_files
+        self._fds = OrderedDict()   # file index -> fd, least recently used first
+        self._dirty = set()         # files written since the last fsync
+        self.complete = False       # finalized: data lives in the real files
+        # Guards the fd cache (an evicted fd must not be closed mid-write) and
+        # the seek+write fallback on platforms without pwrite/pread (Windows)
+        self._lock = threading.RLock()
+
+    def part_path(self, file_index):
+        return self.layout.paths[file_index] + PART_SUFFIX
+
+    def data_path(self, file_index):
+        return self.layout.paths[file_index] if self.complete else self.part_path(file_index)
+
+    def detect_complete(self):
+        """
+        True (and switch to the real files) if a previous run already
+        finalized the download: no .part files, every real file at full size.
+        """
+        layout = self.layout
+        if any(os.path.exists(self.part_path(i)) for i in range(len(layout))):
+            return False
+        for path, length in zip(layout.paths, layout.lengths):
+            try:
+                if os.path.getsize(path) != length: return False
+            except OSError:
+                return False
+        self.complete = True
+        return True
+
+    def open(self):
+        """Create the directory tree and every (preallocated) .part file up front."""
+        with self._lock:
+            for i, path in enumerate(self.layout.paths):
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                fd = self._fd(i)
+                if os.fstat(fd).st_size != self.layout.lengths[i]:
+                    preallocate(fd, self.layout.lengths[i])
+
+    def _fd(self, file_index):
+        fd = self._fds.get(file_index)
+        if fd is not None:
+            self._fds.move_to_end(file_index)
+            return fd
+        if len(self._fds) >= self.max_open_files:
+            _, old = self._fds.popitem(last=False)
+            os.close(old)
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        fd = self._fds[file_index] = os.open(self.data_path(file_index), flags, 0o644)
+        return fd
+
+    def write_block(self, index, begin, data):
+        view = memoryview(data)
+        with self._lock:
+            for file_index, file_off, n in self.layout.segments(index, begin, len(view)):
+                self._pwrite(self._fd(file_index), view[:n], file_off)
+                self._dirty.add(file_index)
+                view = view[n:]
+
+    def read_block(self, index, begin, length):
+        with self._lock:
+            return b''.join(self._pread(self._fd(file_index), n, file_off)
+                            for file_index, file_off, n in self.layout.segments(index, begin, length))
+
+    def write_piece(self, index, data):
+        self.write_block(index, 0, data)
+
+    def read_piece(self, index):
+        return self.read_block(index, 0, self.metainfo.piece_size(index))
+
+    def _pwrite(self, fd, view, offset):
+        if hasattr(os, 'pwrite'):
+            while view:
+                n = os.pwrite(fd, view, offset)
+                view, offset = view[n:], offset + n
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while view:
+                view = view[os.write(fd, view):]
+
+    def _pread(self, fd, length, offset):
+        chunks = []
+        if hasattr(os, 'pread'):
+            while length > 0:
+                chunk = os.pread(fd, length, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                length -= len(chunk)
+                offset += len(chunk)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while length > 0:
+                chunk = os.read(fd, length)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                length -= len(chunk)
+        return b''.join(chunks)
+
+    def sync(self):
+        """fsync every file written since the last sync."""
+        with self._lock:
+            for file_index in sorted(self._dirty):
+                os.fsync(self._fd(file_index))
+            self._dirty.clear()
+
+    def close(self):
+        with self._lock:
+            while self._fds:
+                _, fd = self._fds.popitem()
+                os.close(fd)
+
+    def finalize(self):
+        """Flush everything to disk and atomically move each .part file into place."""
+        with self._lock:
+            if self.complete: return
+            self.sync()
+            self.close()
+            for i, path in enumerate(self.layout.paths):
+                os.replace(self.part_path(i), path)
+            self.complete = True
+
+class WriteCache:
+    """
+    Write-behind cache in front of a PieceStorage. Verified pieces are kept
+    in memory and written out in batches: runs of consecutive pieces are
+    coalesced into one large sequential write per file. Flushes happen when
+    flush_bytes are buffered or a piece is older than flush_interval; past
+    max_bytes the least recently written pieces are evicted (flushed) first.
+    fsync only happens in sync(), i.e. at resume checkpoints and finalize().
+    Exposes the same interface as PieceStorage.
+    """
+
+    def __init__(self, storage, flush_bytes=16 << 20, max_bytes=64 << 20, flush_interval=2.0):
+        self.storage = storage
+        self.metainfo = storage.metainfo
+        self.layout = storage.layout
+        self.flush_bytes = flush_bytes
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._pieces = OrderedDict()   # piece index -> (data, time added), oldest first
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.stats = {
+            'pieces_written': 0, 'write_calls': 0, 'bytes_coalesced': 0, 'flushes': 0,
+            'read_hits': 0, 'read_misses': 0, 'flush_time': 0.0, 'flush_time_max': 0.0,
+        }
+
+    def open(self):
+        self.storage.open()
+
+    def write_piece(self, index, data):
+        with self._lock:
+            old = self._pieces.pop(index, None)
+            if old:
+                self._bytes -= len(old[0])
+            self._pieces[index] = (data, time.monotonic())
+            self._bytes += len(data)
+            if self._bytes >= self.flush_bytes:
+                self.flush()
+            while self._bytes > self.max_bytes:
+                self._flush_run(next(iter(self._pieces)))
+
+    def flush_if_due(self):
+        """Flush runs holding pieces older than flush_interval; called periodically."""
+        with self._lock:
+            deadline = time.monotonic() - self.flush_interval
+            while self._pieces:
+                idx, (_, added) = next(iter(self._pieces.items()))
+                if added > deadline:
+                    break
+                self._flush_run(idx)
+
+    def flush(self):
+        with self._lock:
+            while self._pieces:
+                self._flush_run(min(self._pieces))
+
+    def _flush_run(self, index):
+        # Extend index to the whole run of consecutive cached pieces around it
+        first = index
+        while first - 1 in self._pieces:
+            first -= 1
+        last = index
+        while last + 1 in self._pieces:
+            last += 1
+        t = time.perf_counter()
+        chunks = [self._pieces[i][0] for i in range(first, last + 1)]
+        data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+        self.storage.write_block(first, 0, data)
+        # Only now are they on disk: a failed write leaves the run cached, see unwritten()
+        for i in range(first, last + 1):
+            del self._pieces[i]
+        self._bytes -= len(data)
+        elapsed = time.perf_counter() - t
+        st = self.stats
+        st['pieces_written'] += len(chunks)
+        st['write_calls'] += 1
+        if len(chunks) > 1:
+            st['bytes_coalesced'] += len(data)
+        st['flushes'] += 1
+        st['flush_time'] += elapsed
+        st['flush_time_max'] = max(st['flush_time_max'], elapsed)
+
+    def unwritten(self):
+        """Indices of the pieces still waiting in the cache, i.e. not on disk yet."""
+        with self._lock:
+            return set(self._pieces)
+
+    def read_block(self, index, begin, length):
+        with self._lock:
+            cached = self._pieces.get(index)
+            if cached and begin + length <= len(cached[0]):
+                self.stats['read_hits'] += 1
+                return bytes(cached[0][begin:begin + length])
+            self.stats['read_misses'] += 1
+            # Reads spanning cached pieces must see them: write those out first
+            last = index + (begin + length - 1) // self.metainfo.piece_length
+            if any(i in self._pieces for i in range(index, last + 1)):
+                self.flush()
+        return self.storage.read_block(index, begin, length)
+
+    def read_piece(self, index):
+        return self.read_block(index, 0, self.metainfo.piece_size(index))
+
+    def sync(self):
+        self.flush()
+        self.storage.sync()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.storage.close()
+
+    def finalize(self):
+        self.flush()
+        self.storage.finalize()
+
+    @property
+    def complete(self):
+        return self.storage.complete
+
+    def detect_complete(self):
+        return self.storage.detect_complete()
+
+    def summary(self):
+        st = self.stats
+        reads = st['read_hits'] + st['read_misses']
+        return (f"{st['pieces_written']} pieces in {st['write_calls']} writes, "
+                f"{st['bytes_coalesced'] / 1e6:.1f} MB coalesced, "
+                f"read hit rate {st['read_hits'] / reads * 100 if reads else 0:.0f}%, "
+                f"flush avg {st['flush_time'] / max(st['flushes'], 1) * 1000:.1f} ms "
+                f"max {st['flush_time_max'] * 1000:.1f} ms")
+
+class ReadCache:
+    """
+    LRU cache of whole verified pieces for serving uploads. Peers usually
+    request every block of a piece in a row, so one disk read serves them
+    all. Used from the event loop only; the reads themselves happen on the
+    I/O executor.
+    """
+
+    def __init__(self, max_bytes=32 << 20):
+        self.max_bytes = max_bytes
+        self._pieces = OrderedDict()   # piece index -> bytes, least recently used first
+        self._bytes = 0
+        self.hits = self.misses = 0
+
+    def get(self, index):
+        data = self._pieces.get(index)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pieces.move_to_end(index)
+        return data
+
+    def put(self, index, data):
+        if index in self._pieces: return
+        self._pieces[index] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes and len(self._pieces) > 1:
+            _, old = self._pieces.popitem(last=False)
+            self._bytes -= len(old)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return f"{lookups} lookups, hit rate {self.hits / lookups * 100 if lookups else 0:.0f}%"
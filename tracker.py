@@ -0,0 +1,240 @@
+# In this file we announce to trackers without blocking the event loop: HTTP
+# trackers over asyncio streams, UDP trackers through udp_tracker, and every
+# tracker of every tier at once, answers handed on as they arrive.
+
+import asyncio
+import os
+import random
+import ssl
+import time
+import urllib.parse
+from parser import bdecode
+from pex import parse_compact
+from udp_tracker import UdpTrackerClient, UdpTrackerError
+
+MAX_RESPONSE = 4 * 1024 * 1024
+VIEW_THRESHOLD = 1024          # compact peer lists this long are parsed from the body in place
+DEFAULT_MIN_INTERVAL = 60      # used when a tracker gives no 'min interval'
+RETRY_DELAY, MAX_RETRY_DELAY = 60, 1800
+
+class TrackerError(Exception):
+    pass
+
+class AnnounceResult:
+    __slots__ = ('peers', 'interval', 'min_interval', 'seeders', 'leechers')
+
+    def __init__(self, peers, interval=1800, min_interval=None, seeders=None, leechers=None):
+        self.peers = peers
+        self.interval, self.min_interval = interval, min_interval
+        self.seeders, self.leechers = seeders, leechers
+
+class TrackerStatus:
+    """When one tracker wants to hear from us again."""
+
+    __slots__ = ('next_at', 'min_at', 'failures', 'started', 'last_error')
+
+    def __init__(self):
+        self.next_at = self.min_at = 0.0   # regular / earliest allowed next announce
+        self.failures = 0
+        self.started = False               # a 'started' announce got through
+        self.last_error = None
+
+    def succeeded(self, result, event, now):
+        self.failures, self.last_error = 0, None
+        self.started = event != 'stopped'
+        min_interval = result.min_interval
+        if not isinstance(min_interval, int) or min_interval <= 0:
+            min_interval = min(result.interval, DEFAULT_MIN_INTERVAL)
+        self.next_at = now + result.interval
+        self.min_at = now + min(min_interval, result.interval)
+
+    def failed(self, error, now):
+        self.failures += 1
+        self.last_error = error
+        self.next_at = self.min_at = now + min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (self.failures - 1))
+
+def parse_peers(peers):
+    """Peers of an HTTP announce reply: compact bytes (or a memoryview of them) or a list of dicts."""
+    if isinstance(peers, (bytes, memoryview)):
+        return parse_compact(peers)
+    result = []
+    for p in peers if isinstance(peers, list) else ():
+        try:
+            result.append((p[b'ip'].decode(), int(p[b'port'])))
+        except (KeyError, TypeError, AttributeError, ValueError):
+            continue
+    return result
+
+def announce_query(info_hash, peer_id, port, uploaded=0, downloaded=0, left=0, event=None, numwant=50, key=0):
+    params = [('info_hash', info_hash), ('peer_id', peer_id), ('port', port), ('uploaded', uploaded),
+              ('downloaded', downloaded), ('left', left), ('compact', 1), ('numwant', numwant),
+              ('key', f"{key:08x}")]
+    if event: params.append(('event', event))
+    return '&'.join(f"{k}={urllib.parse.quote(v if isinstance(v, bytes) else str(v), safe='')}" for k, v in params)
+
+def _dechunk(body):
+    out, i = bytearray(), 0
+    while True:
+        end = body.index(b'\r\n', i)
+        size = int(body[i:end].split(b';')[0], 16)
+        if size == 0:
+            return bytes(out)
+        out += body[end + 2:end + 2 + size]
+        i = end + 4 + size
+
+async def http_announce(url, query):
+    """One GET to an HTTP(S) tracker; the caller bounds it with a timeout."""
+    parsed = urllib.parse.urlparse(url)
+    https = parsed.scheme == 'https'
+    reader, writer = await asyncio.open_connection(
+        parsed.hostname, parsed.port or (443 if https else 80), ssl=ssl.create_default_context() if https else None)
+    try:
+        target = (parsed.path or '/') + '?' + (parsed.query + '&' if parsed.query else '') + query
+        writer.write(f"GET {target} HTTP/1.0\r\nHost: {parsed.netloc}\r\nUser-Agent: NovaTorrent/1.0\r\n"
+                     f"Accept-Encoding: identity\r\nConnection: close\r\n\r\n".encode())
+        raw = bytearray()
+        while chunk := await reader.read(65536):
+            raw += chunk
+            if len(raw) > MAX_RESPONSE:
+                raise TrackerError("response too large")
+    finally:
+        writer.close()
+
+    head, _, body = bytes(raw).partition(b'\r\n\r\n')
+    lines = head.split(b'\r\n')
+    try:
+        status = int(lines[0].split()[1])
+    except (IndexError, ValueError):
+        raise TrackerError("not an HTTP response") from None
+    if status != 200:
+        raise TrackerError(f"HTTP {status}")
+    if any(line.lower().replace(b' ', b'') == b'transfer-encoding:chunked' for line in lines[1:]):
+        try:
+            body = _dechunk(body)
+        except ValueError:
+            raise TrackerError("bad chunked encoding") from None
+    try:
+        d = bdecode(body, view_threshold=VIEW_THRESHOLD)
+    except ValueError as e:
+        raise TrackerError(f"bad reply: {e}") from None
+    if not isinstance(d, dict):
+        raise TrackerError("bad reply")
+    if b'failure reason' in d:
+        raise TrackerError(bytes(d[b'failure reason']).decode('utf-8', 'replace'))
+    peers = parse_peers(d.get(b'peers', b''))
+    if isinstance(d.get(b'peers6'), (bytes, memoryview)):
+        peers += parse_compact(d[b'peers6'], ipv6=True)
+    interval = d.get(b'interval')
+    return AnnounceResult(peers, interval if isinstance(interval, int) and interval > 0 else 1800,
+                          d.get(b'min interval'), d.get(b'complete'), d.get(b'incomplete'))
+
+class TrackerTiers:
+    """
+    A torrent's trackers as BEP 12 tiers: each tier shuffled once, a tracker
+    that answers moves to the front of its tier.
+
+    Where BEP 12 tries one tracker at a time and only falls through on
+    failure, announce() asks every tracker of every tier at once and yields
+    each answer as it arrives, so peers flow in at the speed of the fastest
+    tracker and a dead one costs nothing but its timeout.
+
+    Each tracker's interval / min interval is kept in status[url]; due()
+    names the trackers to announce to now (early=True: as soon as their
+    min interval allows). Failed trackers are retried with backoff.
+
+    UDP requests are retransmitted udp_retries times with BEP 15 backoff
+    (timeout, 2 * timeout, ...); the full BEP 15 schedule of 8 retries
+    would keep an announce round open for over an hour.
+    """
+
+    SCHEMES = ('http', 'https', 'udp')
+
+    def __init__(self, tiers, timeout=15.0, udp_retries=1, rng=None):
+        rng = rng or random.Random()
+        seen = set()
+        self.tiers = []
+        for tier in tiers:
+            urls = [u for u in tier if u not in seen and urllib.parse.urlparse(u).scheme in self.SCHEMES]
+            seen.update(urls)
+            rng.shuffle(urls)
+            if urls: self.tiers.append(urls)
+        self.timeout = timeout
+        self.key = int.from_bytes(os.urandom(4), 'big')   # identifies us across IP changes
+        self.udp = UdpTrackerClient(base_timeout=timeout, max_retries=udp_retries)
+        self.status = {url: TrackerStatus() for url in self.urls()}
+        self.announcing = set()   # urls with an announce in flight
+
+    @classmethod
+    def from_metainfo(cls, metainfo, **kw):
+        return cls(metainfo.announce_list, **kw)
+
+    def __len__(self):
+        return sum(map(len, self.tiers))
+
+    def urls(self):
+        return [url for tier in self.tiers for url in tier]
+
+    def promote(self, url):
+        for tier in self.tiers:
+            if url in tier:
+                tier.remove(url)
+                tier.insert(0, url)
+                return
+
+    def due(self, now=None, early=False):
+        now = time.monotonic() if now is None else now
+        return [url for url in self.urls() if url not in self.announcing
+                and now >= (self.status[url].min_at if early else self.status[url].next_at)]
+
+    async def announce_one(self, url, info_hash, peer_id, port, uploaded=0, downloaded=0, left=0,
+                           event=None, numwant=50):
+        if url.startswith('udp://'):
+            # The UDP client has its own timeouts and retransmits
+            interval, leechers, seeders, peers = await self.udp.announce(
+                url, info_hash, peer_id, port, uploaded, downloaded, left, event, numwant, self.key)
+            return AnnounceResult(peers, interval or 1800, None, seeders, leechers)
+        query = announce_query(info_hash, peer_id, port, uploaded, downloaded, left, event, numwant, self.key)
+        try:
+            return await asyncio.wait_for(http_announce(url, query), self.timeout)
+        except asyncio.TimeoutError:
+            raise TrackerError("timed out") from None
+
+    async def announce(self, info_hash, peer_id, port, uploaded=0, downloaded=0, left=0, event=None, numwant=50,
+                       urls=None):
+        """
+        Async iterator of (url, AnnounceResult or the exception it failed
+        with), in arrival order, for urls (default: all trackers). A tracker
+        that has not acknowledged 'started' yet gets that event instead of None.
+        """
+        tasks = {}
+        for url in self.urls() if urls is None else urls:
+            ev = event or (None if self.status[url].started else 'started')
+            task = asyncio.ensure_future(self.announce_one(url, info_hash, peer_id, port, uploaded, downloaded,
+                                                           left, ev, numwant))
+            tasks[task] = (url, ev)
+            self.announcing.add(url)
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    url, ev = tasks[task]
+                    self.announcing.discard(url)
+                    try:
+                        result = task.result()
+                    except (TrackerError, UdpTrackerError, OSError, ValueError) as e:
+                        self.status[url].failed(e, time.monotonic())
+                        yield url, e
+                        continue
+                    self.status[url].succeeded(result, ev, time.monotonic())
+                    self.promote(url)
+                    yield url, result
+        finally:
+            for task in pending:
+                self.announcing.discard(tasks[task][0])
+                task.cancel()
+                # Nobody waits for it any more; it may still fail as the socket closes
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def close(self):
+        self.udp.close()
@@ -0,0 +1,208 @@
+# In this file we talk to UDP trackers (BEP 15) from the event loop: one
+# datagram socket per client, replies matched to requests by transaction id,
+# connection ids reused for a minute, lost packets retransmitted with backoff.
+
+import asyncio
+import os
+import socket
+import struct
+import time
+import urllib.parse
+
+PROTOCOL_ID = 0x41727101980
+CONNECT, ANNOUNCE, SCRAPE, ERROR = 0, 1, 2, 3
+EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+MAX_SCRAPE = 74          # info hashes per scrape packet (BEP 15)
+
+_connect = struct.Struct(">QII")
+_announce = struct.Struct(">QII20s20sQQQIIIiH")
+_header = struct.Struct(">II")              # action, transaction id
+_announce_reply = struct.Struct(">III")     # interval, leechers, seeders
+_scrape_entry = struct.Struct(">III")       # seeders, completed, leechers
+
+class UdpTrackerError(Exception):
+    pass
+
+class _Protocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.waiters = {}    # transaction id -> (future of the reply datagram, tracker address)
+        self.transport = None
+        self.error = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # Anything that does not answer one of our pending requests, from the
+        # address it was sent to, is dropped
+        if len(data) < 8: return
+        waiter = self.waiters.get(_header.unpack_from(data)[1])
+        if waiter and not waiter[0].done() and waiter[1] == addr[:2]:
+            waiter[0].set_result(data)
+
+    def error_received(self, exc):
+        self.error = exc
+
+    def connection_lost(self, exc):
+        for fut, _ in self.waiters.values():
+            if not fut.done(): fut.set_exception(UdpTrackerError("socket closed"))
+
+class UdpTrackerClient:
+    """
+    Announces to and scrapes any number of UDP trackers over one socket.
+
+    Connection ids are cached per tracker for conn_id_ttl seconds (BEP 15
+    allows one minute), so repeated announces and scrapes skip the connect
+    round trip; concurrent requests to one tracker share a single connect.
+    A request that gets no answer is sent again after base_timeout * 2**n
+    seconds, n = 0..max_retries, each time with a new transaction id.
+    Replies are checked for length, action and transaction id; an error
+    reply raises UdpTrackerError with the tracker's message.
+    """
+
+    def __init__(self, base_timeout=15.0, max_retries=8, conn_id_ttl=60.0):
+        self.base_timeout, self.max_retries, self.conn_id_ttl = base_timeout, max_retries, conn_id_ttl
+        self.protocol = None
+        self.opening = None      # future of the socket being created
+        self.conn_ids = {}       # tracker address -> (connection id, when it was obtained)
+        self.connecting = {}     # tracker address -> future of a connect in progress
+        self.packets_sent = self.retransmits = self.connects = 0
+
+    async def open(self):
+        # Announces to several trackers start at once: they all wait for one socket
+        if self.protocol is None:
+            if self.opening is None:
+                self.opening = asyncio.ensure_future(self._open())
+                self.opening.add_done_callback(self._open_done)
+            await asyncio.shield(self.opening)
+        return self
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        _, self.protocol = await loop.create_datagram_endpoint(_Protocol, local_addr=('0.0.0.0', 0))
+
+    def _open_done(self, fut):
+        self.opening = None
+        if not fut.cancelled(): fut.exception()
+
+    def close(self):
+        if self.opening:
+            self.opening.cancel()
+        if self.protocol and self.protocol.transport:
+            self.protocol.transport.close()
+        self.protocol = None
+        self.conn_ids.clear()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def resolve(self, url):
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme != 'udp' or not parsed.hostname or not parsed.port:
+            raise UdpTrackerError(f"not a udp tracker URL: {url}")
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            parsed.hostname, parsed.port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        if not infos:
+            raise UdpTrackerError(f"cannot resolve {parsed.hostname}")
+        return infos[0][4][:2]
+
+    async def _send(self, addr, packet, attempt):
+        """Send one request (packet(tid) -> bytes); the reply datagram, or None after the attempt's timeout."""
+        protocol = (await self.open()).protocol
+        tid = int.from_bytes(os.urandom(4), 'big')
+        while tid in protocol.waiters:
+            tid = int.from_bytes(os.urandom(4), 'big')
+        fut = asyncio.get_running_loop().create_future()
+        protocol.waiters[tid] = (fut, addr)
+        try:
+            protocol.transport.sendto(packet(tid), addr)
+            self.packets_sent += 1
+            if attempt: self.retransmits += 1
+            return await asyncio.wait_for(fut, self.base_timeout * 2 ** attempt)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            protocol.waiters.pop(tid, None)
+
+    @staticmethod
+    def _check(data, action, min_length):
+        got = _header.unpack_from(data)[0]
+        if got == ERROR:
+            raise UdpTrackerError(data[8:].decode('utf-8', 'replace') or "tracker error")
+        if got != action:
+            raise UdpTrackerError(f"expected action {action}, got {got}")
+        if len(data) < min_length:
+            raise UdpTrackerError(f"reply of {len(data)} bytes, expected at least {min_length}")
+        return data
+
+    async def _request(self, addr, action, body, min_length):
+        """A request that needs a connection id: packet is conn id, action, tid, body. Retransmits until answered."""
+        for attempt in range(self.max_retries + 1):
+            conn_id, fresh = await self.connection_id(addr)
+            data = await self._send(addr, lambda tid: _connect.pack(conn_id, action, tid) + body, attempt)
+            if data is None:
+                continue
+            try:
+                return self._check(data, action, min_length)
+            except UdpTrackerError:
+                if fresh: raise
+                # Possibly our cached connection id expired on the tracker's side: get a new one
+                self.conn_ids.pop(addr, None)
+        raise UdpTrackerError(f"no answer from {addr[0]}:{addr[1]} after {self.max_retries + 1} tries")
+
+    async def connection_id(self, addr):
+        """(connection id, True if just obtained) for addr, from the cache or a connect exchange."""
+        cached = self.conn_ids.get(addr)
+        if cached and time.monotonic() - cached[1] < self.conn_id_ttl:
+            return cached[0], False
+        fut = self.connecting.get(addr)
+        if fut is None:
+            fut = self.connecting[addr] = asyncio.ensure_future(self._connect(addr))
+            fut.add_done_callback(lambda f: self._connect_done(addr, f))
+        return await asyncio.shield(fut), True
+
+    def _connect_done(self, addr, fut):
+        self.connecting.pop(addr, None)
+        # Mark a failure as seen: the waiters get it through shield(), unless all were cancelled
+        if not fut.cancelled(): fut.exception()
+
+    async def _connect(self, addr):
+        for attempt in range(self.max_retries + 1):
+            data = await self._send(addr, lambda tid: _connect.pack(PROTOCOL_ID, CONNECT, tid), attempt)
+            if data is not None:
+                self._check(data, CONNECT, 16)
+                self.connects += 1
+                conn_id = struct.unpack_from(">Q", data, 8)[0]
+                self.conn_ids[addr] = (conn_id, time.monotonic())
+                return conn_id
+        raise UdpTrackerError(f"no answer from {addr[0]}:{addr[1]} after {self.max_retries + 1} tries")
+
+    async def announce(self, url, info_hash, peer_id, port, uploaded=0, downloaded=0, left=0,
+                       event=None, numwant=-1, key=0):
+        """Returns (interval, leechers, seeders, [(ip, port), ...]); numwant -1 lets the tracker decide."""
+        addr = await self.resolve(url)
+        body = _announce.pack(0, 0, 0, info_hash, peer_id, downloaded, left, uploaded,
+                              EVENTS[event], 0, key, numwant, port)[16:]
+        data = await self._request(addr, ANNOUNCE, body, 20)
+        interval, leechers, seeders = _announce_reply.unpack_from(data, 8)
+        peers = []
+        for i in range(20, len(data) - 5, 6):
+            peer_port = int.from_bytes(data[i + 4:i + 6], 'big')
+            if peer_port: peers.append((socket.inet_ntoa(data[i:i + 4]), peer_port))
+        return interval, leechers, seeders, peers
+
+    async def scrape(self, url, info_hashes):
+        """{info_hash: (seeders, completed, leechers)}; MAX_SCRAPE hashes per packet, packets sent concurrently."""
+        addr = await self.resolve(url)
+        info_hashes = list(info_hashes)
+        batches = [info_hashes[i:i + MAX_SCRAPE] for i in range(0, len(info_hashes), MAX_SCRAPE)]
+        replies = await asyncio.gather(*(self._request(addr, SCRAPE, b''.join(batch), 8 + 12 * len(batch))
+                                         for batch in batches))
+        result = {}
+        for batch, data in zip(batches, replies):
+            for i, info_hash in enumerate(batch):
+                result[info_hash] = _scrape_entry.unpack_from(data, 8 + 12 * i)
+        return result
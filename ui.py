@@ -2,43 +2,20 @@ import asyncio
 import threading
 import customtkinter as ctk
 from tkinter import filedialog, messagebox
-import socket
-import struct
-import random
-import urllib.parse
-import hashlib
-import time
 import sys
 import os
 
-from parser import bdecode, bencode
-from get_peers import get_peers_from_tracker
+from metainfo import Metainfo
+from tracker import TrackerTiers
+from dht import DhtNode, STATE_FILE
 from connect_to_peer_async import TorrentDownloader 
 
-# UDP FIX: Helper for UDP Trackers
-def get_peers_udp(url, info_hash, peer_id):
-    try:
-        parsed = urllib.parse.urlparse(url)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(5)
-        conn_id, trans_id = 0x41727101980, random.randint(0, 2**31 - 1)
-        sock.sendto(struct.pack(">QII", conn_id, 0, trans_id), (parsed.hostname, parsed.port))
-        res, _ = sock.recvfrom(1024)
-        _, _, conn_id = struct.unpack(">IIQ", res[:16])
-        sock.sendto(struct.pack(">QII20s20sQQQIIIH", conn_id, 1, trans_id, info_hash, peer_id, 0, 0, 0, 0, 0, 0, -1, 6881), (parsed.hostname, parsed.port))
-        res, _ = sock.recvfrom(4096)
-        peers = []
-        for i in range(20, len(res), 6):
-            peers.append((socket.inet_ntoa(res[i:i+4]), struct.unpack(">H", res[i+4:i+6])[0]))
-        return peers
-    except: return []
-
 class NovaTorrentApp(ctk.CTk):
     def __init__(self):
         super().__init__()
         self.title("NovaTorrent - Pro Client")
         self.geometry("750x500")
-        self.downloader = self.loop = self.torrent_path = None
+        self.downloader = self.loop = self.torrent_path = self.metainfo = None
         self.is_running = False
         
         # Protocol for window closing (X button)
@@ -80,8 +57,8 @@ class NovaTorrentApp(ctk.CTk):
         p = filedialog.askopenfilename(filetypes=[("Torrent files", "*.torrent")])
         if p:
             self.torrent_path = p
-            with open(p, 'rb') as f: d = bdecode(f.read())
-            self.file_name_label.configure(text=f"📦 {d[b'info'][b'name'].decode('utf-8', 'ignore')}")
+            self.metainfo = Metainfo.load(p)
+            self.file_name_label.configure(text=f"📦 {self.metainfo.name}")
             self.start_btn.configure(state="normal", text="▶ Start", fg_color="#2ecc71")
             self.status_label.configure(text="Loaded")
             self.progress_bar.set(0)
@@ -125,59 +102,16 @@ class NovaTorrentApp(ctk.CTk):
             print(f"🚀 NOVATORRENT ENGINE STARTING")
             print(f"[*] Torrent File: {os.path.basename(self.torrent_path)}")
             
-            with open(self.torrent_path, 'rb') as f:
-                decoded = bdecode(f.read())
-            
-            info_hash = hashlib.sha1(bencode(decoded[b'info'])).digest()
-            peer_id = b'-PY0001-' + hashlib.sha1(str(time.time()).encode()).digest()[:12]
-            
-            urls = [decoded[b'announce'].decode()]
-            if b'announce-list' in decoded:
-                for tier in decoded[b'announce-list']: urls.append(tier[0].decode())
-            
-            print(f"[*] Found {len(urls)} trackers in list. Scanning now...")
+            metainfo = self.metainfo
+            trackers = TrackerTiers.from_metainfo(metainfo)
+            print(f"[*] Found {len(trackers)} trackers in {len(trackers.tiers)} tiers. Announcing to all of them "
+                  f"and looking the torrent up in the DHT...")
             print("-"*50)
 
-            all_peers = set()
-            for url in urls:
-                if not self.is_running: break
-                
-                # Terminal par tracker status dikhane ke liye
-                print(f"[*] Trying: {url[:60]}...", end=" ", flush=True)
-                peers_before = len(all_peers)
-                
-                try:
-                    if url.startswith('udp://'):
-                        res = get_peers_udp(url, info_hash, peer_id)
-                        all_peers.update(res)
-                    elif url.startswith('http'):
-                        params = urllib.parse.urlencode({'info_hash': info_hash, 'peer_id': peer_id, 'port': 6881, 'compact': 1})
-                        with urllib.request.urlopen(url + "?" + params, timeout=3) as r:
-                            d = bdecode(r.read())
-                            if b'peers' in d and isinstance(d[b'peers'], bytes):
-                                p_data = d[b'peers']
-                                for i in range(0, len(p_data), 6):
-                                    all_peers.add(('.'.join(map(str, p_data[i:i+4])), int.from_bytes(p_data[i+4:i+6], 'big')))
-                    
-                    if len(all_peers) > peers_before:
-                        print(f"DONE (+{len(all_peers) - peers_before} peers)")
-                    else:
-                        print("NO PEERS")
-                except:
-                    print("FAILED/TIMEOUT")
-            
-            print("-" * 50)
-            if not all_peers and self.is_running:
-                print("[!] Result: No active peers found on any tracker.")
-                self.status_label.configure(text="Error: No Peers Found!", text_color="red")
-                self.is_running = False
-                self.upload_btn.configure(state="normal")
-                return
-
-            print(f"[*] Total unique peers collected: {len(all_peers)}")
-            target_name = decoded[b'info'][b'name'].decode('utf-8', 'ignore')
-            
-            self.downloader = TorrentDownloader(self.torrent_path, list(all_peers), max_peers=30)
+            # Peers from each tracker and the DHT join the download as soon as they are found
+            target_name = metainfo.name
+            self.downloader = TorrentDownloader(metainfo, [], max_peers=30, listen_port=6881, trackers=trackers,
+                                                dht=DhtNode(state_file=STATE_FILE))
             
             def up(p, s="0 KB/s"):
                 self.progress_bar.set(p)
@@ -187,7 +121,7 @@ class NovaTorrentApp(ctk.CTk):
             up(len(self.downloader.verified_indices)/self.downloader.num_pieces)
             
             print(f"[*] Starting piece download workers...")
-            self.status_label.configure(text=f"Downloading from {len(all_peers)} peers...", text_color="#3498db")
+            self.status_label.configure(text="Downloading...", text_color="#3498db")
             
             success = await self.downloader.download(target_name, progress_callback=up)
             
@@ -195,6 +129,10 @@ class NovaTorrentApp(ctk.CTk):
                 print(f"\n✅ DOWNLOAD COMPLETE: {target_name}")
                 self.status_label.configure(text="Status: Completed! 🎉", text_color="#2ecc71")
                 messagebox.showinfo("NovaTorrent", "Download Finished!")
+            elif self.is_running and not len(self.downloader.pool):
+                self.status_label.configure(text="Error: No Peers Found!", text_color="red")
+                self.is_running = False
+                self.upload_btn.configure(state="normal")
 
         except Exception as e:
             print(f"\n[!] UI ENGINE ERROR: {e}")
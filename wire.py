@@ -0,0 +1,302 @@
+# In this file we turn the byte stream of a peer connection into messages and
+# back: one receive buffer per connection, many messages parsed per read, block
+# payloads received straight into the piece they belong to, and small outbound
+# messages packed into one buffer that is written once per loop iteration.
+
+import asyncio
+import hashlib
+import ipaddress
+import struct
+from collections import deque
+
+HANDSHAKE_LENGTH = 68
+FAST_EXTENSION_BIT = 0x04              # reserved[7], BEP 6
+MAX_MESSAGE_LENGTH = 4 * 1024 * 1024   # larger than any piece block or realistic bitfield
+_u32 = struct.Struct(">I")
+_piece_header = struct.Struct(">II")
+_simple = struct.Struct(">IB")         # choke, unchoke, interested, not interested
+_have = struct.Struct(">IBI")
+_request = struct.Struct(">IBIII")     # request, cancel and reject
+_piece = struct.Struct(">IBII")        # header of a piece message
+# Smallest valid length (id + payload) of messages with a fixed payload:
+# have, suggest, allowed_fast / request, cancel, reject / piece
+_MIN_LENGTH = {4: 5, 0x0D: 5, 0x11: 5, 6: 13, 8: 13, 0x10: 13, 7: 9}
+
+class ProtocolError(Exception):
+    pass
+
+def allowed_fast_set(ip, info_hash, num_pieces, k=10):
+    """BEP 6 canonical allowed-fast set for an IPv4 peer (empty for IPv6)."""
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return set()
+    if addr.version != 4:
+        return set()
+    k = min(k, num_pieces)
+    x = (int(addr) & 0xFFFFFF00).to_bytes(4, 'big') + info_hash
+    allowed = set()
+    while len(allowed) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed) >= k: break
+            allowed.add(int.from_bytes(x[i:i + 4], 'big') % num_pieces)
+    return allowed
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    Wire codec for one peer connection.
+
+    The first 68 bytes are the handshake, queued as ('handshake', raw).
+    After that every message is queued as (msg_id, payload); piece messages
+    are queued as (7, (index, begin, length, data)). If block_buffer(index,
+    begin, length) returns a writable memoryview, the payload is received
+    directly into it and data is None; otherwise data is a bytes copy.
+
+    One idle timer runs per connection: if nothing arrives for idle_timeout
+    seconds the connection is aborted.
+
+    Outgoing control messages (queue_*) are packed into one buffer and
+    written with a single transport.write() on the next loop iteration;
+    drain() only waits when the transport is above its high-water mark.
+    """
+
+    def __init__(self, block_buffer=None, idle_timeout=120.0, buffer_size=256 * 1024, on_connect=None):
+        self.block_buffer = block_buffer
+        self.on_connect = on_connect     # called with the protocol once connected (inbound peers)
+        self.idle_timeout = idle_timeout
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0        # unparsed bytes are buf[start:end]
+        self.direct = None               # (index, begin, target view) while a block lands in place
+        self.direct_pos = 0
+        self.diverted = None             # private copy the rest of that block goes to, see divert_block()
+        self.handshaken = False
+        self.messages = deque()
+        self.transport = None
+        self.closed = False
+        self.error = None
+        self.bytes_received = 0
+        self.out = bytearray(4096)
+        self.out_len = 0
+        self._flush_scheduled = False
+        self.messages_sent = self.writes = 0
+        self._waiter = None
+        self._drain_waiter = None        # one future shared by every coroutine waiting in drain()
+        self._paused = False
+        self._idle_handle = None
+        self._last_recv = 0.0
+
+    # --- asyncio callbacks ---
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._loop = asyncio.get_running_loop()
+        self._last_recv = self._loop.time()
+        if self.idle_timeout:
+            self._idle_handle = self._loop.call_later(self.idle_timeout, self._check_idle)
+        if self.on_connect:
+            self.on_connect(self)
+
+    def get_buffer(self, sizehint):
+        if self.direct:
+            return self.direct[2][self.direct_pos:]
+        if self.end == len(self.buf):
+            if self.start:
+                # Move the unparsed tail to the front
+                n = self.end - self.start
+                self.buf[:n] = self.view[self.start:self.end]
+                self.start, self.end = 0, n
+            else:
+                # A single message is bigger than the buffer (e.g. a large bitfield)
+                self.view.release()
+                self.buf.extend(bytes(len(self.buf)))
+                self.view = memoryview(self.buf)
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self._last_recv = self._loop.time()
+        self.bytes_received += nbytes
+        if self.direct:
+            self.direct_pos += nbytes
+            index, begin, target = self.direct
+            if self.direct_pos == len(target):
+                self.direct, data, self.diverted = None, self.diverted, None
+                self._emit((7, (index, begin, len(target), data)))
+            return
+        self.end += nbytes
+        try:
+            self._parse()
+        except ProtocolError as e:
+            self.error = e
+            self.transport.abort()
+
+    def eof_received(self):
+        return False   # close our side too
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.error = self.error or exc
+        self.direct = None
+        if self._idle_handle: self._idle_handle.cancel()
+        self._wake()
+        self._wake_drain()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drain()
+
+    # --- parsing ---
+
+    def _parse(self):
+        buf, view = self.buf, self.view
+        start, end = self.start, self.end
+        emit = self.messages.append
+        while True:
+            avail = end - start
+            if not self.handshaken:
+                if avail < HANDSHAKE_LENGTH: break
+                emit(('handshake', bytes(view[start:start + HANDSHAKE_LENGTH])))
+                start += HANDSHAKE_LENGTH
+                self.handshaken = True
+                continue
+            if avail < 4: break
+            length = _u32.unpack_from(buf, start)[0]
+            if length == 0:
+                start += 4   # keep-alive
+                continue
+            if length > MAX_MESSAGE_LENGTH:
+                raise ProtocolError(f"message of {length} bytes")
+            msg_id = buf[start + 4] if avail > 4 else None
+            if length < _MIN_LENGTH.get(msg_id, 1):
+                raise ProtocolError(f"message {msg_id} of {length} bytes")
+            if msg_id == 7 and self.block_buffer:
+                if avail < 13: break
+                index, begin = _piece_header.unpack_from(buf, start + 5)
+                block_len = length - 9
+                target = self.block_buffer(index, begin, block_len)
+                if target is not None:
+                    have = min(avail - 13, block_len)
+                    target[:have] = view[start + 13:start + 13 + have]
+                    start += 13 + have
+                    if have == block_len:
+                        emit((7, (index, begin, block_len, None)))
+                        continue
+                    # Rest of the block is read by the transport straight into target
+                    self.direct, self.direct_pos = (index, begin, target), have
+                    break
+            if avail < 4 + length: break
+            if msg_id == 7:
+                index, begin = _piece_header.unpack_from(buf, start + 5)
+                emit((7, (index, begin, length - 9, bytes(view[start + 13:start + 4 + length]))))
+            else:
+                emit((msg_id, bytes(view[start + 5:start + 4 + length])))
+            start += 4 + length
+        if start == end:
+            start = end = 0
+        self.start, self.end = start, end
+        if self.messages:
+            self._wake()
+
+    def divert_block(self, index, begin):
+        """
+        The block must no longer land in the buffer block_buffer() gave for it
+        (e.g. its request was handed to another peer): if it is arriving in
+        place right now, the rest goes to a private copy, queued as data.
+        """
+        if self.direct and self.direct[:2] == (index, begin) and self.diverted is None:
+            target = self.direct[2]
+            self.diverted = bytearray(len(target))
+            self.diverted[:self.direct_pos] = target[:self.direct_pos]
+            self.direct = (index, begin, memoryview(self.diverted))
+
+    def _emit(self, msg):
+        self.messages.append(msg)
+        self._wake()
+
+    # --- outbound ---
+
+    def _reserve(self, n):
+        off = self.out_len
+        if off + n > len(self.out):
+            self.out.extend(bytes(max(n, len(self.out))))
+        self.out_len = off + n
+        self.messages_sent += 1
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self.flush)
+        return off
+
+    def queue_simple(self, msg_id):
+        _simple.pack_into(self.out, self._reserve(5), 1, msg_id)
+
+    def queue_have(self, index, msg_id=4):
+        # Also used for suggest and allowed_fast, which have the same layout
+        _have.pack_into(self.out, self._reserve(9), 5, msg_id, index)
+
+    def queue_request(self, index, begin, length, msg_id=6):
+        # Also cancel and reject, which have the same layout
+        _request.pack_into(self.out, self._reserve(17), 13, msg_id, index, begin, length)
+
+    def queue_message(self, msg_id, payload):
+        """Any other message (e.g. a bitfield): length prefix, id, payload."""
+        off = self._reserve(5 + len(payload))
+        _simple.pack_into(self.out, off, 1 + len(payload), msg_id)
+        self.out[off + 5:off + 5 + len(payload)] = payload
+
+    def send_block(self, index, begin, data):
+        """A piece message; the payload is written as is, not copied into the queue."""
+        self.flush()
+        if not self.closed:
+            self.transport.writelines((_piece.pack(9 + len(data), 7, index, begin), data))
+            self.writes += 1
+
+    def flush(self):
+        self._flush_scheduled = False
+        if self.out_len and not self.closed:
+            # A slice is a copy, so self.out can be reused while the transport
+            # still holds unsent data
+            self.transport.write(self.out[:self.out_len])
+            self.writes += 1
+        self.out_len = 0
+
+    # --- consumer side ---
+
+    def _wake(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def wait_message(self, timeout):
+        """Wait until a message is queued, the connection closes or timeout passes."""
+        if self.messages or self.closed: return
+        self._waiter = self._loop.create_future()
+        handle = self._loop.call_later(timeout, self._wake)
+        try:
+            await self._waiter
+        finally:
+            handle.cancel()
+            self._waiter = None
+
+    async def drain(self):
+        """Real backpressure: only waits while the transport is above its high-water mark."""
+        if self._paused and not self.closed:
+            # Downloading and uploading both drain the same connection
+            if self._drain_waiter is None:
+                self._drain_waiter = self._loop.create_future()
+            await asyncio.shield(self._drain_waiter)
+
+    def _wake_drain(self):
+        if self._drain_waiter:
+            if not self._drain_waiter.done(): self._drain_waiter.set_result(None)
+            self._drain_waiter = None
+
+    def _check_idle(self):
+        idle = self._loop.time() - self._last_recv
+        if idle >= self.idle_timeout:
+            self.error = self.error or TimeoutError(f"no data for {idle:.0f} s")
+            self.transport.abort()
+        else:
+            self._idle_handle = self._loop.call_later(self.idle_timeout - idle, self._check_idle)